@@ -0,0 +1,86 @@
+import threading
+from contextlib import contextmanager
+
+
+class QueryTooExpensive(Exception):
+    pass
+
+
+class OverBudget(Exception):
+    pass
+
+
+def query_cost(days: int, origin_ports, destination_ports) -> int:
+    """
+    estimates the cost of a price query as the number of (day, origin port, destination port) cells it covers
+    :param days: days of the date range, an empty (reversed) range costs nothing
+    """
+    return max(0, days) * len(origin_ports) * len(destination_ports)
+
+
+class CostBudget:
+    """
+    limits the total estimated cost of the price queries running at once
+
+    queries over the per query ceiling are rejected, queries that do not fit in the budget wait for running ones
+    to finish and are shed if they still do not fit after queue_timeout seconds;
+    a query is always admitted when nothing else is running, so one over the budget can still run on its own
+    """
+
+    def __init__(self, budget: int = 0, max_cost: int = 0, queue_timeout: float = 1.0):
+        """
+        :param budget: total cost of the queries running at once, 0 for no budget
+        :param max_cost: cost of a single query, 0 for no ceiling
+        """
+        self.budget = budget
+        self.max_cost = max_cost
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    def check(self, cost: int):
+        """
+        :raises QueryTooExpensive: when the cost is over the per query ceiling
+        """
+        with self._condition:
+            if self.max_cost and cost > self.max_cost:
+                self.rejected += 1
+                raise QueryTooExpensive(f"query cost {cost} is over the limit of {self.max_cost}, "
+                                        f"narrow the date range, origin or destination")
+
+    def _fits(self, cost: int) -> bool:
+        return not self.budget or self.in_flight == 0 or self.in_flight + cost <= self.budget
+
+    @contextmanager
+    def admit(self, cost: int, ceiling: bool = True):
+        """
+        runs the block once the query's cost fits in the budget
+        :param ceiling: False when the cost adds up queries already checked against the ceiling
+        :raises QueryTooExpensive: when the cost is over the per query ceiling
+        :raises OverBudget: when the cost did not fit within queue_timeout seconds
+        """
+        if ceiling:
+            self.check(cost)
+        with self._condition:
+            if not self._fits(cost):
+                self.queued += 1
+                if not self._condition.wait_for(lambda: self._fits(cost), self.queue_timeout):
+                    self.shed += 1
+                    raise OverBudget("server busy, try again later")
+            self.in_flight += cost
+            self.admitted += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= cost
+                self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"in_flight_cost": self.in_flight, "admitted": self.admitted, "queued": self.queued,
+                    "rejected": self.rejected, "shed": self.shed}
@@ -0,0 +1,152 @@
+"""
+asyncio serving mode
+
+    uvicorn asgi:app
+
+the flask app's routes run unchanged on a bounded pool of ASGI_WORKERS threads, while reading requests and writing
+responses happen on the event loop, so a slow client holds a connection but not a thread;
+price queries over long date ranges fan out over the database executor (see PRICE_CHUNK_DAYS)
+"""
+import asyncio
+import contextvars
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import server
+
+
+class AsgiAdapter:
+    """
+    serves a WSGI app to an ASGI server, calling it on a bounded executor
+
+    each request's body is read before the app is called and its response is sent as the app produces it,
+    every call into the app of one request runs in the same context, so a streamed response can be resumed
+    on any of the executor's threads
+    """
+
+    def __init__(self, wsgi_app, max_workers: int = 32, startup=None, shutdown=None):
+        """
+        :param startup: function called on an executor thread before the first request, e.g. server.create_app
+        :param shutdown: function called on an executor thread when the ASGI server stops
+        """
+        self.wsgi_app = wsgi_app
+        self.startup = startup
+        self.shutdown = shutdown
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='asgi')
+
+    async def __call__(self, scope: dict, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    if self.startup is not None:
+                        await loop.run_in_executor(self.executor, self.startup)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': repr(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.shutdown is not None:
+                    await loop.run_in_executor(self.executor, self.shutdown)
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope: dict, receive, send):
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.write(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        response = {}
+
+        def start_response(status: str, headers: list, exc_info=None):
+            if exc_info is not None and response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return lambda data: response.setdefault('written', []).append(data)
+
+        def call():
+            chunks = self.wsgi_app(wsgi_environ(scope, body), start_response)
+            return chunks, iter(chunks)
+
+        def next_chunk(chunks):
+            return next(chunks, None)
+
+        iterable = None
+        try:
+            try:
+                iterable, chunks = await loop.run_in_executor(self.executor, context.run, call)
+                # the status and headers are known once the app produced its first chunk
+                chunk = await loop.run_in_executor(self.executor, context.run, next_chunk, chunks)
+            except Exception:
+                await send_error(send, HTTPStatus.INTERNAL_SERVER_ERROR)
+                raise
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+            for data in response.pop('written', []):
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(self.executor, context.run, next_chunk, chunks)
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            if iterable is not None and hasattr(iterable, 'close'):
+                await loop.run_in_executor(self.executor, context.run, iterable.close)
+
+
+def wsgi_environ(scope: dict, body: io.BytesIO) -> dict:
+    """
+    builds the WSGI environ of an ASGI http request
+    """
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        value = value.decode('latin-1')
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def send_error(send, status: HTTPStatus):
+    await send({'type': 'http.response.start', 'status': status.value,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': status.phrase.encode(), 'more_body': False})
+
+
+app = AsgiAdapter(server.app, server.asgi_workers, server.create_app, server.close_app)
@@ -0,0 +1,49 @@
+import random
+from datetime import date, timedelta
+from string import ascii_uppercase
+
+
+def port_code(index: int) -> str:
+    """
+    turns an index into a 5 letter uppercase port code, AAAAA, AAAAB, ...
+    """
+    letters = []
+    for _ in range(5):
+        index, letter = divmod(index, len(ascii_uppercase))
+        letters.append(ascii_uppercase[letter])
+    return ''.join(reversed(letters))
+
+
+def generate(roots: int = 2, depth: int = 3, fan_out: int = 3, ports_per_region: int = 3, lanes: int = 200,
+             days: int = 60, quotes: int = 4, start: date = date(2016, 1, 1), seed: int = 0) -> dict:
+    """
+    generates a synthetic catalog and price history
+
+    every region has fan_out child regions down to depth levels, and ports_per_region ports of its own
+    each lane is a random origin and destination port pair quoted between 0 and 2 * quotes times a day
+    :return: dictionary of {ports: [(code, name, parent_slug)], regions: [(slug, name, parent_slug)],
+                            prices: [(orig_code, dest_code, day, price)]}
+    """
+    rand = random.Random(seed)
+    regions = []
+    ports = []
+    regions_left = [(f"region_{root}", None, 1) for root in range(roots)]
+    while regions_left:
+        slug, parent_slug, level = regions_left.pop()
+        regions.append((slug, slug.replace('_', ' ').title(), parent_slug))
+        for _ in range(ports_per_region):
+            code = port_code(len(ports))
+            ports.append((code, f"Port {code}", slug))
+        if level < depth:
+            regions_left += [(f"{slug}_{child}", slug, level + 1) for child in range(fan_out)]
+
+    codes = [code for code, _, _ in ports]
+    prices = []
+    for _ in range(lanes):
+        orig_code, dest_code = rand.sample(codes, 2)
+        base = rand.randrange(500, 3000)
+        for day in range(days):
+            for _ in range(rand.randrange(2 * quotes + 1)):
+                prices.append((orig_code, dest_code, start + timedelta(days=day), base + rand.randrange(-200, 200)))
+
+    return {"ports": ports, "regions": regions, "prices": prices}
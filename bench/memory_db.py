@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+
+class MemoryDB:
+    """
+    local stand-in for DB holding the generated data in memory, for benchmarking without postgres
+
+    answers the same read queries as DB, so the server code above it runs unchanged
+    """
+
+    def __init__(self, data: dict):
+        self.ports = [(code, parent_slug) for code, _, parent_slug in data["ports"]]
+        self.regions = [(slug, parent_slug) for slug, _, parent_slug in data["regions"]]
+        self.prices = data["prices"]
+        self.prices_by_day = {}
+        for row in self.prices:
+            self.prices_by_day.setdefault(row[2], []).append(row)
+
+    def _days(self, date_from: str, date_to: str):
+        day = datetime.strptime(date_from, '%Y-%m-%d').date()
+        end = datetime.strptime(date_to, '%Y-%m-%d').date()
+        while day <= end:
+            yield day
+            day += timedelta(days=1)
+
+    def get_ports(self) -> [tuple]:
+        return list(self.ports)
+
+    def get_regions(self) -> [tuple]:
+        return list(self.regions)
+
+    def get_data_version(self) -> int:
+        return 1
+
+    def get_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        origin_ports, destination_ports = set(origin_ports), set(destination_ports)
+        sums = []
+        for day in self._days(date_from, date_to):
+            prices = [price for org, dest, _, price in self.prices_by_day.get(day, [])
+                      if org in origin_ports and dest in destination_ports]
+            if prices:
+                sums.append((day, sum(prices), len(prices)))
+        return sums
+
+    def get_bucket_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str,
+                        granularity: str) -> [tuple]:
+        start = datetime.strptime(date_from, '%Y-%m-%d').date()
+        sums = {}
+        for day, price_sum, count in self.get_price_sums(origin_ports, destination_ports, date_from, date_to):
+            bucket = day - timedelta(days=day.weekday()) if granularity == 'week' else day.replace(day=1)
+            bucket = max(bucket, start)
+            bucket_sum, bucket_count = sums.get(bucket, (0, 0))
+            sums[bucket] = (bucket_sum + price_sum, bucket_count + count)
+        return [(bucket, price_sum, count) for bucket, (price_sum, count) in sorted(sums.items())]
+
+    def iter_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str,
+                        chunk_size: int = 1000):
+        yield from self.get_price_sums(origin_ports, destination_ports, date_from, date_to)
+
+    def get_port_pair_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        origin_ports, destination_ports = set(origin_ports), set(destination_ports)
+        sums = []
+        for day in self._days(date_from, date_to):
+            pairs = {}
+            for org, dest, _, price in self.prices_by_day.get(day, []):
+                if org in origin_ports and dest in destination_ports:
+                    price_sum, count = pairs.get((org, dest), (0, 0))
+                    pairs[(org, dest)] = (price_sum + price, count + 1)
+            sums += [(org, dest, day, price_sum, count) for (org, dest), (price_sum, count) in pairs.items()]
+        return sums
+
+    def iter_prices(self, chunk_size: int = 10000):
+        for i in range(0, len(self.prices), chunk_size):
+            yield self.prices[i:i + chunk_size]
+
+    def close(self):
+        pass
@@ -0,0 +1,130 @@
+"""
+compares the scan cost of price queries on a single prices table and on monthly partitions
+
+    python -m bench.partitions --days 730
+
+loads the same generated prices into a bench_flat schema laid out as in rates.sql and a bench_partitioned schema
+laid out by migrations/003_partition_prices.sql, in the database configured in .env, then prints the
+EXPLAIN ANALYZE timings, buffers and partitions scanned of single day and multi-month queries on each;
+both schemas are dropped afterwards
+"""
+import argparse
+import io
+import json
+import os
+import random
+
+import server
+from bench.generate import generate
+from database import DB
+
+MIGRATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations',
+                         '003_partition_prices.sql')
+
+# the generated ports are not in the database's ports table, so the scratch schema has one for the foreign keys
+FLAT_SCHEMA = """
+    CREATE TABLE ports (code text PRIMARY KEY);
+    CREATE TABLE prices (orig_code text NOT NULL REFERENCES ports(code), dest_code text NOT NULL REFERENCES ports(code),
+                         day date NOT NULL, price integer NOT NULL);
+    CREATE INDEX prices_orig_code_dest_code_day_idx ON prices (orig_code, dest_code, "day");
+    """
+
+# a scan of every lane on one day, and the query of DB.get_price_sums over one day and over three months
+QUERIES = {
+    "single day, every lane": """
+        select x.orig_code, x.dest_code, sum(x.price), count(x.price) FROM prices x
+        where x."day" = %(day)s::date
+        group by x.orig_code, x.dest_code
+        """,
+    "single day, one lane": """
+        select x."day", sum(x.price), count(x.price) FROM prices x
+        where x.orig_code = ANY(%(origin_ports)s) and x.dest_code = ANY(%(destination_ports)s)
+          and x."day" between %(day)s::date and %(day)s::date
+        group by x."day"
+        """,
+    "three months, one lane": """
+        select x."day", sum(x.price), count(x.price) FROM prices x
+        where x.orig_code = ANY(%(origin_ports)s) and x.dest_code = ANY(%(destination_ports)s)
+          and x."day" between %(day)s::date and %(day)s::date + 90
+        group by x."day"
+        """,
+}
+
+
+def load(cur, schema: str, ports: list, prices: list, partitioned: bool):
+    """
+    creates the schema's ports and prices tables and copies the generated data into them,
+    leaving the schema on the search path
+    """
+    cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path = {schema}, public;")
+    cur.execute(FLAT_SCHEMA)
+    cur.copy_expert('COPY ports (code) FROM STDIN', io.StringIO("".join(f"{code}\n" for code, _, _ in ports)))
+    buffer = io.StringIO()
+    for org, dest, day, price in prices:
+        buffer.write(f"{org}\t{dest}\t{day}\t{price}\n")
+    buffer.seek(0)
+    cur.copy_expert('COPY prices (orig_code, dest_code, "day", price) FROM STDIN', buffer)
+    if partitioned:
+        with open(MIGRATION) as f:
+            cur.execute(f.read())
+    cur.execute("ANALYZE prices;")
+
+
+def explain(cur, sql: str, params: dict) -> dict:
+    """
+    :return: dictionary of {planning_ms, execution_ms, shared_buffers, partitions} of the query's plan
+    """
+    cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+    plan = cur.fetchone()[0][0]
+
+    def walk(node):
+        yield node
+        for child in node.get("Plans", []):
+            yield from walk(child)
+
+    nodes = list(walk(plan["Plan"]))
+    return {"planning_ms": plan["Planning Time"], "execution_ms": plan["Execution Time"],
+            "shared_buffers": plan["Plan"].get("Shared Hit Blocks", 0) + plan["Plan"].get("Shared Read Blocks", 0),
+            "partitions": len({node["Relation Name"] for node in nodes if "Relation Name" in node})}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lanes', type=int, default=500)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--quotes', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5, help="runs of each query, the fastest is reported")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    data = generate(lanes=args.lanes, days=args.days, quotes=args.quotes, seed=args.seed)
+    print(f"generated {len(data['prices'])} prices over {args.days} days")
+    rand = random.Random(args.seed)
+    org, dest, day, _ = rand.choice(data['prices'])
+    params = {"day": str(day), "origin_ports": [org], "destination_ports": [dest]}
+
+    db = DB(server.db_host, server.db_database, server.db_user, server.db_password)
+    report = {}
+    try:
+        for schema, partitioned in [("bench_flat", False), ("bench_partitioned", True)]:
+            with db.cursor() as cur:
+                try:
+                    load(cur, schema, data['ports'], data['prices'], partitioned)
+                    report[schema] = {name: min((explain(cur, sql, params) for _ in range(args.repeat)),
+                                                key=lambda result: result["execution_ms"])
+                                      for name, sql in QUERIES.items()}
+                finally:
+                    cur.execute(f"RESET search_path; DROP SCHEMA IF EXISTS {schema} CASCADE;")
+    finally:
+        db.close()
+
+    print(json.dumps(report, indent=2))
+    for name in QUERIES:
+        flat, partitioned = report["bench_flat"][name], report["bench_partitioned"][name]
+        print(f"{name}: {flat['execution_ms']:.2f}ms -> {partitioned['execution_ms']:.2f}ms, "
+              f"{flat['shared_buffers']} -> {partitioned['shared_buffers']} buffers, "
+              f"{partitioned['partitions']} partitions scanned")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""
+benchmarks /rates against generated data
+
+    python -m bench.run --backend memory
+    python -m bench.run --backend postgres --load
+
+--load replaces the ports, regions and prices of the database configured in .env with the generated data
+results are saved to bench/results/, pass --compare <results file> to print the change against an earlier run
+"""
+import argparse
+import io
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import server
+from bench.generate import generate
+from bench.memory_db import MemoryDB
+from cache import CellCache, LRUCache
+from catalog import Catalog
+from columnar import ColumnarPrices
+from database import DB
+from shards import ShardedPrices
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+MIXES = ['port-port', 'port-region', 'region-region']
+
+
+class CountingDB:
+    """
+    wraps a DB, counting the calls and rows fetched of each of its methods
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.calls = {}
+        self.rows = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        def counted(*args, **kwargs):
+            result = method(*args, **kwargs)
+            rows = len(result) if isinstance(result, list) else 0
+            with self._lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.rows[name] = self.rows.get(name, 0) + rows
+            return result
+
+        return counted
+
+    def share(self, db) -> 'CountingDB':
+        """
+        wraps another db, counting its calls together with this one's
+        """
+        counting_db = CountingDB(db)
+        counting_db.calls, counting_db.rows, counting_db._lock = self.calls, self.rows, self._lock
+        return counting_db
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.rows.clear()
+
+
+def load_postgres(db: DB, data: dict):
+    """
+    replaces the ports, regions and prices tables with the generated data
+    """
+    def copy(cur, table: str, columns: str, rows: list):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join('\\N' if value is None else str(value) for value in row) + '\n')
+        buffer.seek(0)
+        cur.copy_expert(f"COPY {table} ({columns}) FROM STDIN", buffer)
+
+    with db.transaction() as conn:
+        cur = conn.cursor()
+        cur.execute("TRUNCATE prices, ports, regions;")
+        copy(cur, 'regions', 'slug, name, parent_slug', data['regions'])
+        copy(cur, 'ports', 'code, name, parent_slug', data['ports'])
+        cur.close()
+        db.copy_prices(data['prices'])
+
+
+def split_by_date(data: dict, count: int) -> list:
+    """
+    splits the generated prices into count shards of consecutive days
+    :return: list of (first day, last day, generated data holding the shard's prices)
+    """
+    days = sorted({day for _, _, day, _ in data['prices']})
+    size = -(-len(days) // count)
+    shards = []
+    for i in range(0, len(days), size):
+        first, last = days[i], days[min(i + size, len(days)) - 1]
+        shards.append((first, last, {**data, 'prices': [row for row in data['prices'] if first <= row[2] <= last]}))
+    return shards
+
+
+def build_queries(data: dict, count: int, mix: dict, max_days: int, seed: int = 0) -> list:
+    """
+    picks count random /rates queries from the lanes of the generated data
+    port ends of a lane are swapped for one of their regions depending on the mix
+    :param mix: dictionary of {mix name: weight}
+    :return: list of (mix name, query string)
+    """
+    rand = random.Random(seed)
+    parents = {slug: parent_slug for slug, _, parent_slug in data['regions']}
+    parents.update({code: parent_slug for code, _, parent_slug in data['ports']})
+    lanes = sorted({(org, dest) for org, dest, _, _ in data['prices']})
+    days = sorted({day for _, _, day, _ in data['prices']})
+
+    def region_of(port: str) -> str:
+        node = parents[port]
+        while parents.get(node) is not None and rand.random() < 0.5:
+            node = parents[node]
+        return node
+
+    names, weights = zip(*mix.items())
+    queries = []
+    for _ in range(count):
+        name = rand.choices(names, weights)[0]
+        origin, destination = rand.choice(lanes)
+        if name == 'region-region':
+            origin = region_of(origin)
+        if name in ('port-region', 'region-region'):
+            destination = region_of(destination)
+        date_from = rand.choice(days)
+        date_to = min(date_from + timedelta(days=rand.randrange(max_days)), days[-1])
+        queries.append((name, f"/rates?date_from={date_from}&date_to={date_to}&origin={origin}&destination={destination}"))
+    return queries
+
+
+def percentile(latencies: list, p: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def run(queries: list, concurrency: int, counting_db: CountingDB) -> dict:
+    """
+    sends the queries to the app from concurrency threads
+    :return: report of throughput, latency percentiles and database query counts, overall and per mix
+    """
+    latencies = {name: [] for name in MIXES}
+    errors = []
+    lock = threading.Lock()
+
+    def send(query):
+        name, url = query
+        client = server.app.test_client()
+        started = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies[name].append(elapsed * 1000)
+            if response.status_code != 200:
+                errors.append((url, response.status_code))
+
+    counting_db.reset()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, queries))
+    duration = time.perf_counter() - started
+
+    def summary(values: list) -> dict:
+        return {"requests": len(values),
+                "latency_ms": {"p50": percentile(values, 50), "p95": percentile(values, 95),
+                               "p99": percentile(values, 99), "max": max(values, default=0.0)}}
+
+    every_latency = [latency for values in latencies.values() for latency in values]
+    return {"throughput_rps": len(queries) / duration if duration else 0.0,
+            "errors": len(errors),
+            **summary(every_latency),
+            "mixes": {name: summary(values) for name, values in latencies.items() if values},
+            "db_calls": dict(counting_db.calls),
+            "db_rows": dict(counting_db.rows),
+            "db_calls_per_request": sum(counting_db.calls.values()) / len(queries) if queries else 0.0}
+
+
+def compare(report: dict, previous: dict):
+    """
+    prints the change of the headline numbers against an earlier report
+    """
+    def change(new: float, old: float) -> str:
+        return f"{old:.2f} -> {new:.2f} ({(new - old) / old * 100:+.1f}%)" if old else f"{old:.2f} -> {new:.2f}"
+
+    print(f"throughput_rps: {change(report['throughput_rps'], previous['throughput_rps'])}")
+    for p in ['p50', 'p95', 'p99']:
+        print(f"latency {p} ms: {change(report['latency_ms'][p], previous['latency_ms'][p])}")
+    print(f"db_calls_per_request: {change(report['db_calls_per_request'], previous['db_calls_per_request'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=['memory', 'postgres'], default='memory')
+    parser.add_argument('--load', action='store_true', help="load the generated data into postgres first")
+    parser.add_argument('--engine', choices=['sql', 'columnar'], default='sql')
+    parser.add_argument('--cache', action='store_true', help="enable the response and cell caches")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="split the prices by date over this many in-memory shards (memory backend)")
+    parser.add_argument('--roots', type=int, default=2)
+    parser.add_argument('--depth', type=int, default=3)
+    parser.add_argument('--fan-out', type=int, default=3)
+    parser.add_argument('--ports-per-region', type=int, default=3)
+    parser.add_argument('--lanes', type=int, default=200)
+    parser.add_argument('--days', type=int, default=60)
+    parser.add_argument('--quotes', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-range', type=int, default=31, help="longest date range queried, in days")
+    parser.add_argument('--mix', default='port-port=1,port-region=1,region-region=1')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key != 'compare'}
+    data = generate(args.roots, args.depth, args.fan_out, args.ports_per_region, args.lanes, args.days, args.quotes,
+                    seed=args.seed)
+    print(f"generated {len(data['regions'])} regions, {len(data['ports'])} ports, {len(data['prices'])} prices")
+
+    if args.backend == 'postgres':
+        db = DB(server.db_host, server.db_database, server.db_user, server.db_password,
+                server.db_pool_min, max(server.db_pool_max, args.concurrency), server.db_pool_timeout)
+        if args.load:
+            load_postgres(db, data)
+    else:
+        db = MemoryDB(data)
+
+    counting_db = CountingDB(db)
+    server.db = counting_db
+    server.catalog = Catalog(counting_db)
+    server.engine = None
+    if args.shards > 1 and args.backend == 'memory':
+        server.engine = ShardedPrices([(first, last, counting_db.share(MemoryDB(part)))
+                                       for first, last, part in split_by_date(data, args.shards)])
+    if args.engine == 'columnar':
+        server.engine = ColumnarPrices(server.get_engine())
+    server.response_cache = LRUCache() if args.cache else None
+    server.cell_cache = CellCache() if args.cache else None
+
+    mix = {name: float(weight) for name, weight in (part.split('=') for part in args.mix.split(','))}
+    queries = build_queries(data, args.requests, mix, args.max_range, args.seed)
+    report = {"config": config, **run(queries, args.concurrency, counting_db)}
+    db.close()
+
+    print(json.dumps({key: value for key, value in report.items() if key != 'config'}, indent=2))
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ') + '.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"saved {path}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
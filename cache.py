@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from database import DB
+from shards import PartialSums
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    bounded least recently used cache, used for /rates results and daily price sums
+
+    entries expire ttl seconds after being stored, and are only returned for the data version they were computed at
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version: int):
+        """
+        :return: the cached value, or None when missing, expired or computed at another data version
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_version, stored_at = entry
+                if entry_version == version and time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, version: int, value):
+        with self._lock:
+            self._entries[key] = (value, version, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "size": len(self._entries), "max_size": self.max_size}
+
+
+class CellCache:
+    """
+    cache of the daily price sums of each (origin, destination, day) cell
+
+    a date range is assembled from the cells already cached, only the missing contiguous day spans are fetched
+    """
+
+    def __init__(self, max_cells: int = 100000, ttl: float = 300.0):
+        self.cells = LRUCache(max_cells, ttl)
+
+    def get_daily_sums(self, origin: str, destination: str, date_from: str, date_to: str, version: int, fetch) -> list:
+        """
+        sums the prices between the origin and destination for each day in [date_from, date_to]
+        :param fetch: function of (date_from, date_to) returning the (day, price sum, price count) rows of a day span
+        :return: list of (day, price sum, price count) ordered by day, days without prices are left out
+        :raises PartialSums: when fetch could not get some days, carrying the days that were fetched or cached
+        """
+        start = datetime.strptime(date_from, '%Y-%m-%d').date()
+        days = [start + timedelta(days=offset) for offset in
+                range((datetime.strptime(date_to, '%Y-%m-%d').date() - start).days + 1)]
+
+        sums = {}
+        missing = []
+        for day in days:
+            cell = self.cells.get((origin, destination, day), version)
+            if cell is None:
+                missing.append(day)
+            else:
+                sums[day] = cell
+
+        unavailable = []
+        for span_from, span_to in self._spans(missing):
+            try:
+                rows = fetch(span_from.strftime('%Y-%m-%d'), span_to.strftime('%Y-%m-%d'))
+                span_unavailable = []
+            except PartialSums as e:
+                rows, span_unavailable = e.rows, e.missing
+                unavailable += e.missing
+            fetched = {day: (price_sum, count) for day, price_sum, count in rows}
+            for offset in range((span_to - span_from).days + 1):
+                day = span_from + timedelta(days=offset)
+                sums[day] = fetched.get(day, (0, 0))
+                # days without prices are cached too, so they are not fetched again,
+                # unless their shard did not answer
+                day_string = day.strftime('%Y-%m-%d')
+                if not any(first <= day_string <= last for first, last in span_unavailable):
+                    self.cells.set((origin, destination, day), version, sums[day])
+
+        daily_sums = [(day, *sums[day]) for day in days if sums[day][1] > 0]
+        if unavailable:
+            raise PartialSums(daily_sums, unavailable)
+        return daily_sums
+
+    @staticmethod
+    def _spans(days: list) -> list:
+        """
+        groups sorted days into contiguous spans
+        :return: list of (first day, last day)
+        """
+        spans = []
+        for day in days:
+            if spans and day - spans[-1][1] == timedelta(days=1):
+                spans[-1][1] = day
+            else:
+                spans.append([day, day])
+        return [tuple(span) for span in spans]
+
+    def clear(self):
+        self.cells.clear()
+
+    def stats(self) -> dict:
+        return self.cells.stats()
+
+
+class SingleFlight:
+    """
+    runs one computation per key at a time, callers asking for a key already being computed wait for it
+    and share its result (or its exception) instead of computing it again
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, compute):
+        """
+        :param compute: function without arguments computing the key's result
+        :return: the result of compute, run by this caller or by the caller already computing the key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+class DataVersion:
+    """
+    tracks the version of the data in the database, which changes whenever prices, ports or regions change
+
+    the database is polled at most once every poll_interval seconds, listeners are called when the version changes;
+    they run on a background thread and the new version is only reported once they all returned, so requests
+    keep answering from the old data, without waiting, while the listeners build the new data
+    """
+
+    def __init__(self, db: DB, poll_interval: float = 1.0):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.version = db.get_data_version()
+        self._polled_at = time.monotonic()
+        self._listeners = []
+        self._reload = None
+        self._lock = threading.Lock()
+
+    def on_change(self, listener):
+        """
+        :param listener: function called without arguments after the data version changes
+        """
+        self._listeners.append(listener)
+
+    def current(self) -> int:
+        """
+        :return: the current data version, polling the database if the last poll is older than poll_interval
+        """
+        if time.monotonic() - self._polled_at > self.poll_interval:
+            self.refresh()
+        return self.version
+
+    def refresh(self, wait: bool = False) -> int:
+        """
+        reads the data version from the database, notifying the listeners in the background if it changed
+        versions are not polled while the listeners of a change are still running
+        :param wait: wait for the listeners to return
+        :return: the data version reported
+        """
+        with self._lock:
+            reload = self._reload
+            self._polled_at = time.monotonic()
+        if reload is None:
+            version = self.db.get_data_version()
+            with self._lock:
+                if version != self.version and self._reload is None:
+                    self._reload = threading.Thread(target=self._notify, args=(version,), name='data-version',
+                                                    daemon=True)
+                    self._reload.start()
+                reload = self._reload
+        if wait and reload is not None:
+            reload.join()
+        return self.version
+
+    def wait(self, timeout: float = None):
+        """
+        waits for the listeners of a version change being notified, if any
+        """
+        reload = self._reload
+        if reload is not None:
+            reload.join(timeout)
+
+    def _notify(self, version: int):
+        try:
+            for listener in self._listeners:
+                listener()
+        except Exception:
+            # the version is left as it is, so the next poll tries again
+            logger.exception("reloading data version %s failed", version)
+        else:
+            self.version = version
+        finally:
+            with self._lock:
+                self._reload = None
@@ -0,0 +1,65 @@
+from collections import deque
+
+from database import DB
+
+
+class Catalog:
+    """
+    in-memory index of the ports and regions hierarchy
+    loads the ports and regions tables once and precomputes the ports within every region
+    """
+
+    def __init__(self, db: DB):
+        self.db = db
+        self._index = (frozenset(), {})
+        self.reload()
+
+    def reload(self):
+        """
+        reloads the ports and regions from the database and rebuilds the index
+        the new index is swapped in at once, so requests being served keep a consistent view
+        """
+        ports = self.db.get_ports()
+        regions = self.db.get_regions()
+
+        child_ports = {slug: [] for slug, _ in regions}
+        child_regions = {slug: [] for slug, _ in regions}
+        for code, parent_slug in ports:
+            child_ports.setdefault(parent_slug, []).append(code)
+        for slug, parent_slug in regions:
+            if parent_slug is not None:
+                child_regions.setdefault(parent_slug, []).append(slug)
+
+        region_ports = {}
+        for slug, _ in regions:
+            region_ports[slug] = self._collect_ports(slug, child_ports, child_regions)
+
+        self._index = (frozenset(code for code, _ in ports), region_ports)
+
+    @staticmethod
+    def _collect_ports(region: str, child_ports: dict, child_regions: dict) -> tuple:
+        """
+        walks the region tree breadth first, collecting every port within it
+        :return: tuple of port codes
+        """
+        ports = []
+        regions_left = deque([region])
+        while regions_left:
+            next_region = regions_left.popleft()
+            ports += child_ports.get(next_region, [])
+            regions_left += child_regions.get(next_region, [])
+        return tuple(ports)
+
+    def has_port(self, code: str) -> bool:
+        return code in self._index[0]
+
+    def has_region(self, slug: str) -> bool:
+        return slug in self._index[1]
+
+    def get_sub_ports(self, region: str) -> tuple:
+        """
+        gets all the ports within a region
+        :param region: region slug
+        :return: tuple of port codes, empty if the region does not exist
+        """
+        return self._index[1].get(region, ())
@@ -0,0 +1,115 @@
+from datetime import date, datetime
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the columnar engine
+    np = None
+
+from database import DB
+
+
+class ColumnarPrices:
+    """
+    in-process copy of the prices table held as numpy arrays, answering the same price queries as DB
+
+    every price row is stored as integer encoded origin and destination port ids, the day's ordinal and its price,
+    sorted by day so a date range is a contiguous slice of the arrays
+    """
+
+    def __init__(self, db: DB, chunk_size: int = 100000):
+        if np is None:
+            raise RuntimeError("the columnar engine requires numpy, install it with `pip install numpy`")
+        self.db = db
+        self.chunk_size = chunk_size
+        self._columns = self._empty_columns({})
+        self.reload()
+
+    @staticmethod
+    def _empty_columns(port_ids: dict) -> tuple:
+        return (port_ids,
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64))
+
+    def reload(self):
+        """
+        reloads the prices table into memory
+        the new arrays are swapped in at once, so queries being answered keep a consistent view
+        """
+        port_ids = {}
+        origins, destinations, days, prices = [], [], [], []
+        for rows in self.db.iter_prices(self.chunk_size):
+            origins.append(np.fromiter((port_ids.setdefault(row[0], len(port_ids)) for row in rows),
+                                       dtype=np.int32, count=len(rows)))
+            destinations.append(np.fromiter((port_ids.setdefault(row[1], len(port_ids)) for row in rows),
+                                            dtype=np.int32, count=len(rows)))
+            days.append(np.fromiter((row[2].toordinal() for row in rows), dtype=np.int32, count=len(rows)))
+            prices.append(np.fromiter((row[3] for row in rows), dtype=np.int64, count=len(rows)))
+
+        if not days:
+            self._columns = self._empty_columns(port_ids)
+            return
+
+        day = np.concatenate(days)
+        order = np.argsort(day, kind='stable')
+        self._columns = (port_ids,
+                         np.concatenate(origins)[order], np.concatenate(destinations)[order],
+                         day[order], np.concatenate(prices)[order])
+
+    def _port_mask(self, port_ids: dict, ports) -> 'np.ndarray':
+        """
+        :return: boolean lookup table indexed by port id, True for the given ports
+        """
+        mask = np.zeros(len(port_ids), dtype=bool)
+        ids = [port_ids[port] for port in ports if port in port_ids]
+        mask[ids] = True
+        return mask
+
+    def _select(self, origin_ports, destination_ports, date_from: str, date_to: str) -> tuple:
+        """
+        selects the prices between any of the origin and destination ports within [date_from, date_to]
+        :return: port ids, first day ordinal, number of days, and the origin ids, destination ids,
+                 day offsets from the first day and prices of the selected rows
+        """
+        port_ids, origin, destination, day, price = self._columns
+        start = datetime.strptime(date_from, '%Y-%m-%d').toordinal()
+        end = datetime.strptime(date_to, '%Y-%m-%d').toordinal()
+        end = max(end, start - 1)
+
+        lo, hi = np.searchsorted(day, start, side='left'), np.searchsorted(day, end, side='right')
+        selected = self._port_mask(port_ids, origin_ports)[origin[lo:hi]] & \
+            self._port_mask(port_ids, destination_ports)[destination[lo:hi]]
+        return (port_ids, start, end - start + 1, origin[lo:hi][selected], destination[lo:hi][selected],
+                day[lo:hi][selected] - start, price[lo:hi][selected])
+
+    def get_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        sums the prices between any of the origin and destination ports for each day in [date_from, date_to]
+        days without any prices are not returned
+        :return: list of (day, price sum, price count) ordered by day
+        """
+        _, start, days, _, _, day_offsets, prices = self._select(origin_ports, destination_ports, date_from, date_to)
+        counts = np.bincount(day_offsets, minlength=days)
+        sums = np.bincount(day_offsets, weights=prices, minlength=days)
+        return [(date.fromordinal(start + int(offset)), int(sums[offset]), int(counts[offset]))
+                for offset in np.flatnonzero(counts)]
+
+    def get_port_pair_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        sums the prices of each origin and destination port pair for each day in [date_from, date_to]
+        :return: list of (origin port, destination port, day, price sum, price count) ordered by day
+        """
+        port_ids, start, days, origins, destinations, day_offsets, prices = \
+            self._select(origin_ports, destination_ports, date_from, date_to)
+
+        # group on one integer key per (origin, destination, day)
+        keys = (origins.astype(np.int64) * len(port_ids) + destinations) * days + day_offsets
+        groups, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(groups))
+        sums = np.bincount(inverse, weights=prices, minlength=len(groups))
+        group_days = groups % days
+        pairs = groups // days
+
+        codes = list(port_ids)
+        return [(codes[int(pairs[i] // len(port_ids))], codes[int(pairs[i] % len(port_ids))],
+                 date.fromordinal(start + int(group_days[i])), int(sums[i]), int(counts[i]))
+                for i in np.argsort(group_days, kind='stable')]
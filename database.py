@@ -1,50 +1,320 @@
+import io
+import math
+import threading
+from contextlib import contextmanager
+from itertools import islice
+
 import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from metrics import instrumented
+
+class PoolTimeout(PoolError):
+    pass
 
 
 class DB:
-    def __init__(self, host: str, database: str, user: str, password: str):
-        self.conn = psycopg2.connect(host=host,
-                                     database=database,
-                                     user=user,
-                                     password=password)
-
-    def get_child_port_codes(self, parent_region: str) -> [str]:
-        cur = self.conn.cursor()
-        sql = """SELECT p.code FROM ports p WHERE p.parent_slug = %s;"""
-        cur.execute(sql, (parent_region,))
-        ports = cur.fetchall()
-        cur.close()
-        return [port[0] for port in ports]
-
-    def get_child_region_slugs(self, parent_region: str) -> [str]:
-        cur = self.conn.cursor()
-        sql = """SELECT r.slug FROM regions r WHERE r.parent_slug = %s;"""
-        cur.execute(sql, (parent_region,))
-        regions = cur.fetchall()
-        cur.close()
-        return [region[0] for region in regions]
-
-
-    def get_daily_prices(self, day: str) -> [int]:
-        cur = self.conn.cursor()
-        sql = """
-            select x.orig_code, x.dest_code, sum(x.price), count(x.price)  FROM prices x
-            where x."day" = %s
-            group by x.orig_code, x.dest_code
-            """
-        cur.execute(sql, (day,))
-        prices = cur.fetchall()
-        cur.close()
+    def __init__(self, host: str, database: str, user: str, password: str,
+                 min_connections: int = 1, max_connections: int = 10, timeout: float = 30.0, port: int = 5432,
+                 connect_timeout: float | None = None, statement_timeout: float | None = None):
+        """
+        :param min_connections: connections opened up front and kept open
+        :param max_connections: most connections open at once, further checkouts wait for one to be returned
+        :param timeout: seconds to wait for a free connection before raising PoolTimeout
+        :param connect_timeout: seconds to wait for a new connection, None to wait as long as the OS does
+        :param statement_timeout: seconds after which postgres cancels a query, None for no limit
+        """
+        options = {}
+        if connect_timeout is not None:
+            # libpq takes whole seconds, and treats 0 as no limit
+            options["connect_timeout"] = max(1, math.ceil(connect_timeout))
+        if statement_timeout is not None:
+            options["options"] = f"-c statement_timeout={max(1, round(statement_timeout * 1000))}"
+        self.pool = ThreadedConnectionPool(min_connections, max_connections,
+                                           host=host,
+                                           port=port,
+                                           database=database,
+                                           user=user,
+                                           password=password,
+                                           **options)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._local = threading.local()
+
+    @contextmanager
+    def connection(self, dedicated: bool = False):
+        """
+        checks a connection out of the pool for the duration of the block and returns it afterwards
+        nested blocks on the same thread reuse the connection already checked out
+        :param dedicated: check out a connection of its own that nested blocks do not reuse, for generators,
+            which may be resumed on another thread (e.g. an executor's) and whose blocks stay open between items
+        """
+        local = None if dedicated else self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f"no database connection free after {self.timeout}s")
+        broken = False
+        try:
+            conn = self._checkout()
+            if local is not None:
+                local.conn = conn
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if local is not None:
+                local.conn = None
+            if conn is not None:
+                self._checkin(conn, broken)
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                yield cur
+            finally:
+                cur.close()
+
+    @contextmanager
+    def transaction(self, dedicated: bool = False):
+        """
+        runs the block in a transaction on a pooled connection, committing at the end or rolling back on error
+        nested blocks on the same thread join the transaction already open
+        :param dedicated: see connection
+        """
+        with self.connection(dedicated) as conn:
+            if not conn.autocommit:
+                yield conn
+                return
+            conn.autocommit = False
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                # also rolls back a generator closed part way, e.g. when a streaming client disconnects,
+                # autocommit can not be turned back on while the transaction is open
+                conn.rollback()
+                raise
+            finally:
+                conn.autocommit = True
+
+    def _checkout(self):
+        """
+        gets a healthy connection from the pool, pinging it first so connections dropped by a database restart
+        are replaced before a query fails on them
+        after a restart every pooled connection may be dropped, so up to max_connections are discarded
+        before a new one is opened
+        """
+        for _ in range(self.max_connections):
+            conn = self.pool.getconn()
+            if not conn.closed:
+                # reads run outside of a transaction so connections go back to the pool without a rollback
+                conn.autocommit = True
+                if self._ping(conn):
+                    return conn
+            self.pool.putconn(conn, close=True)
+        conn = self.pool.getconn()
+        conn.autocommit = True
+        return conn
+
+    def _checkin(self, conn, broken: bool = False):
+        self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    @instrumented
+    def get_ports(self) -> [tuple]:
+        with self.cursor() as cur:
+            sql = """SELECT p.code, p.parent_slug FROM ports p;"""
+            cur.execute(sql)
+            ports = cur.fetchall()
+        return ports
+
+    @instrumented
+    def get_regions(self) -> [tuple]:
+        with self.cursor() as cur:
+            sql = """SELECT r.slug, r.parent_slug FROM regions r;"""
+            cur.execute(sql)
+            regions = cur.fetchall()
+        return regions
+
+    @instrumented
+    def get_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        sums the prices between any of the origin and destination ports for each day in [date_from, date_to]
+        days without any prices are not returned
+        days are compared as date constants, so postgres only scans the monthly partitions holding them
+        (see migrations/003_partition_prices.sql), the same goes for the other price queries
+        :return: list of (day, price sum, price count) ordered by day
+        """
+        with self.cursor() as cur:
+            sql = """
+                select x."day", sum(x.price), count(x.price) FROM prices x
+                where x.orig_code = ANY(%s) and x.dest_code = ANY(%s)
+                  and x."day" between %s::date and %s::date
+                group by x."day"
+                order by x."day"
+                """
+            cur.execute(sql, (list(origin_ports), list(destination_ports), date_from, date_to))
+            prices = cur.fetchall()
+        return prices
+
+    @instrumented
+    def get_bucket_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str,
+                        granularity: str) -> [tuple]:
+        """
+        sums the prices between any of the origin and destination ports for each week or month in [date_from, date_to]
+        weeks start on monday, the first bucket starts on date_from, buckets without any prices are not returned
+        :param granularity: week or month
+        :return: list of (bucket first day, price sum, price count) ordered by day
+        """
+        with self.cursor() as cur:
+            sql = """
+                select greatest(date_trunc(%s, x."day")::date, %s::date) as bucket, sum(x.price), count(x.price)
+                FROM prices x
+                where x.orig_code = ANY(%s) and x.dest_code = ANY(%s)
+                  and x."day" between %s::date and %s::date
+                group by bucket
+                order by bucket
+                """
+            cur.execute(sql, (granularity, date_from, list(origin_ports), list(destination_ports), date_from, date_to))
+            prices = cur.fetchall()
         return prices
 
-    def get_port(self, orig_code: str) -> tuple:
-        cur = self.conn.cursor()
-        sql = """SELECT p.code FROM ports p
-                    where p.code = %s"""
-        cur.execute(sql, (orig_code,))
-        port = cur.fetchone()
-        cur.close()
-        return port
+    @instrumented
+    def iter_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str,
+                        chunk_size: int = 1000):
+        """
+        same as get_price_sums, but streams the rows from a server-side cursor chunk_size rows at a time
+        :return: generator of (day, price sum, price count) ordered by day
+        """
+        with self.transaction(dedicated=True) as conn:
+            cur = conn.cursor(name='iter_price_sums')
+            try:
+                cur.itersize = chunk_size
+                sql = """
+                    select x."day", sum(x.price), count(x.price) FROM prices x
+                    where x.orig_code = ANY(%s) and x.dest_code = ANY(%s)
+                      and x."day" between %s::date and %s::date
+                    group by x."day"
+                    order by x."day"
+                    """
+                cur.execute(sql, (list(origin_ports), list(destination_ports), date_from, date_to))
+                yield from cur
+            finally:
+                cur.close()
+
+    @instrumented
+    def get_port_pair_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        sums the prices of each origin and destination port pair for each day in [date_from, date_to]
+        :return: list of (origin port, destination port, day, price sum, price count) ordered by day
+        """
+        with self.cursor() as cur:
+            sql = """
+                select x.orig_code, x.dest_code, x."day", sum(x.price), count(x.price) FROM prices x
+                where x.orig_code = ANY(%s) and x.dest_code = ANY(%s)
+                  and x."day" between %s::date and %s::date
+                group by x.orig_code, x.dest_code, x."day"
+                order by x."day"
+                """
+            cur.execute(sql, (list(origin_ports), list(destination_ports), date_from, date_to))
+            prices = cur.fetchall()
+        return prices
+
+    @instrumented
+    def get_rollup_sums(self, origin: str, destination: str, date_from: str, date_to: str) -> [tuple]:
+        """
+        reads the daily price sums between an origin and destination node (port or region) from the rollups
+        days without any prices are not returned
+        :return: list of (day, price sum, price count) ordered by day
+        """
+        with self.cursor() as cur:
+            sql = """
+                select r."day", r.price_sum, r.price_count FROM price_rollups r
+                where r.orig_node = %s and r.dest_node = %s
+                  and r."day" between %s and %s and r.price_count > 0
+                order by r."day"
+                """
+            cur.execute(sql, (origin, destination, date_from, date_to))
+            prices = cur.fetchall()
+        return prices
+
+    @instrumented
+    def get_data_version(self) -> int:
+        """
+        :return: the data version, bumped whenever prices, ports or regions change (see migrations/002_data_version.sql)
+        """
+        with self.cursor() as cur:
+            sql = """SELECT v.version FROM data_version v WHERE v.id = 1;"""
+            cur.execute(sql)
+            version = cur.fetchone()
+        return version[0]
+
+    @instrumented
+    def iter_prices(self, chunk_size: int = 10000):
+        """
+        iterates every row of the prices table through a server-side cursor, chunk_size rows at a time
+        :return: generator of lists of (orig_code, dest_code, day, price)
+        """
+        with self.transaction(dedicated=True) as conn:
+            cur = conn.cursor(name='iter_prices')
+            try:
+                cur.itersize = chunk_size
+                cur.execute("""SELECT x.orig_code, x.dest_code, x."day", x.price FROM prices x;""")
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cur.close()
+
+    def copy_prices(self, rows, chunk_size: int = 10000) -> int:
+        """
+        bulk loads price rows with COPY FROM STDIN, chunk_size rows per COPY, all in one transaction
+        :param rows: iterable of (orig_code, dest_code, day, price)
+        :return: number of rows loaded
+        """
+        rows = iter(rows)
+        count = 0
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            try:
+                # with prices partitioned by month (see migrations/003_partition_prices.sql) the partitions of
+                # the months being loaded are created first, so their rows do not pile up in prices_default
+                cur.execute("""SELECT to_regproc('create_price_partitions') IS NOT NULL;""")
+                partitioned = cur.fetchone()[0]
+                months = set()
+                while chunk := list(islice(rows, chunk_size)):
+                    new_months = {str(day)[:7] for _, _, day, _ in chunk} - months if partitioned else set()
+                    if new_months:
+                        cur.execute("""SELECT create_price_partitions(%s::date, %s::date);""",
+                                    (min(new_months) + '-01', max(new_months) + '-01'))
+                        months |= new_months
+                    buffer = io.StringIO(''.join(f"{orig_code}\t{dest_code}\t{day}\t{price}\n"
+                                                 for orig_code, dest_code, day, price in chunk))
+                    cur.copy_expert("""COPY prices (orig_code, dest_code, "day", price) FROM STDIN""", buffer)
+                    count += len(chunk)
+            finally:
+                cur.close()
+        return count
 
     def close(self):
-        self.conn.close()
+        self.pool.closeall()
@@ -0,0 +1,117 @@
+"""
+bulk loads prices into the database configured in .env
+
+    python -m ingest prices.csv
+    python -m ingest --format ndjson - < prices.ndjson
+
+csv files have orig_code,dest_code,day,price columns (a header row is skipped),
+ndjson files have one {"orig_code", "dest_code", "day", "price"} object per line
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from datetime import date
+
+from dotenv import load_dotenv
+
+from cache import DataVersion
+from catalog import Catalog
+from database import DB
+
+FIELDS = ['orig_code', 'dest_code', 'day', 'price']
+
+
+class IngestError(ValueError):
+    pass
+
+
+def read_csv(lines):
+    """
+    :param lines: iterable of csv lines
+    :return: generator of (line number, [orig_code, dest_code, day, price])
+    """
+    for line_number, row in enumerate(csv.reader(lines), start=1):
+        if not row or (line_number == 1 and row == FIELDS):
+            continue
+        yield line_number, row
+
+
+def read_ndjson(lines):
+    """
+    :param lines: iterable of json lines
+    :return: generator of (line number, [orig_code, dest_code, day, price])
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            price = json.loads(line)
+            yield line_number, [price.get(field) for field in FIELDS]
+        except (ValueError, AttributeError):
+            raise IngestError(f"line {line_number}: not a json object")
+
+
+def validate(rows, catalog: Catalog):
+    """
+    checks each row's ports against the catalog (in memory, no query per row), day and price
+    :param rows: iterable of (line number, [orig_code, dest_code, day, price])
+    :return: generator of (orig_code, dest_code, day, price)
+    """
+    for line_number, row in rows:
+        if len(row) != len(FIELDS):
+            raise IngestError(f"line {line_number}: expected {len(FIELDS)} fields, got {len(row)}")
+        orig_code, dest_code, day, price = row
+        if not catalog.has_port(orig_code):
+            raise IngestError(f"line {line_number}: unknown origin port {orig_code}")
+        if not catalog.has_port(dest_code):
+            raise IngestError(f"line {line_number}: unknown destination port {dest_code}")
+        try:
+            day = date.fromisoformat(str(day))
+            price = int(price)
+        except (TypeError, ValueError):
+            raise IngestError(f"line {line_number}: day must be formatted YYYY-MM-DD and price an integer")
+        yield orig_code, dest_code, day, price
+
+
+def load_prices(db: DB, catalog: Catalog, rows, chunk_size: int = 10000, data_version: DataVersion = None) -> dict:
+    """
+    validates and loads price rows in one transaction, nothing is loaded if any row is invalid
+    caches and in-memory data of servers pick the change up through the data version, which the load bumps;
+    pass this process's data_version to notify its listeners right away
+    :param rows: iterable of (line number, [orig_code, dest_code, day, price]), see read_csv and read_ndjson
+    :return: dictionary of {rows, seconds, rows_per_second}
+    """
+    started = time.perf_counter()
+    count = db.copy_prices(validate(rows, catalog), chunk_size)
+    seconds = time.perf_counter() - started
+    if data_version is not None:
+        data_version.refresh(wait=True)
+    return {"rows": count, "seconds": seconds, "rows_per_second": count / seconds if seconds else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help="price file, - for stdin")
+    parser.add_argument('--format', choices=['csv', 'ndjson'], help="defaults to the file extension, csv for stdin")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="rows sent per COPY")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = DB(os.environ['DB_HOST'], os.environ['DB_DATABASE'], os.environ['DB_USER'], os.environ['DB_PASSWORD'])
+    file_format = args.format or ('ndjson' if args.file.endswith(('.ndjson', '.jsonl')) else 'csv')
+    reader = read_ndjson if file_format == 'ndjson' else read_csv
+    try:
+        with (sys.stdin if args.file == '-' else open(args.file, newline='')) as lines:
+            stats = load_prices(db, Catalog(db), reader(lines), args.chunk_size)
+    except IngestError as e:
+        sys.exit(f"nothing loaded, {e}")
+    finally:
+        db.close()
+    print(f"loaded {stats['rows']} rows in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
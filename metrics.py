@@ -0,0 +1,171 @@
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# queries and phase timings of the request being served
+_trace = ContextVar('request_trace', default=None)
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self._lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', str(bound)),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {count}")
+        return lines
+
+
+def format_labels(labels: tuple) -> str:
+    """
+    :param labels: tuple of (name, value)
+    :return: prometheus label set, {name="value",...}
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+request_seconds = Histogram('rates_request_seconds', "Time spent serving requests")
+phase_seconds = Histogram('rates_request_phase_seconds', "Time spent in each phase of serving a request")
+query_seconds = Histogram('rates_db_query_seconds', "Time spent in each DB method")
+query_rows = Counter('rates_db_rows_total', "Rows fetched by each DB method")
+shard_failures = Counter('rates_shard_failures_total', "Price shard queries that timed out or failed")
+registry = [request_seconds, phase_seconds, query_seconds, query_rows, shard_failures]
+
+
+def render(extra_lines: list = ()) -> str:
+    """
+    :return: every metric in the prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines + list(extra_lines)) + "\n"
+
+
+def start_trace() -> dict:
+    """
+    starts recording the queries and phases of the current request
+    """
+    trace = {"started": time.perf_counter(), "queries": [], "phases": {}}
+    _trace.set(trace)
+    return trace
+
+
+def end_trace() -> dict | None:
+    """
+    stops recording the current request
+    :return: the request's trace, None if none was started
+    """
+    trace = _trace.get()
+    _trace.set(None)
+    return trace
+
+
+def current_trace() -> dict | None:
+    return _trace.get()
+
+
+@contextmanager
+def phase(name: str):
+    """
+    times a phase of the current request
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        phase_seconds.observe(elapsed, (('phase', name),))
+        trace = _trace.get()
+        if trace is not None:
+            trace["phases"][name] = trace["phases"].get(name, 0.0) + elapsed
+
+
+def _record_query(method: str, elapsed: float, rows: int):
+    query_seconds.observe(elapsed, (('method', method),))
+    query_rows.inc((('method', method),), rows)
+    trace = _trace.get()
+    if trace is not None:
+        trace["queries"].append({"method": method, "seconds": elapsed, "rows": rows})
+
+
+def _count_rows(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    return 0 if result is None else 1
+
+
+def instrumented(method):
+    """
+    records the wall time and rows fetched of every call of a DB method
+    rows of generator methods are counted as they are consumed, a chunk of rows counting as its length
+    """
+    name = method.__name__
+
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def generator_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            rows = 0
+            try:
+                for item in method(*args, **kwargs):
+                    rows += len(item) if isinstance(item, list) else 1
+                    yield item
+            finally:
+                _record_query(name, time.perf_counter() - started, rows)
+
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        result = method(*args, **kwargs)
+        _record_query(name, time.perf_counter() - started, _count_rows(result))
+        return result
+
+    return wrapper
@@ -0,0 +1,109 @@
+--
+-- Daily price rollups for every (origin node, destination node) pair,
+-- where a node is a port or any region above it.
+-- The rollups are kept up to date by triggers on prices, so /rates can read a
+-- region to region day as a single row instead of summing every port pair.
+--
+
+CREATE TABLE price_rollups (
+    orig_node text NOT NULL,
+    dest_node text NOT NULL,
+    day date NOT NULL,
+    price_sum bigint NOT NULL,
+    price_count bigint NOT NULL,
+    PRIMARY KEY (orig_node, dest_node, day)
+);
+
+
+--
+-- every node a port rolls up into: the port itself and each of its ancestor regions
+--
+
+CREATE VIEW port_nodes AS
+WITH RECURSIVE regions_above (code, node) AS (
+    SELECT p.code, p.parent_slug FROM ports p
+    UNION ALL
+    SELECT a.code, r.parent_slug FROM regions_above a
+    JOIN regions r ON r.slug = a.node
+    WHERE r.parent_slug IS NOT NULL
+)
+SELECT p.code, p.code AS node FROM ports p
+UNION ALL
+SELECT a.code, a.node FROM regions_above a;
+
+
+--
+-- adds the prices inserted by a statement to the rollups, and removes the deleted ones
+--
+
+CREATE FUNCTION apply_price_rollups() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO price_rollups (orig_node, dest_node, day, price_sum, price_count)
+        SELECT o.node, d.node, x.day, -sum(x.price), -count(*)
+        FROM old_prices x
+        JOIN port_nodes o ON o.code = x.orig_code
+        JOIN port_nodes d ON d.code = x.dest_code
+        GROUP BY o.node, d.node, x.day
+        ON CONFLICT (orig_node, dest_node, day) DO UPDATE
+            SET price_sum = price_rollups.price_sum + EXCLUDED.price_sum,
+                price_count = price_rollups.price_count + EXCLUDED.price_count;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        INSERT INTO price_rollups (orig_node, dest_node, day, price_sum, price_count)
+        SELECT o.node, d.node, x.day, sum(x.price), count(*)
+        FROM new_prices x
+        JOIN port_nodes o ON o.code = x.orig_code
+        JOIN port_nodes d ON d.code = x.dest_code
+        GROUP BY o.node, d.node, x.day
+        ON CONFLICT (orig_node, dest_node, day) DO UPDATE
+            SET price_sum = price_rollups.price_sum + EXCLUDED.price_sum,
+                price_count = price_rollups.price_count + EXCLUDED.price_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER prices_rollup_insert AFTER INSERT ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+CREATE TRIGGER prices_rollup_update AFTER UPDATE ON prices
+    REFERENCING OLD TABLE AS old_prices NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+CREATE TRIGGER prices_rollup_delete AFTER DELETE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+
+
+--
+-- TRUNCATE fires no delete triggers, so the rollups are emptied along with prices
+--
+
+CREATE FUNCTION truncate_price_rollups() RETURNS trigger AS $$
+BEGIN
+    TRUNCATE price_rollups;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER prices_rollup_truncate AFTER TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE truncate_price_rollups();
+
+
+--
+-- rebuilds the rollups from scratch, needed after ports or regions are moved in the hierarchy
+--
+
+CREATE FUNCTION rebuild_price_rollups() RETURNS void AS $$
+BEGIN
+    TRUNCATE price_rollups;
+    INSERT INTO price_rollups (orig_node, dest_node, day, price_sum, price_count)
+    SELECT o.node, d.node, x.day, sum(x.price), count(*)
+    FROM prices x
+    JOIN port_nodes o ON o.code = x.orig_code
+    JOIN port_nodes d ON d.code = x.dest_code
+    GROUP BY o.node, d.node, x.day;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT rebuild_price_rollups();
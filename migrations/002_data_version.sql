@@ -0,0 +1,25 @@
+--
+-- Single row counter bumped by every statement that changes prices, ports or regions.
+-- Servers poll it to invalidate caches and reload in-memory data.
+--
+
+CREATE TABLE data_version (
+    id integer PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version bigint NOT NULL
+);
+INSERT INTO data_version (id, version) VALUES (1, 1);
+
+
+CREATE FUNCTION bump_data_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE data_version SET version = version + 1 WHERE id = 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER prices_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version();
+CREATE TRIGGER ports_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ports
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version();
+CREATE TRIGGER regions_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON regions
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version();
@@ -0,0 +1,79 @@
+--
+-- Moves prices into monthly range partitions on day.
+-- Each partition has a BRIN index on day, which stays a few pages however much history accumulates,
+-- and its own btree on (orig_code, dest_code, day), so a lane query only walks the btrees of the months it asks for.
+-- Queries filtering on day with constants (see database.py) are pruned to the partitions they need.
+--
+
+ALTER TABLE prices RENAME TO prices_unpartitioned;
+
+CREATE TABLE prices (
+    orig_code text NOT NULL,
+    dest_code text NOT NULL,
+    day date NOT NULL,
+    price integer NOT NULL
+) PARTITION BY RANGE (day);
+
+-- created on every partition, present and future
+CREATE INDEX prices_day_brin_idx ON prices USING brin (day);
+CREATE INDEX prices_partitioned_orig_code_dest_code_day_idx ON prices (orig_code, dest_code, day);
+
+-- holds the days no monthly partition has been created for yet
+CREATE TABLE prices_default PARTITION OF prices DEFAULT;
+
+
+--
+-- creates the monthly partitions covering [first_day, last_day], moving their rows out of the default partition
+--
+
+CREATE FUNCTION create_price_partitions(first_day date, last_day date) RETURNS integer AS $$
+DECLARE
+    month date := date_trunc('month', first_day)::date;
+    partition text;
+    created integer := 0;
+BEGIN
+    WHILE month <= last_day LOOP
+        partition := 'prices_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition) IS NULL THEN
+            -- rows are moved by the partition tables themselves, so the triggers on prices do not see them
+            EXECUTE format('CREATE TABLE %I (LIKE prices INCLUDING DEFAULTS)', partition);
+            EXECUTE format('INSERT INTO %I SELECT * FROM prices_default WHERE day >= %L AND day < %L',
+                           partition, month, (month + interval '1 month')::date);
+            EXECUTE format('DELETE FROM prices_default WHERE day >= %L AND day < %L',
+                           month, (month + interval '1 month')::date);
+            EXECUTE format('ALTER TABLE prices ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                           partition, month, (month + interval '1 month')::date);
+            created := created + 1;
+        END IF;
+        month := (month + interval '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_price_partitions(min(day), max(day)) FROM prices_unpartitioned;
+
+-- the rows are unchanged, so they are copied before the rollup and data version triggers are moved over
+INSERT INTO prices (orig_code, dest_code, day, price)
+SELECT orig_code, dest_code, day, price FROM prices_unpartitioned ORDER BY day;
+DROP TABLE prices_unpartitioned;
+
+-- added once the rows are in, so they are checked in one pass; attached partitions inherit them
+ALTER TABLE prices ADD CONSTRAINT prices_orig_code_fkey FOREIGN KEY (orig_code) REFERENCES ports(code);
+ALTER TABLE prices ADD CONSTRAINT prices_dest_code_fkey FOREIGN KEY (dest_code) REFERENCES ports(code);
+
+CREATE TRIGGER prices_rollup_insert AFTER INSERT ON prices
+    REFERENCING NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+CREATE TRIGGER prices_rollup_update AFTER UPDATE ON prices
+    REFERENCING OLD TABLE AS old_prices NEW TABLE AS new_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+CREATE TRIGGER prices_rollup_delete AFTER DELETE ON prices
+    REFERENCING OLD TABLE AS old_prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE apply_price_rollups();
+CREATE TRIGGER prices_rollup_truncate AFTER TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE truncate_price_rollups();
+CREATE TRIGGER prices_data_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE PROCEDURE bump_data_version();
+
+ANALYZE prices;
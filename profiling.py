@@ -0,0 +1,126 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import threading
+import time
+from collections import deque
+
+# deepest call stack written to collapsed stacks, deeper calls are folded into their ancestor
+MAX_STACK_DEPTH = 64
+
+
+class Profiles:
+    """
+    ring buffer of the last profiled requests, older profiles are dropped as new ones are added
+    """
+
+    def __init__(self, size: int = 20):
+        self._profiles = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # one profiler runs at a time, since python 3.12 a second one fails to start
+        self._profiling = threading.Lock()
+
+    def start(self) -> cProfile.Profile | None:
+        """
+        starts profiling the calls made on the current thread
+        :return: the profiler, None if another request or profiling tool is profiling
+        """
+        if not self._profiling.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiling tool is active
+            self._profiling.release()
+            return None
+        return profiler
+
+    def discard(self, profiler: cProfile.Profile):
+        """
+        stops the profiler without storing its profile
+        """
+        profiler.disable()
+        self._profiling.release()
+
+    def stop(self, profiler: cProfile.Profile, path: str, seconds: float, trace: dict | None) -> int:
+        """
+        stops the profiler and stores its profile with the request's phase and query timings
+        :param trace: the request's trace, see metrics.start_trace
+        :return: id of the stored profile
+        """
+        self.discard(profiler)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        with self._lock:
+            profile = {"id": next(self._ids), "path": path, "started": time.time() - seconds, "seconds": seconds,
+                       "phases": dict(trace["phases"]) if trace else {},
+                       "queries": list(trace["queries"]) if trace else [], "stats": stats}
+            self._profiles.append(profile)
+        return profile["id"]
+
+    def summaries(self) -> list:
+        """
+        :return: list of {id, path, started, seconds, phases, queries} of the stored profiles, newest first
+        """
+        with self._lock:
+            return [{key: value for key, value in profile.items() if key != "stats"}
+                    for profile in reversed(self._profiles)]
+
+    def render(self, profile_id: int, output_format: str = 'pstats', limit: int = 50) -> str | None:
+        """
+        :param output_format: pstats (functions sorted by cumulative time) or collapsed (one line per call stack)
+        :return: the profile as text, None if it is no longer stored
+        """
+        with self._lock:
+            profile = next((profile for profile in self._profiles if profile["id"] == profile_id), None)
+            if profile is None:
+                return None
+            stats = profile["stats"]
+            if output_format == 'collapsed':
+                return collapsed_stacks(stats.stats)
+            stats.stream = io.StringIO()
+            stats.sort_stats('cumulative').print_stats(limit)
+            return stats.stream.getvalue()
+
+
+def function_label(function: tuple) -> str:
+    filename, line, name = function
+    if filename == '~':
+        return name
+    return f"{os.path.basename(filename)}:{name}:{line}"
+
+
+def collapsed_stacks(stats: dict) -> str:
+    """
+    folds a profile's call graph into one line per call stack with its own time in microseconds, for flame graphs
+
+    cProfile only records the callers of each function, so a function's time is split between the stacks
+    it was called from in proportion to the time spent in each of those calls
+    :param stats: pstats.Stats.stats dictionary of {function: (calls, total calls, own time, cumulative time, callers)}
+    """
+    callees = {}
+    for function, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((function, caller_stats[3]))
+
+    stacks = {}
+
+    def walk(function: tuple, stack: tuple, share: float):
+        _, _, own_time, cumulative_time, _ = stats[function]
+        stack = stack + (function_label(function),)
+        stacks[stack] = stacks.get(stack, 0.0) + own_time * share
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, call_time in callees.get(function, []):
+            callee_time = stats[callee][3]
+            if callee_time and function_label(callee) not in stack:
+                walk(callee, stack, share * call_time / callee_time)
+
+    for function, (_, _, _, _, callers) in stats.items():
+        if not callers:
+            walk(function, (), 1.0)
+    return "".join(f"{';'.join(stack)} {round(seconds * 1e6)}\n"
+                   for stack, seconds in sorted(stacks.items()) if round(seconds * 1e6) > 0)
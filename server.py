@@ -1,51 +1,307 @@
+import bisect
+import contextvars
+import gzip
+import hashlib
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, nullcontext
 from datetime import datetime, timedelta
-from functools import reduce
 
 from dotenv import load_dotenv
-from flask import Flask, request
+from flask import Flask, Response, g, request
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.datastructures import MultiDict
 
-from database import DB
+from admission import CostBudget, OverBudget, QueryTooExpensive, query_cost
+from cache import CellCache, DataVersion, LRUCache, SingleFlight
+from catalog import Catalog
+from columnar import ColumnarPrices
+import metrics
+from database import DB, PoolTimeout
+from metrics import phase
+from profiling import Profiles
+from sketches import PriceSketches, QuantileSketch, parse_stats
+from shards import PartialSums, ShardedPrices, parse_shards
+from snapshot import SnapshotPrices
+from warmup import Warmup, parse_lanes, read_access_log
+
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+    json provider that times the serialization of responses
+    """
+
+    def response(self, *args, **kwargs):
+        with phase('serialize'):
+            return super().response(*args, **kwargs)
+
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 load_dotenv()
 db_user = os.environ['DB_USER']
 db_password = os.environ['DB_PASSWORD']
 db_host = os.environ['DB_HOST']
 db_database = os.environ['DB_DATABASE']
+db_pool_min = int(os.environ.get('DB_POOL_MIN', 1))
+db_pool_max = int(os.environ.get('DB_POOL_MAX', 10))
+db_pool_timeout = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# engine answering price queries: sql (query postgres), columnar (in-memory numpy arrays)
+# or snapshot (the RATES_SNAPSHOT file mapped read-only, see snapshot.py)
+rates_engine = os.environ.get('RATES_ENGINE', 'sql')
+rates_snapshot = os.environ.get('RATES_SNAPSHOT', 'prices.snapshot')
+# keep quantile sketches of the prices of every port pair and day in memory, to answer /rates?stats=
+rates_sketches = os.environ.get('RATES_SKETCHES', 'false').lower() == 'true'
+# read region and port pairs from the price_rollups table (see migrations/001_price_rollups.sql)
+rates_rollups = os.environ.get('RATES_ROLLUPS', 'false').lower() == 'true'
+# cached /rates responses, 0 disables the cache
+rates_cache_size = int(os.environ.get('RATES_CACHE_SIZE', 1024))
+rates_cache_ttl = float(os.environ.get('RATES_CACHE_TTL', 300))
+# cached (origin, destination, day) price sums, 0 disables the cache
+rates_cell_cache_size = int(os.environ.get('RATES_CELL_CACHE_SIZE', 100000))
+# cost of a price query is the number of (day, origin port, destination port) cells it covers,
+# queries over RATES_MAX_QUERY_COST get a 429, and once the queries running at once reach RATES_COST_BUDGET
+# further ones wait up to RATES_COST_QUEUE_SECONDS before getting a 503 (0 disables either limit)
+rates_max_query_cost = int(os.environ.get('RATES_MAX_QUERY_COST', 0))
+rates_cost_budget = int(os.environ.get('RATES_COST_BUDGET', 0))
+rates_cost_queue_seconds = float(os.environ.get('RATES_COST_QUEUE_SECONDS', 1))
+# identical /rates queries arriving while one is being answered wait for it and share its result
+rates_coalesce = os.environ.get('RATES_COALESCE', 'true').lower() == 'true'
+# how often the data version is polled (see migrations/002_data_version.sql)
+data_version_poll = float(os.environ.get('DATA_VERSION_POLL_SECONDS', 1))
+# requests slower than this are logged with their query breakdown, 0 disables the log
+slow_request_ms = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+# prices split by date over several databases, comma separated first_day..last_day@host[:port] shards
+# (either day can be left out), ports and regions are still read from DB_HOST
+price_shards = os.environ.get('PRICE_SHARDS', '')
+price_shard_timeout = float(os.environ.get('PRICE_SHARD_TIMEOUT', 5))
+# threads querying each shard, queries wait for one of them within PRICE_SHARD_TIMEOUT
+# (defaults to DB_POOL_MAX, so every thread gets a connection of the shard's pool)
+price_shard_workers = int(os.environ.get('PRICE_SHARD_WORKERS', db_pool_max))
+# json responses at least this large are gzipped for clients that accept it
+gzip_min_bytes = int(os.environ.get('GZIP_MIN_BYTES', 1024))
+# comma separated client addresses allowed to profile their requests with ?profile=1 or an X-Profile: 1 header
+# and to read the last PROFILE_BUFFER_SIZE profiles from /admin/profiles, empty disables profiling
+profile_allowlist = {address.strip() for address in os.environ.get('PROFILE_ALLOWLIST', '').split(',') if address.strip()}
+profile_buffer_size = int(os.environ.get('PROFILE_BUFFER_SIZE', 20))
+# comma separated client addresses allowed to call admin endpoints such as POST /catalog/reload
+admin_allowlist = {address.strip() for address in os.environ.get('ADMIN_ALLOWLIST', '127.0.0.1,::1').split(',')
+                   if address.strip()}
+# lanes answered in the background at startup before /readyz reports ready: comma separated
+# origin:destination:date_from:date_to lanes, plus the WARMUP_TOP most requested lanes of a json lines access log
+warmup_lanes = os.environ.get('WARMUP_LANES', '')
+warmup_log = os.environ.get('WARMUP_LOG', '')
+warmup_top = int(os.environ.get('WARMUP_TOP', 50))
+# date ranges longer than PRICE_CHUNK_DAYS are split into chunks whose postgres price queries run concurrently,
+# on at most half of DB_POOL_MAX threads so connections are left for the other queries (0 queries the whole range
+# at once); price shards and in-memory engines are not split
+price_chunk_days = int(os.environ.get('PRICE_CHUNK_DAYS', 0))
+# threads the asyncio serving mode (asgi.py) runs requests on, slow clients are served without holding one
+asgi_workers = int(os.environ.get('ASGI_WORKERS', 32))
+
+# periods /rates can average prices over, weeks start on monday
+GRANULARITIES = ('day', 'week', 'month')
+# shapes of the /rates response: a list of {day, average_price} or parallel days and prices arrays
+RESPONSE_FORMATS = ('list', 'columnar')
 
 db = None
+catalog = None
+engine = None
+data_version = None
+response_cache = None
+cell_cache = None
+sketches = None
+single_flight = None
+cost_budget = None
+profiles = None
+sharded_prices = None
+warmup = None
+db_executor = None
+
+
+def current_data_version() -> int:
+    """
+    gets the version of the prices, ports and regions data, which changes whenever any of them change
+    """
+    return data_version.current() if data_version is not None else 0
+
+
+def get_engine():
+    """
+    gets the engine answering price queries, the database unless another engine is configured
+    """
+    return engine if engine is not None else db
+
+
+def admit(cost: int, ceiling: bool = True):
+    """
+    waits for a price query's cost to fit in the cost budget, when one is configured
+    :param ceiling: False when the cost adds up queries already checked with check_cost
+    """
+    return cost_budget.admit(cost, ceiling) if cost_budget is not None else nullcontext()
+
+
+def check_cost(cost: int):
+    """
+    :raises QueryTooExpensive: when a price query's cost is over the per query ceiling, when one is configured
+    """
+    if cost_budget is not None:
+        cost_budget.check(cost)
+
+
+def split_date_range(date_from: str, date_to: str, days: int) -> list:
+    """
+    :return: list of (first day, last day) strings of consecutive chunks of at most days days covering the range
+    """
+    start = datetime.strptime(date_from, '%Y-%m-%d')
+    end = datetime.strptime(date_to, '%Y-%m-%d')
+    chunks = []
+    while start <= end:
+        last = min(start + timedelta(days=days - 1), end)
+        chunks.append((start.strftime('%Y-%m-%d'), last.strftime('%Y-%m-%d')))
+        start = last + timedelta(days=1)
+    return chunks
+
+
+def fan_out_dates(source, query, date_from: str, date_to: str) -> list:
+    """
+    runs a price query over chunks of PRICE_CHUNK_DAYS days concurrently on the database executor
+    only queries to the database are split: price shards already query their shards concurrently and hold
+    a few connections each, and threads would only contend for the interpreter on in-memory engines
+    :param source: engine or DB the query reads from
+    :param query: function of (first day, last day) returning rows ordered by day
+    :return: the rows of every chunk in order
+    :raises PartialSums: when some chunks were only partly answered by the shards
+    """
+    if db_executor is None or source is not db:
+        return query(date_from, date_to)
+    chunks = split_date_range(date_from, date_to, price_chunk_days)
+    if len(chunks) == 1:
+        return query(date_from, date_to)
+    # each query runs in a copy of the request's context, so its trace records the chunk queries too
+    futures = [db_executor.submit(contextvars.copy_context().run, query, chunk_from, chunk_to)
+               for chunk_from, chunk_to in chunks]
+    rows, missing = [], []
+    for future in futures:
+        try:
+            rows += future.result()
+        except PartialSums as e:
+            rows += e.rows
+            missing += e.missing
+    if missing:
+        raise PartialSums(rows, missing)
+    return rows
+
+
+def fetch_daily_sums(origin: str, destination: str, origin_ports, destination_ports, date_from: str, date_to: str) -> list:
+    """
+    sums the prices between the origin and destination for each day in [date_from, date_to]
+    reads the origin and destination nodes straight from the rollups when they are enabled
+    :return: list of (day, price sum, price count) ordered by day, days without prices are left out
+    """
+    if rates_rollups:
+        return fan_out_dates(db, lambda span_from, span_to: db.get_rollup_sums(origin, destination, span_from, span_to),
+                             date_from, date_to)
+    source = get_engine()
+    return fan_out_dates(source, lambda span_from, span_to: source.get_price_sums(origin_ports, destination_ports,
+                                                                                 span_from, span_to),
+                         date_from, date_to)
+
+
+def get_daily_sums(origin: str, destination: str, origin_ports, destination_ports, date_from: str, date_to: str,
+                   version: int) -> list:
+    """
+    sums the prices between the origin and destination for each day in [date_from, date_to]
+    days already in the cell cache are not fetched again
+    :return: list of (day, price sum, price count) ordered by day, days without prices are left out
+    """
+    if cell_cache is None:
+        return fetch_daily_sums(origin, destination, origin_ports, destination_ports, date_from, date_to)
+    return cell_cache.get_daily_sums(
+        origin, destination, date_from, date_to, version,
+        lambda span_from, span_to: fetch_daily_sums(origin, destination, origin_ports, destination_ports,
+                                                    span_from, span_to))
+
+
+def bucket_sums(daily_sums, buckets: list) -> list:
+    """
+    adds up daily price sums into the week or month buckets holding their days
+    :param daily_sums: iterable of (day, price sum, price count)
+    :param buckets: first day of each bucket in order, see create_date_range
+    :return: list of (bucket first day, price sum, price count) ordered by day, buckets without prices are left out
+    """
+    starts = [bucket.date() for bucket in buckets]
+    sums = {}
+    for day, price_sum, count_sum in daily_sums:
+        start = starts[bisect.bisect_right(starts, day) - 1]
+        bucket_sum, bucket_count = sums.get(start, (0, 0))
+        sums[start] = (bucket_sum + price_sum, bucket_count + count_sum)
+    return [(start, price_sum, count_sum) for start, (price_sum, count_sum) in sorted(sums.items())]
+
+
+def bucket_sketches(daily_sketches: list, buckets: list) -> list:
+    """
+    merges daily price sketches into the week or month buckets holding their days
+    :return: list of (bucket first day, sketch) ordered by day
+    """
+    starts = [bucket.date() for bucket in buckets]
+    merged = {}
+    for day, sketch in daily_sketches:
+        start = starts[bisect.bisect_right(starts, day) - 1]
+        merged.setdefault(start, QuantileSketch()).merge(sketch)
+    return sorted(merged.items())
 
 
-def get_sub_ports(region: str) -> list:
+def get_bucket_sums(origin: str, destination: str, origin_ports, destination_ports, date_from: str, date_to: str,
+                    buckets: list, granularity: str, version: int) -> list:
     """
-    gets all the ports within a region
-    :param region: region slug
-    :return: list of port codes
+    sums the prices between the origin and destination for each day, week or month bucket in [date_from, date_to]
+    without day cells to reuse the database adds up the buckets, otherwise the daily sums are added up here
+    :param buckets: first day of each bucket, see create_date_range
+    :return: list of (bucket first day, price sum, price count) ordered by day, buckets without prices are left out
     """
-    ports = []
-    regions_left = [region]
-    while len(regions_left) > 0:
-        next_region = regions_left.pop(0)
+    if granularity == 'day':
+        return get_daily_sums(origin, destination, origin_ports, destination_ports, date_from, date_to, version)
+    if cell_cache is None and not rates_rollups and engine is None:
+        return db.get_bucket_sums(origin_ports, destination_ports, date_from, date_to, granularity)
+    try:
+        daily_sums = get_daily_sums(origin, destination, origin_ports, destination_ports, date_from, date_to, version)
+    except PartialSums as e:
+        raise PartialSums(bucket_sums(e.rows, buckets), e.missing)
+    return bucket_sums(daily_sums, buckets)
+
 
-        # get the region's ports
-        region_ports = db.get_child_port_codes(next_region)
-        ports += region_ports
+def iter_days(date_start: datetime, date_end: datetime):
+    """
+    iterates each day between [date_start and date_end] (inclusive) without building a list of them
+    """
+    for days in range((date_end - date_start).days + 1):
+        yield date_start + timedelta(days=days)
 
-        # get the region's child regions
-        child_regions = db.get_child_region_slugs(next_region)
-        regions_left += child_regions
 
-    return ports
+def iter_buckets(date_start: datetime, date_end: datetime, granularity: str):
+    """
+    iterates the first day of each week or month between [date_start and date_end] (inclusive),
+    the first bucket starting on date_start
+    """
+    bucket = date_start
+    while bucket <= date_end:
+        yield bucket
+        if granularity == 'week':
+            bucket = bucket - timedelta(days=bucket.weekday()) + timedelta(days=7)
+        else:
+            bucket = (bucket.replace(day=1) + timedelta(days=32)).replace(day=1)
 
 
-def create_date_range(date_from: str, date_to: str) -> dict:
+def parse_date_range(date_from: str, date_to: str) -> dict:
     """
-    creates a list of dates of each day between [date_from and date_to] (inclusive)
+    parses the first and last day of a date range
     :param date_from: start date
     :param date_to: end date
-    :return: dictionary of {error: bool, value}
+    :return: dictionary of {error: bool, value}, value is (start, end) if there is no error
     """
     fields = ['date_from', 'date_to']
     output = []
@@ -58,9 +314,26 @@ def create_date_range(date_from: str, date_to: str) -> dict:
         except Exception as e:
             return {"error": True, "value": f"{fields[i]} error: {str(e)}"}
         output.append(date_time)
-    date_start, date_end = output
+    return {"error": False, "value": tuple(output)}
+
+
+def create_date_range(date_from: str, date_to: str, granularity: str = 'day') -> dict:
+    """
+    creates a list of dates of each day between [date_from and date_to] (inclusive),
+    or of the first day of each week or month bucket between them
+    :param date_from: start date
+    :param date_to: end date
+    :param granularity: day, week or month
+    :return: dictionary of {error: bool, value}
+    """
+    date_range = parse_date_range(date_from, date_to)
+    if date_range['error']:
+        return date_range
+    date_start, date_end = date_range['value']
+    if granularity != 'day':
+        return {"error": False, "value": list(iter_buckets(date_start, date_end, granularity))}
     # date_end - date_start -> timedelta
-    dates = [date_start + timedelta(days=days) for days in range((date_end - date_start).days + 1)]
+    dates = list(iter_days(date_start, date_end))
     return {"error": False, "value": dates}
 
 
@@ -86,68 +359,757 @@ def process_query_params(args: MultiDict[str, str]) -> tuple[list[str], str | No
     return err, date_from, date_to, origin, destination
 
 
-def price_accumulator(origin_ports, destination_ports):
-    def a(acc, val):
-        org, dest, price, count = val
-        if org in origin_ports and dest in destination_ports:
-            acc[0] += price
-            acc[1] += count
-        return acc
+def resolve_lane(origin: str, destination: str) -> tuple:
+    """
+    checks the origin and destination, and gets the ports within them
+    :param origin: origin port code or region slug
+    :param destination: destination port code or region slug
+    :return: origin ports, destination ports, error message (None if both are valid)
+    """
+    origin_is_port = origin.isupper()
+    destination_is_port = destination.isupper()
+
+    # make sure origin and destination are valid ports (if they are ports)
+    # we can filter out if they are bad region values based on their sub region/ports below
+    if origin_is_port and not catalog.has_port(origin):
+        return None, None, f"invalid origin port {origin}"
+    if destination_is_port and not catalog.has_port(destination):
+        return None, None, f"invalid destination port {destination}"
+
+    # get ports
+    origin_ports = [origin] if origin_is_port else catalog.get_sub_ports(origin)
+    destination_ports = [destination] if destination_is_port else catalog.get_sub_ports(destination)
+
+    # get_sub_ports returns nothing, which means the origin/destination region was bad
+    if not origin_ports:
+        return None, None, f"invalid origin region {origin}"
+    if not destination_ports:
+        return None, None, f"invalid destination region {destination}"
+    return origin_ports, destination_ports, None
+
+
+def resolve_node(node: str, side: str) -> tuple:
+    """
+    checks a port or region, and gets the ports within it
+    :param side: origin or destination, for the error message
+    :return: ports, error message (None if it is valid)
+    """
+    if node.isupper():
+        return ([node], None) if catalog.has_port(node) else (None, f"invalid {side} port {node}")
+    ports = catalog.get_sub_ports(node)
+    return (ports, None) if ports else (None, f"invalid {side} region {node}")
+
+
+def split_param(args: MultiDict[str, str], name: str) -> list:
+    """
+    :return: the values of a repeated or comma separated query parameter, without duplicates, in order
+    """
+    values = [value.strip() for param in args.getlist(name) for value in param.split(',')]
+    return list(dict.fromkeys(value for value in values if value))
+
+
+def average_price(price_sum: int, count_sum: int) -> int | None:
+    """
+    averages a day's prices, days with fewer than 3 prices have no average
+    """
+    return None if count_sum < 3 else round(price_sum / count_sum)
+
+
+def average_prices(dates: list, daily_sums: list) -> list:
+    """
+    averages the price of each day
+    :param dates: every day of the date range
+    :param daily_sums: list of (day, price sum, price count), days without prices can be left out
+    :return: list of {day, average_price}
+    """
+    sums = {day.strftime('%Y-%m-%d'): (price_sum, count_sum) for day, price_sum, count_sum in daily_sums}
+    results = []
+    for date in dates:
+        date_string = date.strftime('%Y-%m-%d')
+        price_sum, count_sum = sums.get(date_string, (0, 0))
+        results.append({"day": date_string, "average_price": average_price(price_sum, count_sum)})
+    return results
+
+
+def iter_average_prices(days, daily_sums):
+    """
+    same as average_prices, but consumes both iterators one day at a time
+    :param days: iterator of every day of the date range, in order
+    :param daily_sums: iterator of (day, price sum, price count) ordered by day, days without prices can be left out
+    :return: generator of {day, average_price}
+    """
+    daily_sums = iter(daily_sums)
+    next_sum = next(daily_sums, None)
+    for date in days:
+        price_sum, count_sum = 0, 0
+        if next_sum is not None and next_sum[0] == date.date():
+            _, price_sum, count_sum = next_sum
+            next_sum = next(daily_sums, None)
+        yield {"day": date.strftime('%Y-%m-%d'), "average_price": average_price(price_sum, count_sum)}
+
+
+def iter_daily_sums(origin: str, destination: str, origin_ports, destination_ports, date_from: str, date_to: str):
+    """
+    streams the daily price sums between the origin and destination for each day in [date_from, date_to]
+    the sql engine reads them through a server-side cursor, other engines already hold them in memory
+    :return: iterator of (day, price sum, price count) ordered by day, days without prices are left out
+    """
+    if rates_rollups or engine is not None:
+        try:
+            return iter(fetch_daily_sums(origin, destination, origin_ports, destination_ports, date_from, date_to))
+        except PartialSums as e:
+            app.logger.warning("streaming %s to %s without %s", origin, destination, e)
+            return iter(e.rows)
+    return db.iter_price_sums(origin_ports, destination_ports, date_from, date_to)
+
+
+def add_daily_stats(results: list, daily_sketches: list, names: list):
+    """
+    adds the asked stats of each day's price distribution to its result,
+    days with fewer than 3 prices have no stats, as they have no average
+    :param results: list of {day, average_price}, one per day of the date range
+    :param daily_sketches: list of (day, sketch), days without prices can be left out
+    """
+    sketches_by_day = {day.strftime('%Y-%m-%d'): sketch for day, sketch in daily_sketches}
+    for result in results:
+        sketch = sketches_by_day.get(result["day"])
+        if sketch is None or sketch.count < 3:
+            result.update(dict.fromkeys(names))
+        else:
+            result.update(sketch.stats(names))
+
+
+def columnar_rates(results: list) -> dict:
+    """
+    :param results: list of {day, average_price, and any stats}
+    :return: dictionary of parallel {days, prices, and a list per stat} lists
+    """
+    columns = {"days": [result["day"] for result in results], "prices": [result["average_price"] for result in results]}
+    for name in (results[0] if results else {}):
+        if name not in ("day", "average_price"):
+            columns[name] = [result[name] for result in results]
+    return columns
 
-    return a
+
+def rates_etag(cache_key: tuple, response_format: str, version: int) -> str:
+    """
+    tags a /rates response by its query and the data version, so it changes only when the answer can
+    """
+    return hashlib.sha1(repr((cache_key, response_format, version)).encode()).hexdigest()
+
+
+def wants_stream(req) -> bool:
+    """
+    checks if the request asked for newline delimited json, with ?stream=1 or an Accept: application/x-ndjson header
+    """
+    return req.args.get('stream') in ('1', 'true') or \
+        req.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+@app.before_request
+def start_request_trace():
+    metrics.start_trace()
+
+
+@app.after_request
+def end_request_trace(response):
+    """
+    records the request's latency, logging its phases and queries if it was slow
+    """
+    trace = metrics.end_trace()
+    if trace is None:
+        return response
+    elapsed = time.perf_counter() - trace["started"]
+    metrics.request_seconds.observe(elapsed, (('endpoint', request.endpoint),))
+    if slow_request_ms and elapsed * 1000 > slow_request_ms:
+        app.logger.warning("slow request %s %.1fms phases=%s queries=%s", request.full_path, elapsed * 1000,
+                           {name: round(seconds * 1000, 2) for name, seconds in trace["phases"].items()},
+                           [{**query, "seconds": round(query["seconds"] * 1000, 2)} for query in trace["queries"]])
+    return response
+
+
+def profile_allowed(req) -> bool:
+    return profiles is not None and req.remote_addr in profile_allowlist
+
+
+@app.before_request
+def start_profile():
+    """
+    profiles requests asking for it with ?profile=1 or an X-Profile: 1 header from allowlisted clients
+    """
+    if profiles is None or (request.args.get('profile') != '1' and request.headers.get('X-Profile') != '1'):
+        return
+    if profile_allowed(request):
+        # left unprofiled while another request is being profiled
+        g.profile_started = time.perf_counter()
+        g.profiler = profiles.start()
+
+
+@app.after_request
+def stop_profile(response):
+    """
+    stores the request's profile and trace, runs before end_request_trace so the trace is still current
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profile_id = profiles.stop(profiler, request.full_path, time.perf_counter() - g.profile_started,
+                               metrics.current_trace())
+    response.headers['X-Profile-Id'] = str(profile_id)
+    return response
+
+
+@app.teardown_request
+def discard_profile(exc):
+    """
+    stops the profiler of a request that failed before its after_request hooks ran
+    """
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiles.discard(profiler)
+
+
+@app.after_request
+def compress_response(response):
+    """
+    gzips json responses for clients that accept it, streamed responses are sent as they are
+    """
+    if response.mimetype != 'application/json' or response.is_streamed or response.status_code != 200:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < gzip_min_bytes:
+        return response
+    with phase('compress'):
+        response.set_data(gzip.compress(data, compresslevel=5))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return {"error": "server busy, try again later"}, 503
+
+
+@app.errorhandler(QueryTooExpensive)
+def query_too_expensive(e):
+    return {"error": str(e)}, 429
+
+
+@app.errorhandler(OverBudget)
+def over_budget(e):
+    return {"error": str(e)}, 503, {"Retry-After": "1"}
 
 
 @app.route("/rates")
 def rates():
     """
-    Gets the average price per day between an origin and destination for a specified date range
+    Gets the average price per day between an origin and destination for a specified date range,
+    and with stats=median,p10,p90,min,max,stddev (any of them) the spread of each day's prices
+    granularity=week or month averages each week (starting on monday) or month instead of each day
 
     Process query params
     Set the date range
     Check from and to ports
     Get all origin and destination ports
-    Get prices between each origin and destination port
+    Get the daily price sums between all origin and destination ports
     """
 
-    query_err, date_from, date_to, origin, destination = process_query_params(request.args)
+    with phase('parse'):
+        query_err, date_from, date_to, origin, destination = process_query_params(request.args)
     if query_err:
         return {"error": f"{query_err} params required"}, 400
 
-    # get date range
-    dates_range = create_date_range(date_from, date_to)
+    stats = []
+    if request.args.get('stats'):
+        stats, stats_err = parse_stats(request.args['stats'])
+        if stats_err:
+            return {"error": stats_err}, 400
+        if sketches is None:
+            return {"error": "stats are not enabled on this server"}, 400
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        return {"error": f"granularity must be one of {', '.join(GRANULARITIES)}"}, 400
+
+    # streamed responses write one day per line as soon as it is read, without building the whole list
+    if wants_stream(request):
+        if stats or granularity != 'day':
+            return {"error": "only daily averages can be streamed"}, 400
+        return stream_rates(date_from, date_to, origin, destination)
+
+    # get date range, or the first day of each bucket
+    with phase('parse'):
+        dates_range = create_date_range(date_from, date_to, granularity)
     if dates_range['error']: return {"error": dates_range['value']}, 400
 
-    origin_is_port = origin.isupper()
-    destination_is_port = destination.isupper()
+    response_format = request.args.get('format', 'list')
+    if response_format not in RESPONSE_FORMATS:
+        return {"error": f"format must be one of {', '.join(RESPONSE_FORMATS)}"}, 400
 
-    # make sure origin and destination are valid ports (if they are ports)
-    # we can filter out if they are bad region values based on their sub region/ports below
-    if origin_is_port and not db.get_port(origin):
-        return {"error": f"invalid origin port {origin}"}, 400
-    if destination_is_port and not db.get_port(destination):
-        return {"error": f"invalid destination port {destination}"}, 400
+    # clients holding the response of the same query and data version are told it has not changed,
+    # the tag is weak as gzipped and plain responses share it
+    version = current_data_version()
+    cache_key = (origin, destination,
+                 datetime.strptime(date_from, '%Y-%m-%d').date(), datetime.strptime(date_to, '%Y-%m-%d').date(),
+                 granularity, tuple(stats))
+    etag = rates_etag(cache_key, response_format, version)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
 
-    # get ports
-    origin_ports = [origin] if origin_is_port else get_sub_ports(origin)
-    destination_ports = [destination] if destination_is_port else get_sub_ports(destination)
+    # identical queries are answered from the cache until the data changes,
+    # and identical queries arriving together are answered by one computation
+    results = response_cache.get(cache_key, version) if response_cache is not None else None
+    if results is None:
+        def compute():
+            return compute_rates(origin, destination, dates_range['value'], date_from, date_to, granularity, stats,
+                                 version)
 
-    # get_sub_ports returns nothing, which means the origin/destination region was bad
-    if not origin_ports:
-        return {"error": f"invalid origin region {origin}"}, 400
-    if not destination_ports:
-        return {"error": f"invalid destination region {destination}"}, 400
+        results, missing, lane_err = single_flight.do((cache_key, version), compute) if single_flight is not None \
+            else compute()
+        if lane_err:
+            return {"error": lane_err}, 400
 
-    results = []
-    for date in dates_range['value']:
-        # for any given day, add up all the prices between all the origin and destination ports
-        date_string = date.strftime('%Y-%m-%d')
-        all_prices_by_day = db.get_daily_prices(date_string)
-        price_sum, count_sum = reduce(price_accumulator(origin_ports, destination_ports), all_prices_by_day, [0, 0])
-        results.append({"day": date_string, "average_price": None if count_sum < 3 else round(price_sum / count_sum)})
+        # days of shards that did not answer are left without an average, and the response is neither cached nor tagged
+        if missing:
+            response = app.json.response(columnar_rates(results) if response_format == 'columnar' else results)
+            response.headers['X-Missing-Ranges'] = ",".join(f"{first}..{last}" for first, last in missing)
+            return response
+        if response_cache is not None:
+            response_cache.set(cache_key, version, results)
+
+    response = app.json.response(columnar_rates(results) if response_format == 'columnar' else results)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def compute_rates(origin: str, destination: str, dates: list, date_from: str, date_to: str, granularity: str,
+                  stats: list, version: int) -> tuple:
+    """
+    answers a /rates query
+    :param dates: every day of the date range, or the first day of each bucket, see create_date_range
+    :return: list of {day, average_price, and any stats}, the list of (first day, last day) spans whose shards
+             did not answer, and an error message if the origin or destination is unknown
+    """
+    with phase('resolve'):
+        origin_ports, destination_ports, lane_err = resolve_lane(origin, destination)
+    if lane_err:
+        return None, [], lane_err
+
+    # sum the prices between all the origin and destination ports for every day (or bucket) in one query,
+    # once its estimated cost fits in the budget
+    days = max(0, (datetime.strptime(date_to, '%Y-%m-%d') - datetime.strptime(date_from, '%Y-%m-%d')).days + 1)
+    missing = []
+    with admit(query_cost(days, origin_ports, destination_ports)):
+        with phase('prices'):
+            try:
+                price_sums = get_bucket_sums(origin, destination, origin_ports, destination_ports, date_from, date_to,
+                                             dates, granularity, version)
+            except PartialSums as e:
+                price_sums, missing = e.rows, e.missing
+        with phase('aggregate'):
+            results = average_prices(dates, price_sums)
+
+        # distributions of region lanes are merged from the sketches of their port pairs
+        if stats:
+            with phase('stats'):
+                daily_sketches = sketches.get_daily_sketches(origin_ports, destination_ports, date_from, date_to)
+                if granularity != 'day':
+                    daily_sketches = bucket_sketches(daily_sketches, dates)
+                add_daily_stats(results, daily_sketches, stats)
+    return results, missing, None
+
+
+def stream_rates(date_from: str, date_to: str, origin: str, destination: str):
+    """
+    streams the average price per day as newline delimited json, one {day, average_price} object per line
+    """
+    date_range = parse_date_range(date_from, date_to)
+    if date_range['error']:
+        return {"error": date_range['value']}, 400
+    date_start, date_end = date_range['value']
+
+    origin_ports, destination_ports, lane_err = resolve_lane(origin, destination)
+    if lane_err:
+        return {"error": lane_err}, 400
+
+    # the query holds its cost budget until the response is closed, after the last day was sent
+    admission = ExitStack()
+    days = max(0, (date_end - date_start).days + 1)
+    admission.enter_context(admit(query_cost(days, origin_ports, destination_ports)))
+
+    def generate():
+        daily_sums = iter_daily_sums(origin, destination, origin_ports, destination_ports, date_from, date_to)
+        for result in iter_average_prices(iter_days(date_start, date_end), daily_sums):
+            yield json.dumps(result) + "\n"
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.call_on_close(admission.close)
+    return response
+
+
+def merge_date_ranges(ranges: list) -> list:
+    """
+    merges overlapping and adjacent date ranges
+    :param ranges: list of (first day, last day)
+    :return: sorted list of non-overlapping (first day, last day)
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] <= timedelta(days=1):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(date_range) for date_range in merged]
+
+
+def get_pair_sums(lanes: list) -> tuple:
+    """
+    sums the prices of every port pair any of the lanes needs, with one grouped query per merged date range
+    :param lanes: list of (origin ports, destination ports, dates)
+    :return: dictionary of {(origin port, destination port): [(day, price sum, price count)]},
+             and the list of (first day, last day) strings of the spans whose shards did not answer
+    """
+    origin_ports = set().union(*[origins for origins, _, _ in lanes])
+    destination_ports = set().union(*[destinations for _, destinations, _ in lanes])
+    date_ranges = merge_date_ranges([(dates[0], dates[-1]) for _, _, dates in lanes if dates])
+
+    pair_sums = {}
+    missing = []
+    for start, end in date_ranges:
+        try:
+            source = get_engine()
+            rows = fan_out_dates(source, lambda span_from, span_to: source.get_port_pair_sums(
+                sorted(origin_ports), sorted(destination_ports), span_from, span_to),
+                start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d'))
+        except PartialSums as e:
+            rows = e.rows
+            missing += e.missing
+        for org, dest, day, price_sum, count_sum in rows:
+            pair_sums.setdefault((org, dest), []).append((day, price_sum, count_sum))
+    return pair_sums, missing
+
+
+def lane_daily_sums(pair_sums: dict, origin_ports: set, destination_ports: set, dates: list) -> list:
+    """
+    adds up the daily sums of the port pairs within a lane
+    :return: list of (day, price sum, price count)
+    """
+    if not dates:
+        return []
+    start, end = dates[0].date(), dates[-1].date()
+    sums = {}
+    for (org, dest), daily_sums in pair_sums.items():
+        if org in origin_ports and dest in destination_ports:
+            for day, price_sum, count_sum in daily_sums:
+                if start <= day <= end:
+                    day_sum, day_count = sums.get(day, (0, 0))
+                    sums[day] = (day_sum + price_sum, day_count + count_sum)
+    return [(day, price_sum, count_sum) for day, (price_sum, count_sum) in sums.items()]
+
+
+@app.route("/rates/batch", methods=["POST"])
+def rates_batch():
+    """
+    Gets the average price per day of many lanes in one request
+
+    Takes a list of {origin, destination, date_from, date_to} queries and returns a list with, for each query,
+    either {"rates": [...]} holding the same output as /rates or {"error": "..."}
+    Lanes missing days because a price shard did not answer also get a "missing" list of first_day..last_day spans
+    Every distinct origin and destination is resolved once, and all lanes are answered from the same grouped
+    price queries over their merged date ranges
+    """
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        return {"error": "body must be a list of {origin, destination, date_from, date_to} queries"}, 400
+
+    results = [None] * len(queries)
+    resolved = {}
+    lanes = []
+    for i, query in enumerate(queries):
+        if not isinstance(query, dict):
+            results[i] = {"error": "query must be an object"}
+            continue
+        not_strings = [name for name in ('date_from', 'date_to', 'origin', 'destination')
+                       if query.get(name) is not None and not isinstance(query[name], str)]
+        if not_strings:
+            results[i] = {"error": f"{not_strings} params must be strings"}
+            continue
+        query_err, date_from, date_to, origin, destination = process_query_params(query)
+        if query_err:
+            results[i] = {"error": f"{query_err} params required"}
+            continue
+        dates_range = create_date_range(date_from, date_to)
+        if dates_range['error']:
+            results[i] = {"error": dates_range['value']}
+            continue
+
+        if (origin, destination) not in resolved:
+            resolved[(origin, destination)] = resolve_lane(origin, destination)
+        origin_ports, destination_ports, lane_err = resolved[(origin, destination)]
+        if lane_err:
+            results[i] = {"error": lane_err}
+            continue
+        dates = dates_range['value']
+        # the ceiling applies to every lane on its own, as if it was queried from /rates
+        try:
+            check_cost(query_cost(len(dates), origin_ports, destination_ports))
+        except QueryTooExpensive as e:
+            results[i] = {"error": str(e)}
+            continue
+        lanes.append((i, set(origin_ports), set(destination_ports), dates))
+
+    if lanes:
+        cost = sum(query_cost(len(dates), origin_ports, destination_ports)
+                   for _, origin_ports, destination_ports, dates in lanes)
+        with admit(cost, ceiling=False):
+            pair_sums, missing = get_pair_sums([lane[1:] for lane in lanes])
+        for i, origin_ports, destination_ports, dates in lanes:
+            daily_sums = lane_daily_sums(pair_sums, origin_ports, destination_ports, dates)
+            results[i] = {"rates": average_prices(dates, daily_sums)}
+            if not dates:
+                continue
+            start, end = dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d')
+            lane_missing = [f"{first}..{last}" for first, last in missing if first <= end and last >= start]
+            if lane_missing:
+                results[i]["missing"] = lane_missing
     return results
 
 
-if __name__ == '__main__':
-    db = DB(db_host, db_database, db_user, db_password)
-    app.run(host="localhost", port=8080, debug=True)
+@app.route("/rates/matrix")
+def rates_matrix():
+    """
+    Gets the average price per day from each origin to each destination for a specified date range
+
+    origin and destination take one or more ports or regions, comma separated or repeated
+    Every destination port is mapped to the destinations holding it once, and every cell of the matrix is added up
+    from one grouped price query over all the origin and destination ports
+    Returns {"days": [...], "destinations": [...], "prices": {origin: [[average price of each destination] each day]}}
+    """
+    origins, destinations = split_param(request.args, 'origin'), split_param(request.args, 'destination')
+    date_from, date_to = request.args.get('date_from'), request.args.get('date_to')
+    query_err = [name for name, value in [('date_from', date_from), ('date_to', date_to), ('origin', origins),
+                                          ('destination', destinations)] if not value]
+    if query_err:
+        return {"error": f"{query_err} params required"}, 400
+    dates_range = create_date_range(date_from, date_to)
+    if dates_range['error']:
+        return {"error": dates_range['value']}, 400
+    dates = dates_range['value']
+
+    # which origins and destinations (a port can be within several of them) each port counts towards
+    origins_of, destinations_of = {}, {}
+    for nodes, side, groups in [(origins, 'origin', origins_of), (destinations, 'destination', destinations_of)]:
+        for i, node in enumerate(nodes):
+            ports, err = resolve_node(node, side)
+            if err:
+                return {"error": err}, 400
+            for port in ports:
+                groups.setdefault(port, []).append(i)
+
+    missing = []
+    with admit(query_cost(len(dates), origins_of, destinations_of)):
+        with phase('prices'):
+            try:
+                source = get_engine()
+                rows = fan_out_dates(source, lambda span_from, span_to: source.get_port_pair_sums(
+                    sorted(origins_of), sorted(destinations_of), span_from, span_to), date_from, date_to)
+            except PartialSums as e:
+                rows, missing = e.rows, e.missing
+
+    with phase('aggregate'):
+        start = dates[0].date() if dates else None
+        sums = [[[0] * len(destinations) for _ in dates] for _ in origins]
+        counts = [[[0] * len(destinations) for _ in dates] for _ in origins]
+        for org, dest, day, price_sum, count_sum in rows:
+            offset = (day - start).days
+            for i in origins_of[org]:
+                for j in destinations_of[dest]:
+                    sums[i][offset][j] += price_sum
+                    counts[i][offset][j] += count_sum
+        prices = {origin: [[average_price(price_sum, count_sum) for price_sum, count_sum in zip(day_sums, day_counts)]
+                           for day_sums, day_counts in zip(sums[i], counts[i])]
+                  for i, origin in enumerate(origins)}
+
+    response = app.json.response({"days": [date.strftime('%Y-%m-%d') for date in dates], "destinations": destinations,
+                                  "prices": prices})
+    if missing:
+        response.headers['X-Missing-Ranges'] = ",".join(f"{first}..{last}" for first, last in missing)
+    return response
+
+
+@app.route("/rates/cache")
+def rates_cache():
+    """
+    Reports the /rates response and cell cache hit and miss counts, and how many requests were coalesced
+    """
+    stats = {}
+    for name, cache in [("responses", response_cache), ("cells", cell_cache), ("coalescing", single_flight)]:
+        stats[name] = {"enabled": False} if cache is None else {"enabled": True, **cache.stats()}
+    return stats
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """
+    Exposes request, phase and DB query latencies and the cache counts in the Prometheus text format
+    """
+    lines = []
+    for name, cache in [("responses", response_cache), ("cells", cell_cache)]:
+        if cache is not None:
+            stats = cache.stats()
+            lines += [f'rates_cache_hits_total{{cache="{name}"}} {stats["hits"]}',
+                      f'rates_cache_misses_total{{cache="{name}"}} {stats["misses"]}',
+                      f'rates_cache_evictions_total{{cache="{name}"}} {stats["evictions"]}',
+                      f'rates_cache_size{{cache="{name}"}} {stats["size"]}']
+    if cost_budget is not None:
+        stats = cost_budget.stats()
+        lines += [f'rates_admission_in_flight_cost {stats["in_flight_cost"]}'] + \
+            [f'rates_admission_total{{outcome="{outcome}"}} {stats[outcome]}'
+             for outcome in ["admitted", "queued", "rejected", "shed"]]
+    if single_flight is not None:
+        stats = single_flight.stats()
+        lines += [f'rates_coalesced_requests_total {stats["coalesced"]}',
+                  f'rates_coalescing_leaders_total {stats["leaders"]}']
+    if warmup is not None:
+        stats = warmup.stats()
+        lines += [f'rates_ready {int(stats["ready"])}', f'rates_warmup_lanes_total{{outcome="warmed"}} {stats["warmed"]}',
+                  f'rates_warmup_lanes_total{{outcome="failed"}} {stats["failed"]}']
+        if stats["seconds"] is not None:
+            lines.append(f'rates_warmup_seconds {stats["seconds"]}')
+    return Response(metrics.render(lines), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/admin/profiles")
+def list_profiles():
+    """
+    Lists the stored request profiles with their phase and query timings, newest first
+    """
+    if not profile_allowed(request):
+        return {"error": "profiling is not enabled for this client"}, 403
+    return {"profiles": profiles.summaries()}
+
+
+@app.route("/admin/profiles/<int:profile_id>")
+def get_profile(profile_id: int):
+    """
+    Returns a stored profile as pstats text sorted by cumulative time, or as collapsed stacks with format=collapsed
+    """
+    if not profile_allowed(request):
+        return {"error": "profiling is not enabled for this client"}, 403
+    output_format = request.args.get('format', 'pstats')
+    if output_format not in ('pstats', 'collapsed'):
+        return {"error": "format must be pstats or collapsed"}, 400
+    text = profiles.render(profile_id, output_format)
+    if text is None:
+        return {"error": f"profile {profile_id} is no longer stored"}, 404
+    return Response(text, mimetype='text/plain')
+
+
+@app.route("/healthz")
+def healthz():
+    """
+    Answers as long as the server is up, for liveness checks
+    """
+    return {"status": "ok"}
+
+
+@app.route("/readyz")
+def readyz():
+    """
+    Answers 200 once the startup warm-up finished and 503 until then, with the warm-up progress and duration
+    """
+    if warmup is None:
+        return {"ready": True}
+    stats = warmup.stats()
+    return stats, 200 if stats["ready"] else 503
+
+
+@app.route("/catalog/reload", methods=["POST"])
+def reload_catalog():
+    """
+    Reloads the ports and regions hierarchy so catalog changes are picked up without a restart
+    """
+    if request.remote_addr not in admin_allowlist:
+        return {"error": "catalog reloads are not allowed for this client"}, 403
+    catalog.reload()
+    return {"reloaded": True}
+
+
+def warm_lane(origin: str, destination: str, date_from: str, date_to: str):
+    """
+    answers a /rates request for the lane, filling the caches a client asking for it would hit
+    """
+    response = app.test_client().get('/rates', query_string={"origin": origin, "destination": destination,
+                                                             "date_from": date_from, "date_to": date_to})
+    if response.status_code != 200:
+        raise RuntimeError(f"/rates answered {response.status_code}: {response.get_data(as_text=True)}")
+
+
+def create_app() -> Flask:
+    """
+    connects to the database, loads the catalog and the configured engine and caches,
+    then starts warming the hot lanes in the background; /readyz answers 200 once they are warm
+    """
+    global db, catalog, engine, data_version, sketches, cost_budget, single_flight, profiles, response_cache, \
+        cell_cache, sharded_prices, warmup, db_executor
+    db = DB(db_host, db_database, db_user, db_password, db_pool_min, db_pool_max, db_pool_timeout)
+    # the snapshot engine also holds the ports, regions and data version, so the catalog follows the mapped file
+    source = SnapshotPrices(rates_snapshot) if rates_engine == 'snapshot' else db
+    catalog = Catalog(source)
+    data_version = DataVersion(source, data_version_poll)
+    data_version.on_change(catalog.reload)
+    if rates_engine == 'snapshot':
+        engine = source
+    if price_shards and rates_engine != 'snapshot':
+        # a hung shard fails its queries instead of holding their threads and connections indefinitely
+        shards = [(first, last, DB(host, db_database, db_user, db_password, db_pool_min, db_pool_max, db_pool_timeout, port,
+                                   connect_timeout=price_shard_timeout, statement_timeout=price_shard_timeout))
+                  for first, last, host, port in parse_shards(price_shards)]
+        engine = sharded_prices = ShardedPrices(shards, price_shard_timeout, price_shard_workers)
+    if rates_engine == 'columnar':
+        engine = ColumnarPrices(get_engine())
+        data_version.on_change(engine.reload)
+    if rates_sketches:
+        sketches = PriceSketches(sharded_prices or db)
+        data_version.on_change(sketches.reload)
+    if price_chunk_days > 0:
+        db_executor = ThreadPoolExecutor(max(1, db_pool_max // 2), thread_name_prefix='db')
+    if rates_max_query_cost > 0 or rates_cost_budget > 0:
+        cost_budget = CostBudget(rates_cost_budget, rates_max_query_cost, rates_cost_queue_seconds)
+    if rates_coalesce:
+        single_flight = SingleFlight()
+    if profile_allowlist:
+        profiles = Profiles(profile_buffer_size)
+    if rates_cache_size > 0:
+        response_cache = LRUCache(rates_cache_size, rates_cache_ttl)
+        data_version.on_change(response_cache.clear)
+    if rates_cell_cache_size > 0:
+        cell_cache = CellCache(rates_cell_cache_size, rates_cache_ttl)
+        data_version.on_change(cell_cache.clear)
+    lanes = parse_lanes(warmup_lanes)
+    if warmup_log:
+        lanes += read_access_log(warmup_log, warmup_top)
+    warmup = Warmup(list(dict.fromkeys(lanes)), warm_lane)
+    warmup.start()
+    return app
+
+
+def close_app():
+    """
+    closes the database connections and executors opened by create_app
+    """
+    if db_executor is not None:
+        db_executor.shutdown(wait=False)
+    if sharded_prices is not None:
+        sharded_prices.close()
     db.close()
+
+
+if __name__ == '__main__':
+    create_app()
+    app.run(host="localhost", port=8080, debug=True, threaded=True)
+    close_app()
@@ -0,0 +1,164 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PartialSums(Exception):
+    """
+    raised when some shards did not answer in time, carrying the rows of the shards that did
+    """
+
+    def __init__(self, rows: list, missing: list):
+        """
+        :param rows: rows of the shards that answered, ordered by day
+        :param missing: list of (first day, last day) strings of the date spans that are missing
+        """
+        super().__init__("no prices from the shards of " + ", ".join(f"{first}..{last}" for first, last in missing))
+        self.rows = rows
+        self.missing = missing
+
+
+def parse_shards(spec: str) -> list:
+    """
+    parses a comma separated list of first_day..last_day@host[:port] shards, either day can be left out
+    :return: list of (first day, last day, host, port), open ends are None
+    """
+    shards = []
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            days, address = part.split('@')
+            first, last = days.split('..')
+            host, _, port = address.partition(':')
+            shards.append((date.fromisoformat(first) if first else None, date.fromisoformat(last) if last else None,
+                           host, int(port) if port else 5432))
+        except ValueError:
+            raise ValueError(f"price shard {part} must be formatted first_day..last_day@host[:port]")
+    return shards
+
+
+class ShardedPrices:
+    """
+    prices split by date over several databases, answering the same price queries as DB
+
+    a query's date range is split at the shard boundaries and the shards are queried concurrently,
+    shards that do not answer within the timeout are left out and reported through PartialSums;
+    every shard has threads of its own, so queries hanging on one shard never hold up the others;
+    a query waits for a free thread of a busy shard within its timeout, and leaves the shard out after it
+    """
+
+    def __init__(self, shards: list, timeout: float = 5.0, max_workers: int = 4):
+        """
+        :param shards: list of (first day, last day, DB), open ends are None, the date ranges must not overlap
+        :param timeout: seconds to wait for the shards of a query
+        :param max_workers: threads querying each shard, at most one connection of the shard's pool each
+        """
+        self.shards = sorted(shards, key=lambda shard: shard[0] or date.min)
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self._executors = [ThreadPoolExecutor(max_workers, thread_name_prefix=f'price-shard-{i}')
+                           for i in range(len(self.shards))]
+        self._slots = [threading.BoundedSemaphore(max_workers) for _ in self.shards]
+
+    def _spans(self, date_from: str, date_to: str) -> list:
+        """
+        splits a date range at the shard boundaries
+        :return: list of (shard index, first day, last day) of the shards holding part of the range
+        """
+        start, end = date.fromisoformat(date_from), date.fromisoformat(date_to)
+        spans = []
+        for i, (first, last, _) in enumerate(self.shards):
+            span_from, span_to = max(start, first or date.min), min(end, last or date.max)
+            if span_from <= span_to:
+                spans.append((i, span_from.strftime('%Y-%m-%d'), span_to.strftime('%Y-%m-%d')))
+        return spans
+
+    def _fan_out(self, method: str, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str,
+                 day_index: int) -> list:
+        """
+        runs a price query on every shard holding part of the date range and concatenates the rows by day
+        """
+        deadline = time.monotonic() + self.timeout
+        futures = {}
+        rows, missing = [], []
+
+        def submit(i: int, span_from: str, span_to: str):
+            query = getattr(self.shards[i][2], method)
+            # each query runs in a copy of the request's context, so its trace records the shard queries too
+            future = self._executors[i].submit(contextvars.copy_context().run, self._query, i, query,
+                                               origin_ports, destination_ports, span_from, span_to)
+            futures[future] = (i, span_from, span_to)
+
+        busy = []
+        for i, span_from, span_to in self._spans(date_from, date_to):
+            if self._slots[i].acquire(blocking=False):
+                submit(i, span_from, span_to)
+            else:
+                busy.append((i, span_from, span_to))
+        # the shards with free threads are already queried while waiting for the busy ones
+        for i, span_from, span_to in busy:
+            if self._slots[i].acquire(timeout=max(0.0, deadline - time.monotonic())):
+                submit(i, span_from, span_to)
+                continue
+            logger.warning("price shard %d was busy with %s earlier queries for %ss, leaving out %s..%s",
+                           i, self.max_workers, self.timeout, span_from, span_to)
+            missing.append((span_from, span_to))
+            metrics.shard_failures.inc((('shard', str(i)),))
+        done, _ = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+
+        for future, (i, span_from, span_to) in futures.items():
+            if future in done and future.exception() is None:
+                rows += future.result()
+                continue
+            if future in done:
+                logger.warning("price shard %d failed on %s..%s", i, span_from, span_to, exc_info=future.exception())
+            else:
+                logger.warning("price shard %d did not answer %s..%s within %ss", i, span_from, span_to, self.timeout)
+            missing.append((span_from, span_to))
+            metrics.shard_failures.inc((('shard', str(i)),))
+        rows.sort(key=lambda row: row[day_index])
+        if missing:
+            raise PartialSums(rows, sorted(missing))
+        return rows
+
+    def _query(self, i: int, query, *args) -> list:
+        """
+        runs a query on shard i, freeing its slot once the query returns, even after the request stopped waiting
+        """
+        try:
+            return query(*args)
+        finally:
+            self._slots[i].release()
+
+    def get_price_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        :return: list of (day, price sum, price count) ordered by day, days without prices are left out
+        :raises PartialSums: when some shards did not answer
+        """
+        return self._fan_out('get_price_sums', origin_ports, destination_ports, date_from, date_to, 0)
+
+    def get_port_pair_sums(self, origin_ports: [str], destination_ports: [str], date_from: str, date_to: str) -> [tuple]:
+        """
+        :return: list of (origin port, destination port, day, price sum, price count) ordered by day
+        :raises PartialSums: when some shards did not answer
+        """
+        return self._fan_out('get_port_pair_sums', origin_ports, destination_ports, date_from, date_to, 2)
+
+    def iter_prices(self, chunk_size: int = 10000):
+        """
+        reads the prices of every shard in turn, for loading them into another engine
+        """
+        for _, _, db in self.shards:
+            yield from db.iter_prices(chunk_size)
+
+    def close(self):
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+        for _, _, db in self.shards:
+            db.close()
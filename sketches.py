@@ -0,0 +1,167 @@
+import bisect
+import math
+from datetime import datetime
+
+from database import DB
+
+# prices a quantile is estimated from are within this fraction of an actual price
+RELATIVE_ACCURACY = 0.01
+STATS = ('median', 'p10', 'p90', 'min', 'max', 'stddev')
+QUANTILES = {'median': 0.5, 'p10': 0.1, 'p90': 0.9}
+
+
+class QuantileSketch:
+    """
+    mergeable summary of a distribution of prices
+
+    prices are counted in logarithmic buckets, so merging two sketches adds their bucket counts and quantiles
+    are estimated within RELATIVE_ACCURACY; the count, sum, sum of squares, minimum and maximum are exact
+    """
+    __slots__ = ('buckets', 'non_positive', 'count', 'total', 'squares', 'min', 'max')
+
+    gamma = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    log_gamma = math.log(gamma)
+
+    def __init__(self):
+        self.buckets = {}
+        self.non_positive = 0
+        self.count = 0
+        self.total = 0
+        self.squares = 0
+        self.min = None
+        self.max = None
+
+    def add(self, price: int):
+        if price > 0:
+            index = math.ceil(math.log(price) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        else:
+            self.non_positive += 1
+        self.count += 1
+        self.total += price
+        self.squares += price * price
+        self.min = price if self.min is None else min(self.min, price)
+        self.max = price if self.max is None else max(self.max, price)
+
+    def merge(self, other: 'QuantileSketch'):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.non_positive += other.non_positive
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, q: float) -> float | None:
+        """
+        :param q: quantile between 0 and 1
+        :return: estimated price at the quantile, None if the sketch is empty
+        """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.non_positive
+        if seen > rank:
+            return self.min
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # middle of the bucket (gamma^(index-1), gamma^index], within the relative accuracy of its prices
+                estimate = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(estimate, self.min), self.max)
+        return self.max
+
+    def stddev(self) -> float | None:
+        """
+        :return: sample standard deviation, None for fewer than 2 prices
+        """
+        if self.count < 2:
+            return None
+        return math.sqrt(max(0, (self.squares - self.total * self.total / self.count) / (self.count - 1)))
+
+    def stats(self, names: list) -> dict:
+        """
+        :param names: stats among STATS
+        :return: dictionary of {name: rounded value}
+        """
+        values = {}
+        for name in names:
+            if name in QUANTILES:
+                value = self.quantile(QUANTILES[name])
+            elif name == 'stddev':
+                value = self.stddev()
+            else:
+                value = getattr(self, name)
+            values[name] = None if value is None else round(value)
+        return values
+
+
+class PriceSketches:
+    """
+    in-process quantile sketches of the prices of each (origin port, destination port, day)
+
+    the distribution of a region lane is the merge of the sketches of its port pairs, without reading any price rows
+    """
+
+    def __init__(self, db: DB, chunk_size: int = 100000):
+        self.db = db
+        self.chunk_size = chunk_size
+        self._pairs = {}
+        self.reload()
+
+    def reload(self):
+        """
+        rebuilds the sketches from the prices table
+        the new sketches are swapped in at once, so queries being answered keep a consistent view
+        """
+        cells = {}
+        for rows in self.db.iter_prices(self.chunk_size):
+            for org, dest, day, price in rows:
+                sketch = cells.get((org, dest, day))
+                if sketch is None:
+                    sketch = cells[(org, dest, day)] = QuantileSketch()
+                sketch.add(price)
+
+        # every origin's destinations hold their days in order, so a date range is found by bisection
+        pairs = {}
+        for (org, dest, day), sketch in sorted(cells.items(), key=lambda cell: cell[0][2]):
+            days, sketches = pairs.setdefault(org, {}).setdefault(dest, ([], []))
+            days.append(day)
+            sketches.append(sketch)
+        self._pairs = pairs
+
+    def get_daily_sketches(self, origin_ports, destination_ports, date_from: str, date_to: str) -> [tuple]:
+        """
+        merges the sketches of every origin and destination port pair for each day in [date_from, date_to]
+        :return: list of (day, sketch) ordered by day, days without prices are left out
+        """
+        start = datetime.strptime(date_from, '%Y-%m-%d').date()
+        end = datetime.strptime(date_to, '%Y-%m-%d').date()
+        destination_ports = set(destination_ports)
+        pairs = self._pairs
+
+        merged = {}
+        for org in origin_ports:
+            for dest, (days, sketches) in pairs.get(org, {}).items():
+                if dest not in destination_ports:
+                    continue
+                for i in range(bisect.bisect_left(days, start), bisect.bisect_right(days, end)):
+                    day_sketch = merged.get(days[i])
+                    if day_sketch is None:
+                        day_sketch = merged[days[i]] = QuantileSketch()
+                    day_sketch.merge(sketches[i])
+        return sorted(merged.items())
+
+
+def parse_stats(value: str) -> tuple[list, str | None]:
+    """
+    :param value: comma separated stats, e.g. median,p10,p90
+    :return: list of stat names in the order asked, and an error message if any is unknown
+    """
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in STATS]
+    if unknown or not names:
+        return [], f"stats must be a comma separated list of {', '.join(STATS)}"
+    return list(dict.fromkeys(names)), None
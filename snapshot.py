@@ -0,0 +1,178 @@
+"""
+exports the prices, ports and regions tables of the database configured in .env into a snapshot file
+
+    python -m snapshot prices.snapshot
+
+servers started with RATES_ENGINE=snapshot map the file read-only and pick up a rebuilt file without a restart
+"""
+import argparse
+import mmap
+import os
+import struct
+import time
+
+from dotenv import load_dotenv
+
+from columnar import ColumnarPrices, np
+from database import DB
+
+MAGIC = b'RATESNAP'
+FORMAT_VERSION = 1
+# magic, format version, data version, strings, string bytes, ports, regions, prices
+HEADER = struct.Struct('<8sIqqqqqq')
+ALIGNMENT = 8
+
+
+def _sections(header: tuple) -> list:
+    """
+    :return: list of (name, dtype, length) of the arrays following the header, in file order
+    """
+    _, _, _, strings, string_bytes, ports, regions, prices = header
+    return [('string_offsets', '<i8', strings + 1), ('string_bytes', 'u1', string_bytes),
+            ('port_codes', '<i4', ports), ('port_parents', '<i4', ports),
+            ('region_slugs', '<i4', regions), ('region_parents', '<i4', regions),
+            ('origin', '<i4', prices), ('destination', '<i4', prices), ('day', '<i4', prices), ('price', '<i8', prices)]
+
+
+def _padding(offset: int) -> int:
+    return -offset % ALIGNMENT
+
+
+def write_snapshot(path: str, db: DB, chunk_size: int = 100000) -> dict:
+    """
+    writes a snapshot of the database to path, replacing any previous snapshot at once
+
+    every code and slug is stored once in a string dictionary and referred to by its index,
+    prices are fixed width origin, destination, day ordinal and price arrays sorted by day
+    :return: dictionary of {data_version, ports, regions, prices}
+    """
+    data_version = db.get_data_version()
+    ports, regions = db.get_ports(), db.get_regions()
+    prices = ColumnarPrices(db, chunk_size)
+    port_ids, origin, destination, day, price = prices._columns
+
+    # price port ids are the first entries of the dictionary, so the price arrays are written as they are
+    strings = dict(port_ids)
+    for name in [code for code, _ in ports] + [slug for slug, _ in regions]:
+        strings.setdefault(name, len(strings))
+    encoded = [string.encode() for string in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+
+    def ids(names) -> 'np.ndarray':
+        return np.array([-1 if name is None else strings[name] for name in names], dtype='<i4')
+
+    header = (MAGIC, FORMAT_VERSION, data_version, len(encoded), int(string_offsets[-1]), len(ports), len(regions),
+              len(day))
+    arrays = {'string_offsets': string_offsets, 'string_bytes': np.frombuffer(b''.join(encoded), dtype='u1'),
+              'port_codes': ids(code for code, _ in ports), 'port_parents': ids(parent for _, parent in ports),
+              'region_slugs': ids(slug for slug, _ in regions), 'region_parents': ids(parent for _, parent in regions),
+              'origin': origin, 'destination': destination, 'day': day, 'price': price}
+
+    # written next to the snapshot and renamed over it, so servers never map a partly written file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'wb') as f:
+        f.write(HEADER.pack(*header))
+        f.write(b'\0' * _padding(HEADER.size))
+        for name, dtype, _ in _sections(header):
+            data = arrays[name].astype(dtype, copy=False).tobytes()
+            f.write(data + b'\0' * _padding(len(data)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+    return {"data_version": data_version, "ports": len(ports), "regions": len(regions), "prices": len(day)}
+
+
+class Snapshot:
+    """
+    snapshot file mapped read-only, its arrays are views of the mapping rather than copies
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.file_id = os.fstat(f.fileno()).st_ino
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self._map)
+        if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} rates snapshot")
+        self.data_version = header[2]
+
+        arrays = {}
+        offset = HEADER.size + _padding(HEADER.size)
+        for name, dtype, length in _sections(header):
+            arrays[name] = np.frombuffer(self._map, dtype=dtype, count=length, offset=offset)
+            offset += arrays[name].nbytes + _padding(arrays[name].nbytes)
+        self.arrays = arrays
+
+        string_bytes, string_offsets = bytes(arrays['string_bytes']), arrays['string_offsets'].tolist()
+        self.strings = [string_bytes[string_offsets[i]:string_offsets[i + 1]].decode()
+                        for i in range(len(string_offsets) - 1)]
+
+    def _names(self, ids: 'np.ndarray') -> list:
+        return [None if i < 0 else self.strings[i] for i in ids.tolist()]
+
+    def get_ports(self) -> [tuple]:
+        return list(zip(self._names(self.arrays['port_codes']), self._names(self.arrays['port_parents'])))
+
+    def get_regions(self) -> [tuple]:
+        return list(zip(self._names(self.arrays['region_slugs']), self._names(self.arrays['region_parents'])))
+
+
+class SnapshotPrices(ColumnarPrices):
+    """
+    columnar engine answering price queries from a mapped snapshot file instead of arrays of its own,
+    so every process serving from the same file shares one copy of the prices in the page cache
+
+    also answers the ports, regions and data version queries, so the catalog and data version can follow the snapshot
+    """
+
+    def __init__(self, path: str):
+        if np is None:
+            raise RuntimeError("the snapshot engine requires numpy, install it with `pip install numpy`")
+        self.path = path
+        self.snapshot = None
+        self._columns = self._empty_columns({})
+        self.reload()
+
+    def reload(self):
+        """
+        maps the snapshot file again if it was replaced since it was mapped
+        the previous mapping is left to be closed once the queries still reading it are done
+        """
+        if self.snapshot is not None and os.stat(self.path).st_ino == self.snapshot.file_id:
+            return
+        snapshot = Snapshot(self.path)
+        arrays = snapshot.arrays
+        self._columns = ({string: i for i, string in enumerate(snapshot.strings)},
+                         arrays['origin'], arrays['destination'], arrays['day'], arrays['price'])
+        self.snapshot = snapshot
+
+    def get_data_version(self) -> int:
+        self.reload()
+        return self.snapshot.data_version
+
+    def get_ports(self) -> [tuple]:
+        return self.snapshot.get_ports()
+
+    def get_regions(self) -> [tuple]:
+        return self.snapshot.get_regions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="snapshot file to write")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = DB(os.environ['DB_HOST'], os.environ['DB_DATABASE'], os.environ['DB_USER'], os.environ['DB_PASSWORD'])
+    started = time.perf_counter()
+    try:
+        stats = write_snapshot(args.path, db)
+    finally:
+        db.close()
+    print(f"wrote {stats['prices']} prices, {stats['ports']} ports and {stats['regions']} regions "
+          f"at data version {stats['data_version']} to {args.path} in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+from admission import CostBudget, OverBudget, QueryTooExpensive, query_cost
+
+
+class TestCostBudget(unittest.TestCase):
+
+    def test_query_cost(self):
+        # act / assert
+        self.assertEqual(query_cost(10, ["ABCDE", "FGHIJ"], ("VWXYZ", "PQRST", "KLMNO")), 60)
+        self.assertEqual(query_cost(-3, ["ABCDE", "FGHIJ"], ("VWXYZ", "PQRST", "KLMNO")), 0)
+
+    def test_over_ceiling_rejected(self):
+        # arrange
+        budget = CostBudget(max_cost=100)
+
+        # act / assert
+        with self.assertRaises(QueryTooExpensive):
+            with budget.admit(101):
+                pass
+        self.assertEqual(budget.stats()["rejected"], 1)
+
+    def test_checked_total_admitted_over_ceiling(self):
+        # arrange
+        budget = CostBudget(max_cost=100)
+
+        # act
+        budget.check(60)
+        budget.check(60)
+        with budget.admit(120, ceiling=False):
+            in_flight = budget.stats()["in_flight_cost"]
+
+        # assert
+        self.assertEqual(in_flight, 120)
+        self.assertEqual(budget.stats()["rejected"], 0)
+
+    def test_over_budget_admitted_when_idle(self):
+        # arrange
+        budget = CostBudget(budget=10)
+
+        # act
+        with budget.admit(50):
+            in_flight = budget.stats()["in_flight_cost"]
+
+        # assert
+        self.assertEqual(in_flight, 50)
+        self.assertEqual(budget.stats()["in_flight_cost"], 0)
+
+    def test_shed_after_queue_timeout(self):
+        # arrange
+        budget = CostBudget(budget=10, queue_timeout=0.01)
+
+        # act
+        with budget.admit(8):
+            with self.assertRaises(OverBudget):
+                with budget.admit(5):
+                    pass
+            with budget.admit(2):
+                pass
+
+        # assert
+        self.assertEqual(budget.stats(), {"in_flight_cost": 0, "admitted": 2, "queued": 1, "rejected": 0, "shed": 1})
+
+    def test_queued_until_budget_frees(self):
+        # arrange
+        budget = CostBudget(budget=10, queue_timeout=5)
+        admitted = threading.Event()
+
+        def expensive():
+            with budget.admit(5):
+                admitted.set()
+
+        # act
+        with budget.admit(8):
+            thread = threading.Thread(target=expensive)
+            thread.start()
+            queued = admitted.wait(0.05)
+        thread.join(5)
+
+        # assert
+        self.assertFalse(queued)
+        self.assertTrue(admitted.is_set())
+        self.assertEqual(budget.stats()["queued"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+from asgi import AsgiAdapter
+
+
+def http_scope(path: str, query_string: bytes = b'', method: str = 'GET', headers: list = ()) -> dict:
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': query_string, 'headers': list(headers),
+            'http_version': '1.1', 'scheme': 'http', 'server': ('localhost', 8080), 'client': ('127.0.0.1', 5000)}
+
+
+def run_asgi(adapter: AsgiAdapter, scope: dict, messages: list) -> list:
+    """
+    runs one ASGI call, feeding it the messages and collecting what it sends
+    """
+    received = iter(messages)
+    sent = []
+
+    async def receive():
+        return next(received)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(adapter(scope, receive, send))
+    return sent
+
+
+class TestAsgiAdapter(unittest.TestCase):
+    def test_request_and_response(self):
+        # arrange
+        def echo(environ, start_response):
+            body = environ['wsgi.input'].read()
+            start_response('201 Created', [('Content-Type', 'application/json')])
+            return [json.dumps({"method": environ['REQUEST_METHOD'], "query": environ['QUERY_STRING'],
+                                "body": body.decode(), "type": environ['CONTENT_TYPE'],
+                                "accept": environ['HTTP_ACCEPT'], "client": environ['REMOTE_ADDR']}).encode()]
+
+        adapter = AsgiAdapter(echo, max_workers=2)
+        scope = http_scope('/rates/batch', b'a=1', 'POST', [(b'content-type', b'application/json'),
+                                                            (b'accept', b'text/plain'), (b'accept', b'*/*')])
+
+        # act
+        sent = run_asgi(adapter, scope, [{'type': 'http.request', 'body': b'[{"ori', 'more_body': True},
+                                         {'type': 'http.request', 'body': b'gin": 1}]', 'more_body': False}])
+
+        # assert
+        self.assertEqual(sent[0], {'type': 'http.response.start', 'status': 201,
+                                   'headers': [(b'content-type', b'application/json')]})
+        self.assertEqual(json.loads(b''.join(message['body'] for message in sent[1:])),
+                         {"method": "POST", "query": "a=1", "body": '[{"origin": 1}]', "type": "application/json",
+                          "accept": "text/plain,*/*", "client": "127.0.0.1"})
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_streamed_response_across_threads(self):
+        # arrange
+        threads = set()
+        closed = MagicMock()
+
+        class Body:
+            def __init__(self):
+                self.lines = iter([b'1\n', b'2\n', b'3\n'])
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                threads.add(threading.get_ident())
+                return next(self.lines)
+
+            def close(self):
+                closed()
+
+        def stream(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+            return Body()
+
+        adapter = AsgiAdapter(stream, max_workers=4)
+
+        # act
+        sent = run_asgi(adapter, http_scope('/rates'), [{'type': 'http.request', 'body': b''}])
+
+        # assert
+        self.assertEqual([message['body'] for message in sent[1:]], [b'1\n', b'2\n', b'3\n', b''])
+        self.assertNotIn(threading.get_ident(), threads)
+        closed.assert_called_once_with()
+
+    def test_app_error(self):
+        # arrange
+        def broken(environ, start_response):
+            raise RuntimeError("broken")
+
+        adapter = AsgiAdapter(broken, max_workers=1)
+
+        sent = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            sent.append(message)
+
+        # act
+        with self.assertRaises(RuntimeError):
+            asyncio.run(adapter(http_scope('/rates'), receive, send))
+
+        # assert
+        self.assertEqual(sent[0]['status'], 500)
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_lifespan(self):
+        # arrange
+        startup, shutdown = MagicMock(), MagicMock()
+        adapter = AsgiAdapter(MagicMock(), max_workers=1, startup=startup, shutdown=shutdown)
+
+        # act
+        sent = run_asgi(adapter, {'type': 'lifespan'}, [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}])
+
+        # assert
+        self.assertEqual([message['type'] for message in sent],
+                         ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        startup.assert_called_once_with()
+        shutdown.assert_called_once_with()
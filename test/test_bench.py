@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import MagicMock
+
+from bench.generate import generate, port_code
+from bench.memory_db import MemoryDB
+from bench.partitions import explain
+from bench.run import split_by_date
+from catalog import Catalog
+
+
+class TestGenerate(unittest.TestCase):
+
+    def test_port_codes_are_unique_uppercase(self):
+        # act
+        codes = [port_code(i) for i in range(1000)]
+
+        # assert
+        self.assertEqual(len(set(codes)), 1000)
+        self.assertTrue(all(code.isupper() and len(code) == 5 for code in codes))
+
+    def test_region_tree(self):
+        # act
+        data = generate(roots=2, depth=3, fan_out=2, ports_per_region=1, lanes=5, days=3, seed=1)
+
+        # assert
+        self.assertEqual(len(data['regions']), 2 * (1 + 2 + 4))
+        self.assertEqual(len(data['ports']), len(data['regions']))
+        catalog = Catalog(MemoryDB(data))
+        self.assertEqual(len(catalog.get_sub_ports('region_0')), 7)
+
+    def test_deterministic(self):
+        # act / assert
+        self.assertEqual(generate(lanes=5, days=3, seed=3), generate(lanes=5, days=3, seed=3))
+
+    def test_split_by_date(self):
+        # arrange
+        data = generate(lanes=5, days=10, seed=4)
+
+        # act
+        shards = split_by_date(data, 3)
+
+        # assert
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(sorted(row for _, _, part in shards for row in part['prices']), sorted(data['prices']))
+        self.assertTrue(all(first <= row[2] <= last for first, last, part in shards for row in part['prices']))
+
+
+class TestPartitions(unittest.TestCase):
+
+    def test_explain(self):
+        # arrange
+        cur = MagicMock()
+        plan = {"Plan": {"Shared Hit Blocks": 12, "Shared Read Blocks": 3,
+                         "Plans": [{"Relation Name": "prices_2016_01"},
+                                   {"Plans": [{"Relation Name": "prices_2016_02"}, {"Relation Name": "prices_2016_02"}]}]},
+                "Planning Time": 0.5, "Execution Time": 1.25}
+        cur.fetchone.return_value = [[plan]]
+
+        # act
+        result = explain(cur, "select 1", {})
+
+        # assert
+        self.assertEqual(result, {"planning_ms": 0.5, "execution_ms": 1.25, "shared_buffers": 15, "partitions": 2})
+        self.assertTrue(cur.execute.call_args[0][0].startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "))
+
+
+if __name__ == '__main__':
+    unittest.main()
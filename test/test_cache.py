@@ -0,0 +1,265 @@
+import threading
+import time
+import unittest
+from datetime import date
+from unittest.mock import patch, MagicMock
+
+from cache import CellCache, DataVersion, LRUCache, SingleFlight
+from database import DB
+from shards import PartialSums
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_hit_and_miss(self):
+        # arrange
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1, ["a result"])
+
+        # act
+        hit = cache.get("a", 1)
+        miss = cache.get("b", 1)
+
+        # assert
+        self.assertEqual(hit, ["a result"])
+        self.assertIsNone(miss)
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "evictions": 0, "size": 1, "max_size": 2})
+
+    def test_least_recently_used_evicted(self):
+        # arrange
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1, "a")
+        cache.set("b", 1, "b")
+        cache.get("a", 1)
+
+        # act
+        cache.set("c", 1, "c")
+
+        # assert
+        self.assertEqual(cache.get("a", 1), "a")
+        self.assertIsNone(cache.get("b", 1))
+        self.assertEqual(cache.get("c", 1), "c")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_expired_entry(self):
+        # arrange
+        cache = LRUCache(max_size=2, ttl=10)
+        with patch('cache.time.monotonic', return_value=100):
+            cache.set("a", 1, "a")
+
+        # act
+        with patch('cache.time.monotonic', return_value=111):
+            res = cache.get("a", 1)
+
+        # assert
+        self.assertIsNone(res)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_other_data_version(self):
+        # arrange
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", 1, "a")
+
+        # act / assert
+        self.assertIsNone(cache.get("a", 2))
+
+
+class TestCellCache(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.prices = {date(2016, 1, day): (100 * day, day) for day in range(1, 32) if day % 5}
+        self.fetch = MagicMock(side_effect=self.expected)
+
+    def expected(self, date_from: str, date_to: str) -> list:
+        return [(day, price_sum, count) for day, (price_sum, count) in sorted(self.prices.items())
+                if date_from <= day.strftime('%Y-%m-%d') <= date_to]
+
+    def test_fetches_whole_range_once(self):
+        # arrange
+        cache = CellCache()
+
+        # act
+        first = cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-10", 1, self.fetch)
+        second = cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-10", 1, self.fetch)
+
+        # assert
+        expected = self.expected("2016-01-01", "2016-01-10")
+        self.assertEqual(first, expected)
+        self.assertEqual(second, expected)
+        self.fetch.assert_called_once_with("2016-01-01", "2016-01-10")
+
+    def test_sliding_window_fetches_only_new_days(self):
+        # arrange
+        cache = CellCache()
+        cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-20", 1, self.fetch)
+        self.fetch.reset_mock()
+
+        # act
+        res = cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-02", "2016-01-21", 1, self.fetch)
+
+        # assert
+        self.fetch.assert_called_once_with("2016-01-21", "2016-01-21")
+        self.assertEqual(res, self.expected("2016-01-02", "2016-01-21"))
+
+    def test_missing_spans_fetched_separately(self):
+        # arrange
+        cache = CellCache()
+        cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-10", "2016-01-12", 1, self.fetch)
+        self.fetch.reset_mock()
+
+        # act
+        res = cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-08", "2016-01-14", 1, self.fetch)
+
+        # assert
+        self.assertEqual(self.fetch.call_args_list, [(("2016-01-08", "2016-01-09"),), (("2016-01-13", "2016-01-14"),)])
+        self.assertEqual(res, self.expected("2016-01-08", "2016-01-14"))
+
+    def test_new_data_version_refetches(self):
+        # arrange
+        cache = CellCache()
+        cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-03", 1, self.fetch)
+        self.fetch.reset_mock()
+
+        # act
+        cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-03", 2, self.fetch)
+
+        # assert
+        self.fetch.assert_called_once_with("2016-01-01", "2016-01-03")
+
+
+    def test_unavailable_days_not_cached(self):
+        # arrange
+        cache = CellCache()
+        rows = self.expected("2016-01-01", "2016-01-05")
+        self.fetch.side_effect = PartialSums(rows, [("2016-01-06", "2016-01-10")])
+        with self.assertRaises(PartialSums) as partial:
+            cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-10", 1, self.fetch)
+        self.fetch.reset_mock()
+        self.fetch.side_effect = self.expected
+
+        # act
+        res = cache.get_daily_sums("ABCDE", "VWXYZ", "2016-01-01", "2016-01-10", 1, self.fetch)
+
+        # assert
+        self.assertEqual(partial.exception.rows, rows)
+        self.assertEqual(partial.exception.missing, [("2016-01-06", "2016-01-10")])
+        self.fetch.assert_called_once_with("2016-01-06", "2016-01-10")
+        self.assertEqual(res, self.expected("2016-01-01", "2016-01-10"))
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_concurrent_callers_share_one_computation(self):
+        # arrange
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        compute = MagicMock(side_effect=lambda: started.set() or release.wait(5) and ["result"])
+        results = []
+        leader = threading.Thread(target=lambda: results.append(single_flight.do("key", compute)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(single_flight.do("key", compute))) for _ in range(3)]
+
+        # act
+        for follower in followers:
+            follower.start()
+        while single_flight.stats()["coalesced"] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        # assert
+        compute.assert_called_once_with()
+        self.assertEqual(results, [["result"]] * 4)
+        self.assertEqual(single_flight.stats(), {"leaders": 1, "coalesced": 3, "in_flight": 0})
+
+    def test_error_shared_and_key_released(self):
+        # arrange
+        single_flight = SingleFlight()
+
+        # act
+        with self.assertRaises(ValueError):
+            single_flight.do("key", MagicMock(side_effect=ValueError))
+        result = single_flight.do("key", lambda: "recomputed")
+
+        # assert
+        self.assertEqual(result, "recomputed")
+        self.assertEqual(single_flight.stats()["leaders"], 2)
+
+
+class TestDataVersion(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.mock_db = DB.__new__(DB)
+        self.mock_db.get_data_version = MagicMock(return_value=1)
+
+    def test_polls_after_interval(self):
+        # arrange
+        with patch('cache.time.monotonic', return_value=100):
+            data_version = DataVersion(self.mock_db, poll_interval=1)
+        listener = MagicMock()
+        data_version.on_change(listener)
+        self.mock_db.get_data_version = MagicMock(return_value=2)
+
+        # act
+        with patch('cache.time.monotonic', return_value=100.5):
+            before_interval = data_version.current()
+        with patch('cache.time.monotonic', return_value=102):
+            data_version.current()
+        data_version.wait(5)
+        after_interval = data_version.current()
+
+        # assert
+        self.assertEqual(before_interval, 1)
+        self.assertEqual(after_interval, 2)
+        listener.assert_called_once_with()
+
+    def test_listeners_run_in_background(self):
+        # arrange
+        data_version = DataVersion(self.mock_db, poll_interval=0)
+        reloading, release = threading.Event(), threading.Event()
+        data_version.on_change(lambda: (reloading.set(), release.wait(5)))
+        self.mock_db.get_data_version = MagicMock(return_value=2)
+
+        # act
+        polled = data_version.current()
+        reloading.wait(5)
+        during_reload = [data_version.current() for _ in range(3)]
+        release.set()
+        data_version.wait(5)
+
+        # assert
+        self.assertEqual(polled, 1)
+        self.assertEqual(during_reload, [1, 1, 1])
+        self.assertEqual(data_version.current(), 2)
+        # no polls while the listeners run
+        self.assertEqual(self.mock_db.get_data_version.call_count, 2)
+
+    def test_failed_listener_keeps_version(self):
+        # arrange
+        data_version = DataVersion(self.mock_db, poll_interval=1)
+        data_version.on_change(MagicMock(side_effect=RuntimeError("reload failed")))
+        self.mock_db.get_data_version = MagicMock(return_value=2)
+
+        # act
+        with self.assertLogs('cache', 'ERROR'):
+            version = data_version.refresh(wait=True)
+
+        # assert
+        self.assertEqual(version, 1)
+
+    def test_listeners_not_called_without_change(self):
+        # arrange
+        data_version = DataVersion(self.mock_db, poll_interval=1)
+        listener = MagicMock()
+        data_version.on_change(listener)
+
+        # act
+        data_version.refresh()
+
+        # assert
+        listener.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import random
+import unittest
+from datetime import date, timedelta
+from unittest.mock import MagicMock
+
+from columnar import ColumnarPrices, np
+from database import DB
+
+
+def sql_price_sums(rows: list, origin_ports, destination_ports, date_from: str, date_to: str) -> list:
+    """
+    reference implementation of DB.get_price_sums over raw price rows
+    """
+    sums = {}
+    for org, dest, day, price in rows:
+        if org in origin_ports and dest in destination_ports and date_from <= day.strftime('%Y-%m-%d') <= date_to:
+            price_sum, count = sums.get(day, (0, 0))
+            sums[day] = (price_sum + price, count + 1)
+    return [(day, price_sum, count) for day, (price_sum, count) in sorted(sums.items())]
+
+
+def create_engine(rows: list, chunk_size: int = 7) -> ColumnarPrices:
+    mock_db = DB.__new__(DB)
+    mock_db.iter_prices = MagicMock(side_effect=lambda size: (rows[i:i + size] for i in range(0, len(rows), size)))
+    return ColumnarPrices(mock_db, chunk_size=chunk_size)
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestColumnarPrices(unittest.TestCase):
+
+    def test_sums_prices_per_day(self):
+        # arrange
+        rows = [("ABCDE", "VWXYZ", date(2016, 1, 2), 456),
+                ("ABCDE", "VWXYZ", date(2016, 1, 1), 121),
+                ("ABCDE", "VWXYZ", date(2016, 1, 1), 122),
+                ("ABCDE", "LMNOP", date(2016, 1, 1), 999),
+                ("LMNOP", "VWXYZ", date(2016, 1, 1), 999),
+                ("ABCDE", "VWXYZ", date(2016, 1, 4), 789)]
+
+        # act
+        res = create_engine(rows).get_price_sums(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-03")
+
+        # assert
+        expected = [(date(2016, 1, 1), 243, 2), (date(2016, 1, 2), 456, 1)]
+        self.assertEqual(res, expected)
+
+    def test_unknown_ports_and_empty_table(self):
+        # arrange
+        rows = [("ABCDE", "VWXYZ", date(2016, 1, 1), 121)]
+
+        # act / assert
+        self.assertEqual(create_engine(rows).get_price_sums(["QQQQQ"], ["VWXYZ"], "2016-01-01", "2016-01-03"), [])
+        self.assertEqual(create_engine([]).get_price_sums(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-03"), [])
+
+    def test_parity_with_sql_path(self):
+        # arrange
+        rand = random.Random(42)
+        ports = [f"P{i:04d}" for i in range(20)]
+        start = date(2016, 1, 1)
+        rows = [(rand.choice(ports), rand.choice(ports), start + timedelta(days=rand.randrange(60)),
+                 rand.randrange(100, 3000)) for _ in range(5000)]
+        engine = create_engine(rows, chunk_size=1000)
+
+        for _ in range(50):
+            origin_ports = rand.sample(ports, rand.randrange(1, 8))
+            destination_ports = rand.sample(ports, rand.randrange(1, 8))
+            date_from = start + timedelta(days=rand.randrange(-5, 60))
+            date_to = date_from + timedelta(days=rand.randrange(0, 40))
+            date_from, date_to = date_from.strftime('%Y-%m-%d'), date_to.strftime('%Y-%m-%d')
+
+            # act
+            res = engine.get_price_sums(origin_ports, destination_ports, date_from, date_to)
+
+            # assert
+            expected = sql_price_sums(rows, origin_ports, destination_ports, date_from, date_to)
+            self.assertEqual(res, expected)
+
+    def test_port_pair_sums_parity_with_sql_path(self):
+        # arrange
+        rand = random.Random(7)
+        ports = [f"P{i:04d}" for i in range(10)]
+        start = date(2016, 1, 1)
+        rows = [(rand.choice(ports), rand.choice(ports), start + timedelta(days=rand.randrange(20)),
+                 rand.randrange(100, 3000)) for _ in range(2000)]
+        engine = create_engine(rows, chunk_size=500)
+        origin_ports, destination_ports = ports[:4], ports[3:8]
+
+        # act
+        res = engine.get_port_pair_sums(origin_ports, destination_ports, "2016-01-05", "2016-01-15")
+
+        # assert
+        expected = {}
+        for org, dest, day, price in rows:
+            if org in origin_ports and dest in destination_ports and date(2016, 1, 5) <= day <= date(2016, 1, 15):
+                price_sum, count = expected.get((org, dest, day), (0, 0))
+                expected[(org, dest, day)] = (price_sum + price, count + 1)
+        self.assertEqual(sorted(res), sorted((*key, *value) for key, value in expected.items()))
+        self.assertEqual([row[2] for row in res], sorted(row[2] for row in res))
+
+    def test_reload_picks_up_new_prices(self):
+        # arrange
+        rows = [("ABCDE", "VWXYZ", date(2016, 1, 1), 121)]
+        engine = create_engine(rows)
+        rows.append(("ABCDE", "VWXYZ", date(2016, 1, 1), 123))
+
+        # act
+        engine.reload()
+
+        # assert
+        self.assertEqual(engine.get_price_sums(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-01"),
+                         [(date(2016, 1, 1), 244, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
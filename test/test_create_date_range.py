@@ -38,5 +38,22 @@ class TestCreateDateRange(unittest.TestCase):
         self.assertEqual(res['value'], self.error("date_to"))
 
 
+    def test_week_buckets(self):
+        # act
+        res = create_date_range("2016-01-01", "2016-01-20", "week")
+
+        # assert
+        self.assertFalse(res['error'])
+        self.assertEqual(res['value'], [datetime(2016, 1, 1), datetime(2016, 1, 4), datetime(2016, 1, 11),
+                                        datetime(2016, 1, 18)])
+
+    def test_month_buckets(self):
+        # act
+        res = create_date_range("2016-01-15", "2016-03-01", "month")
+
+        # assert
+        self.assertFalse(res['error'])
+        self.assertEqual(res['value'], [datetime(2016, 1, 15), datetime(2016, 2, 1), datetime(2016, 3, 1)])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,233 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+
+import psycopg2
+
+from database import DB, PoolTimeout
+
+# other test modules stub out DB.__init__, keep the real one to build pooled instances
+db_init = DB.__init__
+
+
+def mock_connection(closed=0):
+    conn = MagicMock()
+    conn.closed = closed
+    conn.autocommit = True
+    return conn
+
+
+@patch('database.ThreadedConnectionPool')
+class TestDBPool(unittest.TestCase):
+
+    def create_db(self, max_connections=2, timeout=0.01) -> DB:
+        db = DB.__new__(DB)
+        db_init(db, "host", "database", "user", "password", 1, max_connections, timeout)
+        return db
+
+    def test_connection_returned_to_pool(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+
+        # act
+        with db.connection() as checked_out:
+            pass
+
+        # assert
+        self.assertIs(checked_out, conn)
+        mock_pool.return_value.putconn.assert_called_once_with(conn, close=False)
+
+    def test_nested_checkout_reuses_connection(self, mock_pool):
+        # arrange
+        mock_pool.return_value.getconn.side_effect = [mock_connection(), mock_connection()]
+        db = self.create_db()
+
+        # act
+        with db.connection() as outer:
+            with db.connection() as inner:
+                pass
+
+        # assert
+        self.assertIs(outer, inner)
+        mock_pool.return_value.getconn.assert_called_once()
+
+    def test_checkout_timeout(self, mock_pool):
+        # arrange
+        mock_pool.return_value.getconn.return_value = mock_connection()
+        db = self.create_db(max_connections=1)
+        db._slots.acquire()
+
+        # act / assert
+        with self.assertRaises(PoolTimeout):
+            with db.connection():
+                pass
+
+    def test_closed_connection_replaced(self, mock_pool):
+        # arrange
+        closed, healthy = mock_connection(closed=1), mock_connection()
+        mock_pool.return_value.getconn.side_effect = [closed, healthy]
+        db = self.create_db()
+
+        # act
+        with db.connection() as conn:
+            pass
+
+        # assert
+        self.assertIs(conn, healthy)
+        mock_pool.return_value.putconn.assert_any_call(closed, close=True)
+
+    def test_dropped_connection_replaced(self, mock_pool):
+        # arrange
+        dropped, healthy = mock_connection(), mock_connection()
+        dropped.cursor.return_value.execute.side_effect = psycopg2.OperationalError
+        mock_pool.return_value.getconn.side_effect = [dropped, healthy]
+        db = self.create_db()
+
+        # act
+        with db.connection() as conn:
+            pass
+
+        # assert
+        self.assertIs(conn, healthy)
+        mock_pool.return_value.putconn.assert_any_call(dropped, close=True)
+
+    def test_every_dropped_connection_replaced(self, mock_pool):
+        # arrange
+        dropped = [mock_connection(), mock_connection()]
+        for conn in dropped:
+            conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError
+        reconnected = mock_connection()
+        mock_pool.return_value.getconn.side_effect = dropped + [reconnected]
+        db = self.create_db(max_connections=2)
+
+        # act
+        with db.connection() as conn:
+            pass
+
+        # assert
+        self.assertIs(conn, reconnected)
+        self.assertEqual(mock_pool.return_value.putconn.call_args_list[:2],
+                         [((conn, ), {"close": True}) for conn in dropped])
+
+    def test_connection_discarded_after_operational_error(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+
+        # act
+        with self.assertRaises(psycopg2.OperationalError):
+            with db.connection():
+                raise psycopg2.OperationalError()
+
+        # assert
+        mock_pool.return_value.putconn.assert_called_once_with(conn, close=True)
+        self.assertTrue(db._slots.acquire(blocking=False))
+
+    def test_copy_prices_in_chunks(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+        rows = [("ABCDE", "VWXYZ", "2016-01-0" + str(day), 100 + day) for day in range(1, 6)]
+
+        # act
+        count = db.copy_prices(rows, chunk_size=2)
+
+        # assert
+        self.assertEqual(count, 5)
+        copies = conn.cursor.return_value.copy_expert.call_args_list
+        self.assertEqual([len(buffer.getvalue().splitlines()) for (_, buffer), _ in copies], [2, 2, 1])
+        self.assertEqual(copies[0][0][1].getvalue().splitlines()[0], "ABCDE\tVWXYZ\t2016-01-01\t101")
+        conn.commit.assert_called_once_with()
+
+    def test_copy_prices_creates_month_partitions(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        conn.cursor.return_value.fetchone.return_value = (True,)
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+        rows = [("ABCDE", "VWXYZ", day, 100) for day in ["2016-01-31", "2016-03-01", "2016-01-01", "2016-06-15"]]
+
+        # act
+        db.copy_prices(rows, chunk_size=2)
+
+        # assert
+        partitions = [args for (sql, *args), _ in conn.cursor.return_value.execute.call_args_list
+                      if "create_price_partitions(" in sql]
+        self.assertEqual(partitions, [[("2016-01-01", "2016-03-01")], [("2016-06-01", "2016-06-01")]])
+
+    def test_nested_transaction_joins_outer(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+
+        # act
+        with db.transaction():
+            with db.transaction():
+                pass
+
+        # assert
+        conn.commit.assert_called_once_with()
+        self.assertTrue(conn.autocommit)
+
+    def test_generator_connection_not_shared(self, mock_pool):
+        # arrange
+        streamed, other = mock_connection(), mock_connection()
+        streamed.cursor.return_value.fetchmany.side_effect = [[("ABCDE", "VWXYZ", "2016-01-01", 100)], []]
+        mock_pool.return_value.getconn.side_effect = [streamed, other]
+        db = self.create_db()
+
+        # act
+        rows = db.iter_prices()
+        first = next(rows)
+        with db.connection() as conn:
+            pass
+        # the generator finishes on another thread, as when a response is streamed from an executor
+        with ThreadPoolExecutor(1) as executor:
+            rest = executor.submit(list, rows).result()
+
+        # assert
+        self.assertEqual(first, [("ABCDE", "VWXYZ", "2016-01-01", 100)])
+        self.assertEqual(rest, [])
+        self.assertIs(conn, other)
+        self.assertIsNone(getattr(db._local, 'conn', None))
+        self.assertEqual([args[0] for args, _ in mock_pool.return_value.putconn.call_args_list], [other, streamed])
+        streamed.commit.assert_called_once_with()
+
+
+    def test_connection_timeouts(self, mock_pool):
+        # act
+        db = DB.__new__(DB)
+        db_init(db, "host", "database", "user", "password", 1, 2, 0.01, 5433, connect_timeout=2.5, statement_timeout=2.5)
+
+        # assert
+        kwargs = mock_pool.call_args.kwargs
+        self.assertEqual(kwargs["connect_timeout"], 3)
+        self.assertEqual(kwargs["options"], "-c statement_timeout=2500")
+
+    def test_closed_generator_rolls_back(self, mock_pool):
+        # arrange
+        conn = mock_connection()
+        conn.cursor.return_value.__iter__.return_value = iter([("2016-01-01", 300, 3), ("2016-01-02", 400, 4)])
+        mock_pool.return_value.getconn.return_value = conn
+        db = self.create_db()
+
+        # act
+        rows = db.iter_price_sums(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-02")
+        first = next(rows)
+        rows.close()
+
+        # assert
+        self.assertEqual(first, ("2016-01-01", 300, 3))
+        conn.rollback.assert_called_once_with()
+        conn.commit.assert_not_called()
+        self.assertTrue(conn.autocommit)
+        mock_pool.return_value.putconn.assert_called_once_with(conn, close=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,13 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import MagicMock
 
-from server import get_sub_ports
+from catalog import Catalog
 from database import DB
 
 DB.__init__ = lambda x: None
 mock_db = DB()
 
 
-@patch('server.db', mock_db)
 class TestGetSubPorts(unittest.TestCase):
 
     def test_one_port_in_region(self):
@@ -16,28 +15,28 @@ class TestGetSubPorts(unittest.TestCase):
         region = 'a_region'
         port = "ABCDE"
 
-        mock_db.get_child_port_codes = MagicMock(return_value=[port])
-        mock_db.get_child_region_slugs = MagicMock(return_value=[])
+        mock_db.get_ports = MagicMock(return_value=[(port, region)])
+        mock_db.get_regions = MagicMock(return_value=[(region, None)])
 
         # act
-        res = get_sub_ports(region)
+        res = Catalog(mock_db).get_sub_ports(region)
 
         # assert
-        self.assertEqual(res, [port])
+        self.assertEqual(list(res), [port])
 
     def test_multiple_ports_in_region(self):
         # arrange
         region = 'a_region'
         ports = ["ABCDE", "DEFGH"]
 
-        mock_db.get_child_port_codes = MagicMock(return_value=ports)
-        mock_db.get_child_region_slugs = MagicMock(return_value=[])
+        mock_db.get_ports = MagicMock(return_value=[(port, region) for port in ports])
+        mock_db.get_regions = MagicMock(return_value=[(region, None)])
 
         # act
-        res = get_sub_ports(region)
+        res = Catalog(mock_db).get_sub_ports(region)
 
         # assert
-        self.assertEqual(res, ports)
+        self.assertEqual(list(res), ports)
 
     def test_sub_region_in_region(self):
         # arrange
@@ -46,83 +45,71 @@ class TestGetSubPorts(unittest.TestCase):
         a_ports = ["A1111", "A2222"]
         b_ports = ['B1111']
 
-        def child_ports_func(region):
-            match region:
-                case 'a_region':
-                    return a_ports
-                case 'b_region':
-                    return b_ports
-
-        def child_regions_func(region):
-            match region:
-                case 'a_region':
-                    return [sub_region]
-                case 'b_region':
-                    return []
-
-        mock_db.get_child_port_codes = MagicMock(side_effect=child_ports_func)
-        mock_db.get_child_region_slugs = MagicMock(side_effect=child_regions_func)
+        mock_db.get_ports = MagicMock(return_value=[(port, region) for port in a_ports] +
+                                                   [(port, sub_region) for port in b_ports])
+        mock_db.get_regions = MagicMock(return_value=[(region, None), (sub_region, region)])
 
         # act
-        res = get_sub_ports(region)
+        catalog = Catalog(mock_db)
 
         # assert
-        self.assertEqual(res, a_ports + b_ports)
+        self.assertEqual(list(catalog.get_sub_ports(region)), a_ports + b_ports)
+        self.assertEqual(list(catalog.get_sub_ports(sub_region)), b_ports)
 
     def test_multi_sub_regions_in_region(self):
         # arrange
         region = 'a_region'
-        a_sub_regions = ['b_region', 'c_region']
-        b_sub_regions = ['d_region', 'e_region']
-        c_sub_regions = ['f_region']
-        d_sub_regions = []
-        e_sub_regions = []
-        f_sub_regions = []
+        regions = [('a_region', None),
+                   ('b_region', 'a_region'), ('c_region', 'a_region'),
+                   ('d_region', 'b_region'), ('e_region', 'b_region'),
+                   ('f_region', 'c_region')]
         a_ports = ["A1111", "A2222"]
         b_ports = ['B1111']
         c_ports = ['C1111', 'C2222', 'C3333']
         d_ports = ['D1111']
         e_ports = ['E1111']
         f_ports = ['F1111']
+        ports = [(port, 'f_region') for port in f_ports] + [(port, 'e_region') for port in e_ports] + \
+                [(port, 'd_region') for port in d_ports] + [(port, 'c_region') for port in c_ports] + \
+                [(port, 'b_region') for port in b_ports] + [(port, 'a_region') for port in a_ports]
+
+        mock_db.get_ports = MagicMock(return_value=ports)
+        mock_db.get_regions = MagicMock(return_value=regions)
+
+        # act
+        res = Catalog(mock_db).get_sub_ports(region)
+
+        # assert
+        self.assertEqual(list(res), a_ports + b_ports + c_ports + d_ports + e_ports + f_ports)
 
-        def child_ports_func(region):
-            match region:
-                case 'a_region':
-                    return a_ports
-                case 'b_region':
-                    return b_ports
-                case 'c_region':
-                    return c_ports
-                case 'd_region':
-                    return d_ports
-                case 'e_region':
-                    return e_ports
-                case 'f_region':
-                    return f_ports
-
-        def child_regions_func(region):
-            match region:
-                case 'a_region':
-                    return a_sub_regions
-                case 'b_region':
-                    return b_sub_regions
-                case 'c_region':
-                    return c_sub_regions
-                case 'd_region':
-                    return d_sub_regions
-                case 'e_region':
-                    return e_sub_regions
-                case 'f_region':
-                    return f_sub_regions
-
-        mock_db.get_child_port_codes = MagicMock(side_effect=child_ports_func)
-        mock_db.get_child_region_slugs = MagicMock(side_effect=child_regions_func)
+    def test_unknown_region(self):
+        # arrange
+        mock_db.get_ports = MagicMock(return_value=[("ABCDE", 'a_region')])
+        mock_db.get_regions = MagicMock(return_value=[('a_region', None)])
+
+        # act
+        catalog = Catalog(mock_db)
+
+        # assert
+        self.assertEqual(catalog.get_sub_ports('b_region'), ())
+        self.assertFalse(catalog.has_region('b_region'))
+        self.assertTrue(catalog.has_port("ABCDE"))
+        self.assertFalse(catalog.has_port("VWXYZ"))
+
+    def test_reload_picks_up_changes(self):
+        # arrange
+        region = 'a_region'
+        mock_db.get_ports = MagicMock(return_value=[("ABCDE", region)])
+        mock_db.get_regions = MagicMock(return_value=[(region, None)])
+        catalog = Catalog(mock_db)
+        mock_db.get_ports = MagicMock(return_value=[("ABCDE", region), ("VWXYZ", region)])
 
         # act
-        res = get_sub_ports(region)
+        catalog.reload()
 
         # assert
-        self.assertEqual(res, a_ports + b_ports + c_ports + d_ports + e_ports + f_ports)
+        self.assertEqual(list(catalog.get_sub_ports(region)), ["ABCDE", "VWXYZ"])
+        self.assertTrue(catalog.has_port("VWXYZ"))
 
 
 if __name__ == '__main__':
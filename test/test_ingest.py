@@ -0,0 +1,74 @@
+import unittest
+from datetime import date
+from unittest.mock import MagicMock
+
+from catalog import Catalog
+from database import DB
+from ingest import IngestError, load_prices, read_csv, read_ndjson, validate
+
+
+def create_catalog() -> Catalog:
+    mock_db = DB.__new__(DB)
+    mock_db.get_ports = MagicMock(return_value=[("ABCDE", "a_region"), ("VWXYZ", "a_region")])
+    mock_db.get_regions = MagicMock(return_value=[("a_region", None)])
+    return Catalog(mock_db)
+
+
+class TestIngest(unittest.TestCase):
+
+    def test_read_csv(self):
+        # arrange
+        lines = ["orig_code,dest_code,day,price\n", "ABCDE,VWXYZ,2016-01-01,121\n", "\n", "VWXYZ,ABCDE,2016-01-02,122\n"]
+
+        # act
+        res = list(read_csv(lines))
+
+        # assert
+        self.assertEqual(res, [(2, ["ABCDE", "VWXYZ", "2016-01-01", "121"]), (4, ["VWXYZ", "ABCDE", "2016-01-02", "122"])])
+
+    def test_read_ndjson(self):
+        # arrange
+        lines = ['{"orig_code": "ABCDE", "dest_code": "VWXYZ", "day": "2016-01-01", "price": 121}\n']
+
+        # act
+        res = list(read_ndjson(lines))
+
+        # assert
+        self.assertEqual(res, [(1, ["ABCDE", "VWXYZ", "2016-01-01", 121])])
+
+    def test_validate(self):
+        # arrange
+        catalog = create_catalog()
+        rows = [(1, ["ABCDE", "VWXYZ", "2016-01-01", "121"])]
+        bad_rows = [((2, ["ABCDE", "QQQQQ", "2016-01-01", "121"]), "line 2: unknown destination port QQQQQ"),
+                    ((3, ["QQQQQ", "VWXYZ", "2016-01-01", "121"]), "line 3: unknown origin port QQQQQ"),
+                    ((4, ["ABCDE", "VWXYZ", "2016-0101", "121"]), "line 4: day must be formatted YYYY-MM-DD and price an integer"),
+                    ((5, ["ABCDE", "VWXYZ", "2016-01-01"]), "line 5: expected 4 fields, got 3")]
+
+        # act
+        res = list(validate(rows, catalog))
+
+        # assert
+        self.assertEqual(res, [("ABCDE", "VWXYZ", date(2016, 1, 1), 121)])
+        for row, error in bad_rows:
+            with self.assertRaises(IngestError) as e:
+                list(validate([row], catalog))
+            self.assertEqual(str(e.exception), error)
+
+    def test_load_prices(self):
+        # arrange
+        mock_db = DB.__new__(DB)
+        mock_db.copy_prices = MagicMock(side_effect=lambda rows, chunk_size: len(list(rows)))
+        data_version = MagicMock()
+        rows = [(1, ["ABCDE", "VWXYZ", "2016-01-01", "121"]), (2, ["VWXYZ", "ABCDE", "2016-01-01", "122"])]
+
+        # act
+        stats = load_prices(mock_db, create_catalog(), rows, chunk_size=1, data_version=data_version)
+
+        # assert
+        self.assertEqual(stats["rows"], 2)
+        data_version.refresh.assert_called_once_with(wait=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
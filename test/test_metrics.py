@@ -0,0 +1,68 @@
+import unittest
+
+import metrics
+from metrics import Counter, Histogram, instrumented
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_render(self):
+        # arrange
+        histogram = Histogram('test_seconds', "test", buckets=(0.1, 1.0))
+        histogram.observe(0.05, (('method', 'a'),))
+        histogram.observe(0.5, (('method', 'a'),))
+
+        # act
+        res = histogram.render()
+
+        # assert
+        self.assertEqual(res, ['# HELP test_seconds test', '# TYPE test_seconds histogram',
+                               'test_seconds_bucket{method="a",le="0.1"} 1',
+                               'test_seconds_bucket{method="a",le="1.0"} 2',
+                               'test_seconds_bucket{method="a",le="+Inf"} 2',
+                               'test_seconds_sum{method="a"} 0.55',
+                               'test_seconds_count{method="a"} 2'])
+
+    def test_counter_render(self):
+        # arrange
+        counter = Counter('test_total', "test")
+        counter.inc(amount=3)
+
+        # act / assert
+        self.assertEqual(counter.render(), ['# HELP test_total test', '# TYPE test_total counter', 'test_total 3'])
+
+    def test_instrumented_records_queries_in_trace(self):
+        # arrange
+        @instrumented
+        def get_rows():
+            return [1, 2, 3]
+
+        @instrumented
+        def iter_rows():
+            yield [1, 2]
+            yield [3]
+
+        # act
+        trace = metrics.start_trace()
+        get_rows()
+        list(iter_rows())
+        metrics.end_trace()
+
+        # assert
+        self.assertEqual([(query["method"], query["rows"]) for query in trace["queries"]],
+                         [("get_rows", 3), ("iter_rows", 3)])
+        self.assertIsNone(metrics.current_trace())
+
+    def test_phase_recorded_in_trace(self):
+        # act
+        trace = metrics.start_trace()
+        with metrics.phase('resolve'):
+            pass
+        metrics.end_trace()
+
+        # assert
+        self.assertIn('resolve', trace["phases"])
+
+
+if __name__ == '__main__':
+    unittest.main()
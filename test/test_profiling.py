@@ -0,0 +1,67 @@
+import unittest
+
+from profiling import Profiles, collapsed_stacks
+
+
+def work(n: int) -> int:
+    return sum(i * i for i in range(n))
+
+
+class TestProfiling(unittest.TestCase):
+    def test_ring_buffer(self):
+        # arrange
+        profiles = Profiles(size=2)
+        trace = {"phases": {"prices": 0.01}, "queries": [{"method": "get_price_sums", "seconds": 0.01, "rows": 3}]}
+
+        # act
+        ids = []
+        for path in ['/a', '/b', '/c']:
+            profiler = profiles.start()
+            work(1000)
+            ids.append(profiles.stop(profiler, path, 0.02, trace))
+        summaries = profiles.summaries()
+
+        # assert
+        self.assertEqual(ids, [1, 2, 3])
+        self.assertEqual([summary["path"] for summary in summaries], ['/c', '/b'])
+        self.assertEqual(summaries[0]["queries"], trace["queries"])
+        self.assertEqual(summaries[0]["phases"], trace["phases"])
+        self.assertIsNone(profiles.render(1))
+        self.assertIn('work', profiles.render(3))
+        self.assertIn('work', profiles.render(3, 'collapsed'))
+
+    def test_one_profile_at_a_time(self):
+        # arrange
+        profiles = Profiles(size=2)
+
+        # act
+        first = profiles.start()
+        second = profiles.start()
+        profiles.stop(first, '/a', 0.01, None)
+        third = profiles.start()
+        profiles.discard(third)
+
+        # assert
+        self.assertIsNotNone(first)
+        self.assertIsNone(second)
+        self.assertIsNotNone(third)
+        self.assertEqual(len(profiles.summaries()), 1)
+
+    def test_collapsed_stacks(self):
+        # arrange
+        main, a, b, leaf = ('app.py', 1, 'main'), ('app.py', 5, 'a'), ('app.py', 9, 'b'), ('~', 0, '<built-in leaf>')
+        # (calls, total calls, own time, cumulative time, {caller: (calls, total calls, own time, cumulative time)})
+        stats = {main: (1, 1, 0.001, 0.010, {}),
+                 a: (1, 1, 0.001, 0.004, {main: (1, 1, 0.001, 0.004)}),
+                 b: (1, 1, 0.001, 0.005, {main: (1, 1, 0.001, 0.005)}),
+                 leaf: (2, 2, 0.007, 0.007, {a: (1, 1, 0.003, 0.003), b: (1, 1, 0.004, 0.004)})}
+
+        # act
+        lines = collapsed_stacks(stats).splitlines()
+
+        # assert
+        self.assertEqual(lines, ['app.py:main:1 1000',
+                                 'app.py:main:1;app.py:a:5 1000',
+                                 'app.py:main:1;app.py:a:5;<built-in leaf> 3000',
+                                 'app.py:main:1;app.py:b:9 1000',
+                                 'app.py:main:1;app.py:b:9;<built-in leaf> 4000'])
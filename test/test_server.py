@@ -1,13 +1,72 @@
+import gzip
+import json
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
 from unittest.mock import patch, MagicMock, call
+from admission import CostBudget
+from cache import CellCache, LRUCache, SingleFlight
+from catalog import Catalog
+from profiling import Profiles
 from database import DB
+from shards import PartialSums
+from warmup import Warmup
+from sketches import PriceSketches
+import server
 from server import app
 
 DB.__init__ = lambda x: None
 mock_db = DB()
+mock_db.get_ports = MagicMock(return_value=[])
+mock_db.get_regions = MagicMock(return_value=[])
+mock_catalog = Catalog(mock_db)
+
+
+def load_catalog(ports: list, regions: list):
+    """
+    reloads the mocked catalog
+    :param ports: list of (port code, parent slug)
+    :param regions: list of (region slug, parent slug)
+    """
+    mock_db.get_ports = MagicMock(return_value=ports)
+    mock_db.get_regions = MagicMock(return_value=regions)
+    mock_catalog.reload()
+
+
+def price_sums_func(prices: dict):
+    """
+    builds a get_price_sums side effect from the raw prices of each (origin port, destination port, day)
+    :param prices: dictionary of {(origin port, destination port, day): [prices]}
+    """
+    def price_sums(origin_ports, destination_ports, date_from, date_to):
+        sums = {}
+        for (org, dest, day), day_prices in prices.items():
+            if org in origin_ports and dest in destination_ports and date_from <= day <= date_to and day_prices:
+                price_sum, count = sums.get(day, (0, 0))
+                sums[day] = (price_sum + sum(day_prices), count + len(day_prices))
+        return [(datetime.strptime(day, '%Y-%m-%d').date(), price_sum, count)
+                for day, (price_sum, count) in sorted(sums.items())]
+
+    return price_sums
+
+
+def port_pair_sums_func(prices: dict):
+    """
+    builds a get_port_pair_sums side effect from the raw prices of each (origin port, destination port, day)
+    :param prices: dictionary of {(origin port, destination port, day): [prices]}
+    """
+    def port_pair_sums(origin_ports, destination_ports, date_from, date_to):
+        return sorted([(org, dest, datetime.strptime(day, '%Y-%m-%d').date(), sum(day_prices), len(day_prices))
+                       for (org, dest, day), day_prices in prices.items()
+                       if org in origin_ports and dest in destination_ports and date_from <= day <= date_to],
+                      key=lambda row: row[2])
+
+    return port_pair_sums
+
 
 @patch('server.db', mock_db)
+@patch('server.catalog', mock_catalog)
 class TestServer(unittest.TestCase):
 
     def test_origin_and_dest_ports(self):
@@ -17,23 +76,20 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        def daily_prices_func(origin, dest, day):
-            match day:
-                case "2016-01-01": return [121, 122, 123]
-                case "2016-01-02": return [456]
-                case "2016-01-03": return [789, 790, 791, 792]
-                case _: return [701]
+        prices = {(origin_port, destination_port, "2016-01-01"): [121, 122, 123],
+                  (origin_port, destination_port, "2016-01-02"): [456],
+                  (origin_port, destination_port, "2016-01-03"): [789, 790, 791, 792],
+                  (origin_port, destination_port, "2016-01-04"): [701]}
 
-        mock_db.get_daily_prices = MagicMock(side_effect=daily_prices_func)
-        mock_db.get_port = MagicMock(return_value=(True,))
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        load_catalog([(origin_port, "a_region"), (destination_port, "b_region")], [("a_region", None), ("b_region", None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_port}&destination={destination_port}')
 
         # assert
         expected = [{'average_price': 122, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'}, {'average_price': 790, 'day': '2016-01-03'}]
-        calls = [call(origin_port, destination_port, start_date), call(origin_port, destination_port, '2016-01-02'), call(origin_port, destination_port, end_date)]
-        mock_db.get_daily_prices.assert_has_calls(calls, any_order=False)
+        mock_db.get_price_sums.assert_called_once_with([origin_port], [destination_port], start_date, end_date)
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, expected)
 
@@ -45,28 +101,22 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        def daily_prices_func(origin, dest, day):
-            match origin, dest, day:
-                case "ABCDE", "VWXYZ", "2016-01-01": return [121, 122, 123]
-                case "ABCDE", "VWXYZ", "2016-01-02": return [456]
-                case "ABCDE", "VWXYZ", "2016-01-03": return [789, 790, 791, 792]
-                case _: return [701]
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456],
+                  ("ABCDE", "VWXYZ", "2016-01-03"): [789, 790, 791, 792],
+                  ("ABCDE", "LMNOP", "2016-01-02"): [701],
+                  ("LMNOP", "VWXYZ", "2016-01-02"): [701]}
 
-        mock_db.get_daily_prices = MagicMock(side_effect=daily_prices_func)
-        mock_db.get_child_port_codes = MagicMock(return_value=[dest_port])
-        mock_db.get_child_region_slugs = MagicMock(return_value=[])
-        mock_db.get_port = MagicMock(return_value=(True,))
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        load_catalog([(origin_port, "o_region"), (dest_port, destination_region), ("LMNOP", "o_region")],
+                     [("o_region", None), (destination_region, None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_port}&destination={destination_region}')
 
         # assert
         expected = [{'average_price': 122, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'}, {'average_price': 790, 'day': '2016-01-03'}]
-        prices_calls = [call(origin_port, dest_port, start_date), call(origin_port, dest_port, '2016-01-02'), call(origin_port, dest_port, end_date)]
-        mock_db.get_daily_prices.assert_has_calls(prices_calls, any_order=False)
-        mock_db.get_child_port_codes.assert_called_once_with(destination_region)
-        mock_db.get_child_region_slugs.assert_called_once_with(destination_region)
-        mock_db.get_port.assert_called_once_with(origin_port)
+        mock_db.get_price_sums.assert_called_once_with([origin_port], (dest_port,), start_date, end_date)
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, expected)
@@ -78,17 +128,15 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        def daily_prices_func(origin, dest, day):
-            match origin, dest, day:
-                case "ABCDE", "VWXYZ", "2016-01-01": return [121, 122, 123]
-                case "ABCDE", "VWXYZ", "2016-01-02": return [456]
-                case "ABCDE", "VWXYZ", "2016-01-03": return [789, 790, 791, 792]
-                case _: return [701]
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456],
+                  ("ABCDE", "VWXYZ", "2016-01-03"): [789, 790, 791, 792],
+                  ("ABCDE", "LMNOP", "2016-01-02"): [701],
+                  ("LMNOP", "VWXYZ", "2016-01-02"): [701]}
 
-        mock_db.get_daily_prices = MagicMock(side_effect=daily_prices_func)
-        mock_db.get_child_port_codes = MagicMock(return_value=["ABCDE"])
-        mock_db.get_child_region_slugs = MagicMock(return_value=[])
-        mock_db.get_port = MagicMock(return_value=(True,))
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        load_catalog([("ABCDE", origin_region), (destination_port, "d_region"), ("LMNOP", "d_region")],
+                     [(origin_region, None), ("d_region", None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_region}&destination={destination_port}')
@@ -105,30 +153,15 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        def child_ports_func(region):
-            match region:
-                case "a_region": return ["ABCDE"]
-                case "b_region": return ["VWXYZ"]
-                case "c_region": return ["PQRST"]
-                case _: return ["LMNOP"]
-
-        def child_region_func(region):
-            match region:
-                case "b_region": return ["c_region"]
-                case _: return []
-
-        def daily_prices_func(origin, dest, day):
-            match origin, dest, day:
-                case "ABCDE", "VWXYZ", "2016-01-01": return [121, 122, 123]
-                case "ABCDE", "PQRST", "2016-01-01": return [124, 125]
-                case "ABCDE", "VWXYZ", "2016-01-02": return [456]
-                case "ABCDE", "PQRST", "2016-01-03": return [789, 790, 791, 792]
-                case _: return []
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123],
+                  ("ABCDE", "PQRST", "2016-01-01"): [124, 125],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456],
+                  ("ABCDE", "PQRST", "2016-01-03"): [789, 790, 791, 792],
+                  ("ABCDE", "LMNOP", "2016-01-02"): [701, 702, 703]}
 
-        mock_db.get_daily_prices = MagicMock(side_effect=daily_prices_func)
-        mock_db.get_child_port_codes = MagicMock(side_effect=child_ports_func)
-        mock_db.get_child_region_slugs = MagicMock(side_effect=child_region_func)
-        mock_db.get_port = MagicMock(return_value=(True,))
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "c_region"), ("LMNOP", "d_region")],
+                     [("a_region", None), ("b_region", None), ("c_region", "b_region"), ("d_region", None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_region}&destination={destination_region}')
@@ -138,6 +171,437 @@ class TestServer(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json, expected)
 
+    def test_read_from_rollups(self):
+        # arrange
+        origin_region = "a_region"
+        destination_region = "b_region"
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock()
+        mock_db.get_rollup_sums = MagicMock(return_value=[(datetime(2016, 1, 1).date(), 366, 3),
+                                                          (datetime(2016, 1, 2).date(), 456, 1)])
+
+        # act
+        with patch('server.rates_rollups', True):
+            response = app.test_client().get(f'/rates?date_from=2016-01-01&date_to=2016-01-02&origin={origin_region}&destination={destination_region}')
+
+        # assert
+        expected = [{'average_price': 122, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'}]
+        mock_db.get_rollup_sums.assert_called_once_with(origin_region, destination_region, "2016-01-01", "2016-01-02")
+        mock_db.get_price_sums.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, expected)
+
+    def test_cached_response(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func({("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123]}))
+        cache = LRUCache()
+
+        # act
+        with patch('server.response_cache', cache):
+            first = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-01&origin=ABCDE&destination=VWXYZ')
+            second = app.test_client().get('/rates?date_from=2016-1-1&date_to=2016-01-01&origin=ABCDE&destination=VWXYZ')
+            stats = app.test_client().get('/rates/cache')
+
+        # assert
+        expected = [{'average_price': 122, 'day': '2016-01-01'}]
+        self.assertEqual(first.json, expected)
+        self.assertEqual(second.json, expected)
+        mock_db.get_price_sums.assert_called_once()
+        self.assertEqual(stats.json["responses"]["hits"], 1)
+        self.assertEqual(stats.json["responses"]["misses"], 1)
+
+    def test_not_modified(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func({("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123]}))
+        url = '/rates?date_from=2016-01-01&date_to=2016-01-01&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        first = app.test_client().get(url)
+        second = app.test_client().get(url, headers={'If-None-Match': first.headers['ETag']})
+        with patch('server.current_data_version', MagicMock(return_value=2)):
+            changed = app.test_client().get(url, headers={'If-None-Match': first.headers['ETag']})
+
+        # assert
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(mock_db.get_price_sums.call_count, 2)
+
+    def test_columnar_format(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func({("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123]}))
+        query = 'date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        response = app.test_client().get(f'/rates?{query}&format=columnar')
+        bad_format = app.test_client().get(f'/rates?{query}&format=csv')
+
+        # assert
+        self.assertEqual(response.json, {"days": ["2016-01-01", "2016-01-02"], "prices": [122, None]})
+        self.assertEqual(bad_format.status_code, 400)
+
+    def test_gzip(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+        url = '/rates?date_from=2016-01-01&date_to=2016-03-31&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        compressed = app.test_client().get(url, headers={'Accept-Encoding': 'gzip'})
+        plain = app.test_client().get(url)
+
+        # assert
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(compressed.data)), plain.json)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+    def test_stats(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [100, 120],
+                  ("ABCDE", "PQRST", "2016-01-01"): [200],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456]}
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        mock_db.iter_prices = MagicMock(return_value=iter([[(org, dest, datetime.strptime(day, '%Y-%m-%d').date(), price)
+                                                            for (org, dest, day), day_prices in prices.items()
+                                                            for price in day_prices]]))
+        query = 'date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=b_region'
+
+        # act
+        with patch('server.sketches', PriceSketches(mock_db)):
+            response = app.test_client().get(f'/rates?{query}&stats=min,max,median')
+            columnar = app.test_client().get(f'/rates?{query}&stats=max&format=columnar')
+            bad_stats = app.test_client().get(f'/rates?{query}&stats=mode')
+        disabled = app.test_client().get(f'/rates?{query}&stats=max')
+
+        # assert
+        self.assertEqual(response.json, [{'day': '2016-01-01', 'average_price': 140, 'min': 100, 'max': 200, 'median': 120},
+                                         {'day': '2016-01-02', 'average_price': None, 'min': None, 'max': None, 'median': None}])
+        self.assertEqual(columnar.json, {"days": ["2016-01-01", "2016-01-02"], "prices": [140, None], "max": [200, None]})
+        self.assertEqual(bad_stats.status_code, 400)
+        self.assertEqual(disabled.status_code, 400)
+
+    def test_granularity(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [100],
+                  ("ABCDE", "VWXYZ", "2016-01-03"): [200, 300],
+                  ("ABCDE", "VWXYZ", "2016-01-05"): [400],
+                  ("ABCDE", "VWXYZ", "2016-02-02"): [500, 600, 700]}
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        query = 'date_from=2016-01-01&date_to=2016-02-02&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        with patch('server.cell_cache', CellCache()):
+            weeks = app.test_client().get(f'/rates?{query}&granularity=week')
+            months = app.test_client().get(f'/rates?{query}&granularity=month')
+        bad_granularity = app.test_client().get(f'/rates?{query}&granularity=year')
+
+        # assert
+        self.assertEqual([week["day"] for week in weeks.json],
+                         ['2016-01-01', '2016-01-04', '2016-01-11', '2016-01-18', '2016-01-25', '2016-02-01'])
+        self.assertEqual([week["average_price"] for week in weeks.json], [200, None, None, None, None, 600])
+        self.assertEqual(months.json, [{'day': '2016-01-01', 'average_price': 250}, {'day': '2016-02-01', 'average_price': 600}])
+        self.assertEqual(bad_granularity.status_code, 400)
+
+    def test_granularity_summed_in_database(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_bucket_sums = MagicMock(return_value=[(datetime(2016, 1, 1).date(), 750, 3)])
+
+        # act
+        response = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-02-02&origin=ABCDE&destination=VWXYZ&granularity=month')
+
+        # assert
+        mock_db.get_bucket_sums.assert_called_once_with(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-02-02", "month")
+        self.assertEqual(response.json, [{'day': '2016-01-01', 'average_price': 250}, {'day': '2016-02-01', 'average_price': None}])
+
+    def test_missing_shard(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(side_effect=PartialSums(
+            price_sums_func({("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123]})(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-01"),
+            [("2016-01-02", "2016-01-02")]))
+        cache = LRUCache()
+
+        # act
+        with patch('server.response_cache', cache):
+            response = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=VWXYZ')
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [{'average_price': 122, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'}])
+        self.assertEqual(response.headers['X-Missing-Ranges'], "2016-01-02..2016-01-02")
+        self.assertNotIn('ETag', response.headers)
+        self.assertEqual(cache.stats()["size"], 0)
+
+    def test_coalescing_counts(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+
+        # act
+        with patch('server.single_flight', SingleFlight()):
+            app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=VWXYZ')
+            stats = app.test_client().get('/rates/cache')
+            response = app.test_client().get('/metrics')
+
+        # assert
+        self.assertEqual(stats.json["coalescing"], {"enabled": True, "leaders": 1, "coalesced": 0, "in_flight": 0})
+        self.assertIn('rates_coalesced_requests_total 0', response.data.decode())
+
+    def test_query_cost_ceiling(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+
+        # act
+        with patch('server.cost_budget', CostBudget(max_cost=3)):
+            cheap = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-03&origin=ABCDE&destination=VWXYZ')
+            expensive = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-03&origin=ABCDE&destination=b_region')
+
+        # assert
+        self.assertEqual(cheap.status_code, 200)
+        self.assertEqual(expensive.status_code, 429)
+        mock_db.get_price_sums.assert_called_once()
+
+    def test_cost_budget_sheds(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+        budget = CostBudget(budget=5, queue_timeout=0.01)
+
+        # act
+        with patch('server.cost_budget', budget), budget.admit(4):
+            response = app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-03&origin=ABCDE&destination=VWXYZ')
+
+        # assert
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], "1")
+        mock_db.get_price_sums.assert_not_called()
+
+    def test_reversed_date_range_costs_nothing(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        budget = CostBudget(budget=10)
+        in_flight = []
+        mock_db.get_price_sums = MagicMock(side_effect=lambda *args: in_flight.append(budget.in_flight) or [])
+
+        # act
+        with patch('server.cost_budget', budget), budget.admit(4):
+            response = app.test_client().get('/rates?date_from=2016-01-10&date_to=2016-01-01'
+                                              '&origin=ABCDE&destination=b_region')
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(cost == 4 for cost in in_flight))
+        self.assertEqual(budget.stats()["in_flight_cost"], 0)
+
+    def test_streamed_query_admitted(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        mock_db.iter_price_sums = MagicMock(return_value=iter([]))
+        budget = CostBudget(budget=10, max_cost=3)
+        query = 'date_from=2016-01-01&date_to=2016-01-03&origin=ABCDE&stream=1'
+
+        # act
+        with patch('server.cost_budget', budget):
+            expensive = app.test_client().get(f'/rates?{query}&destination=b_region')
+            response = app.test_client().get(f'/rates?{query}&destination=VWXYZ', buffered=False)
+            in_flight = budget.stats()["in_flight_cost"]
+            lines = response.get_data(as_text=True).splitlines()
+            response.close()
+
+        # assert
+        self.assertEqual(expensive.status_code, 429)
+        self.assertEqual(in_flight, 3)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(budget.stats()["in_flight_cost"], 0)
+
+    def test_batch(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123],
+                  ("ABCDE", "PQRST", "2016-01-01"): [124, 125],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456],
+                  ("ABCDE", "PQRST", "2016-01-03"): [789, 790, 791, 792]}
+        mock_db.get_port_pair_sums = MagicMock(side_effect=port_pair_sums_func(prices))
+        queries = [{"origin": "ABCDE", "destination": "b_region", "date_from": "2016-01-01", "date_to": "2016-01-03"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "destination": "c_region", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "date_from": "2016-01-01", "date_to": "2016-01-02"}]
+
+        # act
+        response = app.test_client().post('/rates/batch', json=queries)
+
+        # assert
+        expected = [{"rates": [{'average_price': 123, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'},
+                               {'average_price': 790, 'day': '2016-01-03'}]},
+                    {"rates": [{'average_price': 122, 'day': '2016-01-01'}, {'average_price': None, 'day': '2016-01-02'}]},
+                    {"error": "invalid destination region c_region"},
+                    {"error": "['destination'] params required"}]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, expected)
+        mock_db.get_port_pair_sums.assert_called_once_with(["ABCDE"], ["PQRST", "VWXYZ"], "2016-01-01", "2016-01-03")
+
+    def test_batch_lane_cost_ceiling(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "b_region")],
+                     [("a_region", None), ("b_region", None)])
+        mock_db.get_port_pair_sums = MagicMock(return_value=[])
+        month = {"origin": "ABCDE", "date_from": "2016-01-01", "date_to": "2016-01-31"}
+        queries = [{**month, "destination": "VWXYZ"}] * 4 + [{**month, "destination": "b_region"}]
+        budget = CostBudget(budget=10, max_cost=40)
+
+        # act
+        with patch('server.cost_budget', budget):
+            response = app.test_client().post('/rates/batch', json=queries)
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all("rates" in result for result in response.json[:4]))
+        self.assertEqual(response.json[4], {"error": "query cost 62 is over the limit of 40, "
+                                                     "narrow the date range, origin or destination"})
+        self.assertEqual(budget.stats()["rejected"], 1)
+        self.assertEqual(budget.stats()["admitted"], 1)
+
+    def test_batch_separate_date_ranges(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_port_pair_sums = MagicMock(return_value=[])
+        queries = [{"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-03", "date_to": "2016-01-04"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-02-01", "date_to": "2016-02-01"}]
+
+        # act
+        response = app.test_client().post('/rates/batch', json=queries)
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_db.get_port_pair_sums.call_args_list,
+                         [call(["ABCDE"], ["VWXYZ"], "2016-01-01", "2016-01-04"),
+                          call(["ABCDE"], ["VWXYZ"], "2016-02-01", "2016-02-01")])
+
+    def test_batch_empty_date_range(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_port_pair_sums = MagicMock(side_effect=PartialSums([], [("2016-01-02", "2016-01-02")]))
+        queries = [{"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-05", "date_to": "2016-01-01"}]
+
+        # act
+        response = app.test_client().post('/rates/batch', json=queries)
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json[0]["missing"], ["2016-01-02..2016-01-02"])
+        self.assertEqual(response.json[1], {"rates": []})
+
+    def test_batch_non_string_fields(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_port_pair_sums = MagicMock(return_value=[])
+        queries = [{"origin": 123, "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "destination": ["VWXYZ"], "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-01"}]
+
+        # act
+        response = app.test_client().post('/rates/batch', json=queries)
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json[:2], [{"error": "['origin'] params must be strings"},
+                                             {"error": "['destination'] params must be strings"}])
+        self.assertEqual(response.json[2], {"rates": [{'average_price': None, 'day': '2016-01-01'}]})
+
+    def test_batch_bad_body(self):
+        # act
+        response = app.test_client().post('/rates/batch', json={"origin": "ABCDE"})
+
+        # assert
+        self.assertEqual(response.status_code, 400)
+
+    def test_matrix(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("FGHIJ", "a_region"), ("VWXYZ", "b_region"), ("PQRST", "c_region")],
+                     [("a_region", None), ("b_region", "north"), ("c_region", "north"), ("north", None)])
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [100, 110, 120],
+                  ("ABCDE", "PQRST", "2016-01-01"): [300, 300, 300],
+                  ("FGHIJ", "VWXYZ", "2016-01-02"): [200, 200, 200]}
+        mock_db.get_port_pair_sums = MagicMock(side_effect=port_pair_sums_func(prices))
+
+        # act
+        response = app.test_client().get('/rates/matrix?date_from=2016-01-01&date_to=2016-01-02'
+                                          '&origin=ABCDE,a_region&destination=b_region,c_region&destination=north')
+        bad_destination = app.test_client().get('/rates/matrix?date_from=2016-01-01&date_to=2016-01-02'
+                                                '&origin=ABCDE&destination=b_region,nowhere')
+
+        # assert
+        self.assertEqual(response.json, {"days": ["2016-01-01", "2016-01-02"],
+                                         "destinations": ["b_region", "c_region", "north"],
+                                         "prices": {"ABCDE": [[110, 300, 205], [None, None, None]],
+                                                    "a_region": [[110, 300, 205], [200, None, 200]]}})
+        mock_db.get_port_pair_sums.assert_called_once_with(["ABCDE", "FGHIJ"], ["PQRST", "VWXYZ"], "2016-01-01", "2016-01-02")
+        self.assertEqual(bad_destination.status_code, 400)
+        self.assertEqual(bad_destination.json, {"error": "invalid destination region nowhere"})
+
+    def test_stream(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", "2016-01-01"): [121, 122, 123],
+                  ("ABCDE", "VWXYZ", "2016-01-02"): [456],
+                  ("ABCDE", "VWXYZ", "2016-01-03"): [789, 790, 791, 792]}
+        mock_db.iter_price_sums = MagicMock(side_effect=lambda *args: iter(price_sums_func(prices)(*args)))
+        query = 'date_from=2016-01-01&date_to=2016-01-04&origin=ABCDE&destination=b_region'
+
+        # act
+        by_param = app.test_client().get(f'/rates?{query}&stream=1')
+        by_header = app.test_client().get(f'/rates?{query}', headers={'Accept': 'application/x-ndjson'})
+
+        # assert
+        expected = [{'day': '2016-01-01', 'average_price': 122}, {'day': '2016-01-02', 'average_price': None},
+                    {'day': '2016-01-03', 'average_price': 790}, {'day': '2016-01-04', 'average_price': None}]
+        for response in [by_param, by_header]:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in response.data.decode().splitlines()], expected)
+        mock_db.iter_price_sums.assert_called_with(["ABCDE"], ("VWXYZ",), "2016-01-01", "2016-01-04")
+
+    def test_stream_bad_date(self):
+        # act
+        response = app.test_client().get('/rates?date_from=2016-0101&date_to=2016-01-04&origin=ABCDE&destination=VWXYZ&stream=1')
+
+        # assert
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"error": "date_from incorrect range or format. Make sure it is formatted YYYY-MM-DD"})
+
+    def test_metrics(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+
+        # act
+        with patch('server.slow_request_ms', 0.000001), self.assertLogs(app.logger, level='WARNING') as logs:
+            app.test_client().get('/rates?date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=VWXYZ')
+        response = app.test_client().get('/metrics')
+
+        # assert
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('rates_request_seconds_count{endpoint="rates"}', response.data.decode())
+        self.assertIn('rates_request_phase_seconds_count{phase="serialize"}', response.data.decode())
+        self.assertIn("slow request /rates?", logs.output[0])
+
     def test_bad_origin_port_query_param(self):
         # arrange
         origin_port = "ABCD"
@@ -145,7 +609,7 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        mock_db.get_port = MagicMock(side_effect=lambda x: (True,) if x == "ABCDE" else None)
+        load_catalog([("ABCDE", "a_region")], [("a_region", None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_port}&destination={destination_port}')
@@ -162,7 +626,7 @@ class TestServer(unittest.TestCase):
         start_date="2016-01-01"
         end_date = "2016-01-03"
 
-        mock_db.get_port = MagicMock(side_effect=lambda x: (True,) if x == "ABCDE" else None)
+        load_catalog([("ABCDE", "a_region")], [("a_region", None)])
 
         # act
         response = app.test_client().get(f'/rates?date_from={start_date}&date_to={end_date}&origin={origin_port}&destination={destination_port}')
@@ -172,6 +636,35 @@ class TestServer(unittest.TestCase):
         self.assertEqual(response.status_code, 400)
         self.assertEqual(response.json, expected)
 
+    def test_bad_origin_region_query_param(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region")], [("a_region", None)])
+
+        # act
+        response = app.test_client().get(f'/rates?date_from=2016-01-01&date_to=2016-01-03&origin=b_region&destination=ABCDE')
+
+        # assert
+        expected = {'error': 'invalid origin region b_region'}
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, expected)
+
+    def test_reload_catalog(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region")], [("a_region", None)])
+        mock_db.get_regions = MagicMock(return_value=[("a_region", None), ("b_region", "a_region")])
+
+        # act
+        with patch('server.admin_allowlist', {'10.0.0.1'}):
+            forbidden = app.test_client().post('/catalog/reload')
+            reloaded_before = mock_catalog.has_region("b_region")
+        response = app.test_client().post('/catalog/reload')
+
+        # assert
+        self.assertEqual(forbidden.status_code, 403)
+        self.assertFalse(reloaded_before)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(mock_catalog.has_region("b_region"))
+
     def test_missing_query_param(self):
         # arrange
         missing_origin = f'/rates?date_from=2016-01-01&date_to=2016-01-10&destination=VWXYZ'
@@ -192,6 +685,103 @@ class TestServer(unittest.TestCase):
             self.assertEqual(response.status_code, 400)
             self.assertEqual(response.json, expected)
 
+    def test_profile(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_price_sums = MagicMock(return_value=[])
+        url = '/rates?date_from=2016-01-01&date_to=2016-01-02&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        with patch('server.profiles', Profiles(2)), patch('server.profile_allowlist', {'127.0.0.1'}):
+            profiled = app.test_client().get(url, headers={'X-Profile': '1'})
+            plain = app.test_client().get(url)
+            listed = app.test_client().get('/admin/profiles')
+            pstats = app.test_client().get(f'/admin/profiles/{profiled.headers["X-Profile-Id"]}')
+            collapsed = app.test_client().get(f'/admin/profiles/{profiled.headers["X-Profile-Id"]}?format=collapsed')
+            gone = app.test_client().get('/admin/profiles/99')
+            with patch('server.profiles.start', return_value=None):
+                busy = app.test_client().get(url, headers={'X-Profile': '1'})
+        with patch('server.profiles', Profiles(2)), patch('server.profile_allowlist', {'10.0.0.1'}):
+            not_allowed = app.test_client().get(url + '&profile=1')
+            forbidden = app.test_client().get('/admin/profiles')
+
+        # assert
+        self.assertEqual(profiled.json, plain.json)
+        self.assertNotIn('X-Profile-Id', plain.headers)
+        self.assertEqual([profile["path"] for profile in listed.json["profiles"]], [url])
+        self.assertTrue({"resolve", "prices", "aggregate", "serialize"} <= set(listed.json["profiles"][0]["phases"]))
+        self.assertIn('function calls', pstats.text)
+        self.assertIn('server.py:rates:', collapsed.text)
+        self.assertEqual(gone.status_code, 404)
+        self.assertEqual(busy.status_code, 200)
+        self.assertNotIn('X-Profile-Id', busy.headers)
+        self.assertNotIn('X-Profile-Id', not_allowed.headers)
+        self.assertEqual(forbidden.status_code, 403)
+
+    def test_create_app_warms_lanes(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        mock_db.get_data_version = MagicMock(return_value=1)
+        mock_db.get_price_sums = MagicMock(return_value=[("2016-01-01", 300, 3)])
+        state = {name: None for name in ["db", "catalog", "engine", "data_version", "sketches", "cost_budget",
+                                         "single_flight", "profiles", "response_cache", "cell_cache", "warmup"]}
+
+        # act
+        with patch.multiple('server', **state), patch('server.DB', return_value=mock_db), \
+                patch('server.warmup_lanes', 'ABCDE:VWXYZ:2016-01-01:2016-01-02'):
+            pending = Warmup([('ABCDE', 'VWXYZ', '2016-01-01', '2016-01-02')], MagicMock())
+            with patch('server.warmup', pending):
+                not_ready = app.test_client().get('/readyz')
+            server.create_app()
+            server.warmup.wait(5)
+            ready = app.test_client().get('/readyz')
+            healthy = app.test_client().get('/healthz')
+            cache_stats = server.response_cache.stats()
+
+        # assert
+        self.assertEqual(not_ready.status_code, 503)
+        self.assertEqual(ready.status_code, 200)
+        self.assertEqual({**ready.json, "seconds": None},
+                         {"ready": True, "lanes": 1, "warmed": 1, "failed": 0, "seconds": None})
+        self.assertEqual(healthy.json, {"status": "ok"})
+        self.assertEqual(cache_stats["size"], 1)
+
+    def test_date_chunks_fan_out(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", f"2016-01-{day:02}"): [100 * day] * 3 for day in range(1, 11)}
+        mock_db.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        url = '/rates?date_from=2016-01-01&date_to=2016-01-10&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        with ThreadPoolExecutor(2) as executor, patch('server.db_executor', executor), \
+                patch('server.price_chunk_days', 4):
+            response = app.test_client().get(url)
+
+        # assert
+        self.assertEqual([rate["average_price"] for rate in response.json], [100 * day for day in range(1, 11)])
+        self.assertEqual(sorted(call_args[0][2:] for call_args in mock_db.get_price_sums.call_args_list),
+                         [("2016-01-01", "2016-01-04"), ("2016-01-05", "2016-01-08"), ("2016-01-09", "2016-01-10")])
+
+    def test_sharded_date_range_not_split(self):
+        # arrange
+        load_catalog([("ABCDE", "a_region"), ("VWXYZ", "b_region")], [("a_region", None), ("b_region", None)])
+        prices = {("ABCDE", "VWXYZ", f"2016-01-{day:02}"): [100 * day] * 3 for day in range(1, 11)}
+        shards = MagicMock()
+        shards.get_price_sums = MagicMock(side_effect=price_sums_func(prices))
+        url = '/rates?date_from=2016-01-01&date_to=2016-01-10&origin=ABCDE&destination=VWXYZ'
+
+        # act
+        with ThreadPoolExecutor(2) as executor, patch('server.db_executor', executor), \
+                patch('server.price_chunk_days', 4), patch('server.engine', shards), \
+                patch('server.sharded_prices', shards):
+            response = app.test_client().get(url)
+
+        # assert
+        self.assertEqual([rate["average_price"] for rate in response.json], [100 * day for day in range(1, 11)])
+        self.assertEqual([call_args[0][2:] for call_args in shards.get_price_sums.call_args_list],
+                         [("2016-01-01", "2016-01-10")])
+
 
 if __name__ == '__main__':
     unittest.main()
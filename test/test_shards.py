@@ -0,0 +1,141 @@
+import threading
+import time
+import unittest
+from datetime import date, timedelta
+
+from bench.generate import generate
+from bench.memory_db import MemoryDB
+from shards import PartialSums, ShardedPrices, parse_shards
+
+
+class SlowDB(MemoryDB):
+    """
+    shard that does not answer until released
+    """
+
+    def __init__(self, data: dict):
+        super().__init__(data)
+        self.release = threading.Event()
+
+    def get_price_sums(self, *args) -> [tuple]:
+        self.release.wait(5)
+        return super().get_price_sums(*args)
+
+
+def split_by_day(data: dict, first: date, last: date) -> dict:
+    return {**data, "prices": [row for row in data["prices"] if first <= row[2] <= last]}
+
+
+class TestShardedPrices(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = generate(roots=1, depth=2, fan_out=2, ports_per_region=2, lanes=20, days=30, quotes=3, seed=2)
+        days = sorted({row[2] for row in self.data["prices"]})
+        self.first, self.middle, self.last = days[0], days[14], days[-1]
+        self.ports = sorted(code for code, _, _ in self.data["ports"])
+
+    def shards(self, second_db=MemoryDB) -> list:
+        after_middle = self.middle + timedelta(days=1)
+        return [(None, self.middle, MemoryDB(split_by_day(self.data, self.first, self.middle))),
+                (after_middle, None, second_db(split_by_day(self.data, after_middle, self.last)))]
+
+    def test_merges_shards(self):
+        # arrange
+        sharded = ShardedPrices(self.shards())
+        whole = MemoryDB(self.data)
+        date_from, date_to = str(self.first), str(self.last)
+
+        # act
+        price_sums = sharded.get_price_sums(self.ports, self.ports, date_from, date_to)
+        pair_sums = sharded.get_port_pair_sums(self.ports, self.ports, date_from, date_to)
+
+        # assert
+        self.assertEqual(price_sums, whole.get_price_sums(self.ports, self.ports, date_from, date_to))
+        self.assertEqual(sorted(pair_sums), sorted(whole.get_port_pair_sums(self.ports, self.ports, date_from, date_to)))
+        self.assertEqual([row[2] for row in pair_sums], sorted(row[2] for row in pair_sums))
+
+    def test_only_overlapping_shards_queried(self):
+        # arrange
+        sharded = ShardedPrices(self.shards())
+
+        # act
+        spans = sharded._spans(str(self.first), str(self.middle))
+
+        # assert
+        self.assertEqual(spans, [(0, str(self.first), str(self.middle))])
+
+    def test_timeout_keeps_answered_days(self):
+        # arrange
+        shards = self.shards(SlowDB)
+        sharded = ShardedPrices(shards, timeout=0.05)
+        date_from, date_to = str(self.first), str(self.last)
+
+        # act
+        with self.assertRaises(PartialSums) as partial:
+            sharded.get_price_sums(self.ports, self.ports, date_from, date_to)
+        shards[1][2].release.set()
+
+        # assert
+        expected = MemoryDB(self.data).get_price_sums(self.ports, self.ports, date_from, str(self.middle))
+        self.assertEqual(partial.exception.rows, expected)
+        self.assertEqual(partial.exception.missing, [(str(shards[1][0]), date_to)])
+
+    def test_hung_shard_keeps_other_shards_answering(self):
+        # arrange
+        shards = self.shards(SlowDB)
+        sharded = ShardedPrices(shards, timeout=0.02, max_workers=2)
+        date_from, date_to = str(self.first), str(self.last)
+        self.addCleanup(shards[1][2].release.set)
+
+        # act
+        partials = []
+        for _ in range(8):
+            with self.assertLogs('shards', 'WARNING'), self.assertRaises(PartialSums) as partial:
+                sharded.get_price_sums(self.ports, self.ports, date_from, date_to)
+            partials.append(partial.exception)
+
+        # assert
+        expected = MemoryDB(self.data).get_price_sums(self.ports, self.ports, date_from, str(self.middle))
+        self.assertTrue(all(partial.rows == expected for partial in partials))
+        self.assertTrue(all(partial.missing == [(str(shards[1][0]), date_to)] for partial in partials))
+
+    def test_busy_shard_queues_queries(self):
+        # arrange
+        shards = self.shards(SlowDB)
+        sharded = ShardedPrices(shards, timeout=5, max_workers=1)
+        date_from, date_to = str(self.first), str(self.last)
+        results, errors = [], []
+
+        def query():
+            try:
+                results.append(sharded.get_price_sums(self.ports, self.ports, date_from, date_to))
+            except PartialSums as e:
+                errors.append(e)
+
+        # act
+        threads = [threading.Thread(target=query) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        # the other queries wait for the shard's thread while the first one is held up
+        time.sleep(0.1)
+        shards[1][2].release.set()
+        for thread in threads:
+            thread.join()
+
+        # assert
+        expected = MemoryDB(self.data).get_price_sums(self.ports, self.ports, date_from, date_to)
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [expected] * 4)
+
+    def test_parse_shards(self):
+        # act
+        shards = parse_shards("..2016-06-30@localhost:5433, 2016-07-01..@shard2")
+
+        # assert
+        self.assertEqual(shards, [(None, date(2016, 6, 30), "localhost", 5433), (date(2016, 7, 1), None, "shard2", 5432)])
+        with self.assertRaises(ValueError):
+            parse_shards("2016-07-01@shard2")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import random
+import statistics
+import unittest
+from datetime import date
+
+from bench.generate import generate
+from bench.memory_db import MemoryDB
+from sketches import RELATIVE_ACCURACY, PriceSketches, QuantileSketch, parse_stats
+
+
+def sketch_of(prices: list) -> QuantileSketch:
+    sketch = QuantileSketch()
+    for price in prices:
+        sketch.add(price)
+    return sketch
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def test_quantiles_within_relative_accuracy(self):
+        # arrange
+        rand = random.Random(1)
+        prices = [rand.randrange(100, 5000) for _ in range(1001)]
+
+        # act
+        sketch = sketch_of(prices)
+
+        # assert
+        ordered = sorted(prices)
+        for q in [0.1, 0.5, 0.9]:
+            exact = ordered[int(q * (len(ordered) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - exact), exact * RELATIVE_ACCURACY)
+
+    def test_merge_equals_sketch_of_all_prices(self):
+        # arrange
+        first, second = [120, 130, 500, 90], [1000, 110, 130]
+
+        # act
+        merged = sketch_of(first)
+        merged.merge(sketch_of(second))
+
+        # assert
+        whole = sketch_of(first + second)
+        self.assertEqual(merged.buckets, whole.buckets)
+        self.assertEqual((merged.count, merged.total, merged.min, merged.max), (7, 2080, 90, 1000))
+
+    def test_exact_stats(self):
+        # arrange
+        prices = [100, 120, 130, 190]
+
+        # act
+        stats = sketch_of(prices).stats(['min', 'max', 'stddev'])
+
+        # assert
+        self.assertEqual(stats, {'min': 100, 'max': 190, 'stddev': round(statistics.stdev(prices))})
+
+    def test_empty_sketch(self):
+        # act / assert
+        self.assertEqual(QuantileSketch().stats(['median', 'min', 'stddev']), {'median': None, 'min': None, 'stddev': None})
+
+
+class TestPriceSketches(unittest.TestCase):
+
+    def test_merges_port_pairs(self):
+        # arrange
+        data = generate(roots=1, depth=2, fan_out=2, ports_per_region=2, lanes=20, days=10, quotes=4, seed=6)
+        ports = sorted(code for code, _, _ in data['ports'])
+        first_org, first_dest, day, _ = data['prices'][0]
+        origins, destinations = set(ports[:3]) | {first_org}, set(ports[3:6]) | {first_dest}
+
+        # act
+        daily_sketches = PriceSketches(MemoryDB(data)).get_daily_sketches(origins, destinations, str(day), str(day))
+
+        # assert
+        prices = [price for org, dest, price_day, price in data['prices']
+                  if org in origins and dest in destinations and price_day == day]
+        self.assertEqual(len(daily_sketches), 1)
+        self.assertEqual(daily_sketches[0][1].buckets, sketch_of(prices).buckets)
+        self.assertEqual(daily_sketches[0][1].count, len(prices))
+
+    def test_date_range(self):
+        # arrange
+        rows = [("ABCDE", "VWXYZ", date(2016, 1, day), 100 + day) for day in range(1, 6)]
+        sketches = PriceSketches(MemoryDB({"ports": [], "regions": [], "prices": rows}))
+
+        # act
+        daily_sketches = sketches.get_daily_sketches(["ABCDE"], ["VWXYZ"], "2016-01-02", "2016-01-03")
+
+        # assert
+        self.assertEqual([(day, sketch.total) for day, sketch in daily_sketches],
+                         [(date(2016, 1, 2), 102), (date(2016, 1, 3), 103)])
+
+
+class TestParseStats(unittest.TestCase):
+
+    def test_parse_stats(self):
+        # act / assert
+        self.assertEqual(parse_stats("median, p90,median"), (['median', 'p90'], None))
+        self.assertEqual(parse_stats("median,mode")[0], [])
+        self.assertIsNotNone(parse_stats("median,mode")[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
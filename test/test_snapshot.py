@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from bench.generate import generate
+from bench.memory_db import MemoryDB
+from catalog import Catalog
+from columnar import ColumnarPrices, np
+from snapshot import Snapshot, SnapshotPrices, write_snapshot
+
+
+class VersionedMemoryDB(MemoryDB):
+    def __init__(self, data: dict, version: int):
+        super().__init__(data)
+        self.version = version
+
+    def get_data_version(self) -> int:
+        return self.version
+
+
+@unittest.skipIf(np is None, "numpy is not installed")
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.data = generate(roots=1, depth=2, fan_out=2, ports_per_region=2, lanes=20, days=30, quotes=3, seed=5)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'prices.snapshot')
+        self.ports = sorted(code for code, _, _ in self.data['ports'])
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        # arrange
+        db = VersionedMemoryDB(self.data, 7)
+        date_from, date_to = str(self.data['prices'][0][2]), str(self.data['prices'][-1][2])
+
+        # act
+        stats = write_snapshot(self.path, db)
+        snapshot_prices = SnapshotPrices(self.path)
+
+        # assert
+        self.assertEqual(stats, {"data_version": 7, "ports": len(self.data['ports']),
+                                 "regions": len(self.data['regions']), "prices": len(self.data['prices'])})
+        self.assertEqual(snapshot_prices.get_data_version(), 7)
+        self.assertEqual(snapshot_prices.get_ports(), db.get_ports())
+        self.assertEqual(snapshot_prices.get_regions(), db.get_regions())
+        columnar = ColumnarPrices(db)
+        self.assertEqual(snapshot_prices.get_price_sums(self.ports[:3], self.ports, date_from, date_to),
+                         columnar.get_price_sums(self.ports[:3], self.ports, date_from, date_to))
+        self.assertEqual(snapshot_prices.get_port_pair_sums(self.ports, self.ports[2:], date_from, date_to),
+                         columnar.get_port_pair_sums(self.ports, self.ports[2:], date_from, date_to))
+        self.assertEqual(Catalog(snapshot_prices).get_sub_ports('region_0'), Catalog(db).get_sub_ports('region_0'))
+
+    def test_arrays_are_mapped(self):
+        # arrange
+        write_snapshot(self.path, VersionedMemoryDB(self.data, 1))
+
+        # act
+        snapshot = Snapshot(self.path)
+
+        # assert
+        self.assertFalse(snapshot.arrays['price'].flags.owndata)
+        self.assertFalse(snapshot.arrays['price'].flags.writeable)
+
+    def test_replaced_snapshot_picked_up(self):
+        # arrange
+        write_snapshot(self.path, VersionedMemoryDB(self.data, 1))
+        snapshot_prices = SnapshotPrices(self.path)
+        before = snapshot_prices.snapshot
+
+        # act
+        unchanged_version = snapshot_prices.get_data_version()
+        write_snapshot(self.path, VersionedMemoryDB({**self.data, 'prices': []}, 2))
+        changed_version = snapshot_prices.get_data_version()
+
+        # assert
+        self.assertEqual(unchanged_version, 1)
+        self.assertEqual(changed_version, 2)
+        self.assertEqual(len(before.arrays['price']), len(self.data['prices']))
+        self.assertEqual(snapshot_prices.get_price_sums(self.ports, self.ports, '2000-01-01', '2100-01-01'), [])
+
+    def test_not_a_snapshot(self):
+        # arrange
+        with open(self.path, 'wb') as f:
+            f.write(b'\0' * 128)
+
+        # act / assert
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import unittest
+
+from warmup import Warmup, parse_lanes, read_access_log
+
+
+class TestWarmup(unittest.TestCase):
+    def test_parse_lanes(self):
+        # act
+        lanes = parse_lanes('CNSGH:north_europe_main:2016-01-01:2016-01-31, ABCDE:VWXYZ:2016-01-01:2016-01-02,')
+
+        # assert
+        self.assertEqual(lanes, [('CNSGH', 'north_europe_main', '2016-01-01', '2016-01-31'),
+                                 ('ABCDE', 'VWXYZ', '2016-01-01', '2016-01-02')])
+        self.assertEqual(parse_lanes(''), [])
+        self.assertRaises(ValueError, parse_lanes, 'CNSGH:north_europe_main:2016-01-01')
+
+    def test_read_access_log(self):
+        # arrange
+        entries = [{"url": "/rates?date_from=2016-01-01&date_to=2016-01-10&origin=CNSGH&destination=baltic"},
+                   {"path": "/rates?date_from=2016-01-01&date_to=2016-01-10&origin=CNSGH&destination=baltic"},
+                   {"origin": "ABCDE", "destination": "VWXYZ", "date_from": "2016-01-01", "date_to": "2016-01-02"},
+                   {"url": "/rates/matrix?date_from=2016-01-01&date_to=2016-01-10&origin=CNSGH&destination=baltic"},
+                   {"url": "/rates?date_from=2016-01-01&origin=CNSGH&destination=baltic"},
+                   ["not", "a", "request"]]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries) + "not json\n")
+        self.addCleanup(os.remove, f.name)
+
+        # act
+        lanes = read_access_log(f.name, top=5)
+        top = read_access_log(f.name, top=1)
+
+        # assert
+        self.assertEqual(lanes, [('CNSGH', 'baltic', '2016-01-01', '2016-01-10'),
+                                 ('ABCDE', 'VWXYZ', '2016-01-01', '2016-01-02')])
+        self.assertEqual(top, lanes[:1])
+
+    def test_warmup(self):
+        # arrange
+        fetched = []
+
+        def fetch(origin, destination, date_from, date_to):
+            if origin == 'BROKEN':
+                raise RuntimeError("no such port")
+            fetched.append(origin)
+
+        warmup = Warmup([('ABCDE', 'VWXYZ', '2016-01-01', '2016-01-02'),
+                         ('BROKEN', 'VWXYZ', '2016-01-01', '2016-01-02')], fetch)
+
+        # act
+        before = warmup.stats()
+        warmup.start().join()
+
+        # assert
+        self.assertEqual(before, {"ready": False, "lanes": 2, "warmed": 0, "failed": 0, "seconds": None})
+        self.assertEqual(fetched, ['ABCDE'])
+        self.assertTrue(warmup.ready)
+        self.assertEqual({**warmup.stats(), "seconds": None},
+                         {"ready": True, "lanes": 2, "warmed": 1, "failed": 1, "seconds": None})
+        self.assertGreaterEqual(warmup.stats()["seconds"], 0)
@@ -0,0 +1,107 @@
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+LANE_FIELDS = ('origin', 'destination', 'date_from', 'date_to')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lanes(spec: str) -> list:
+    """
+    :param spec: comma separated origin:destination:date_from:date_to lanes,
+        e.g. CNSGH:north_europe_main:2016-01-01:2016-01-31
+    :return: list of (origin, destination, date_from, date_to)
+    """
+    lanes = []
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        fields = [field.strip() for field in entry.split(':')]
+        if len(fields) != len(LANE_FIELDS) or not all(fields):
+            raise ValueError(f"warm-up lane {entry.strip()!r} is not origin:destination:date_from:date_to")
+        lanes.append(tuple(fields))
+    return lanes
+
+
+def read_access_log(path: str, top: int) -> list:
+    """
+    picks the most requested lanes out of a json lines access log
+
+    each line is either an object holding origin, destination, date_from and date_to,
+    or one with the requested "url" or "path" of a /rates request; other lines are skipped
+    :param top: number of lanes to return
+    :return: list of (origin, destination, date_from, date_to), most requested first
+    """
+    counts = Counter()
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if not isinstance(entry, dict):
+                continue
+            url = entry.get('url') or entry.get('path')
+            if isinstance(url, str):
+                parts = urlsplit(url)
+                if parts.path != '/rates':
+                    continue
+                entry = {name: values[0] for name, values in parse_qs(parts.query).items()}
+            lane = tuple(entry.get(field) for field in LANE_FIELDS)
+            if all(isinstance(value, str) and value for value in lane):
+                counts[lane] += 1
+    return [lane for lane, _ in counts.most_common(top)]
+
+
+class Warmup:
+    """
+    answers a list of lanes in a background thread, so the caches, the database connections and its buffers
+    are warm before the server is reported ready
+    """
+
+    def __init__(self, lanes: list, fetch):
+        """
+        :param lanes: list of (origin, destination, date_from, date_to)
+        :param fetch: function answering one lane, a lane raising an error is counted as failed
+        """
+        self.lanes = lanes
+        self.fetch = fetch
+        self.warmed = 0
+        self.failed = 0
+        self.seconds = None
+        self._done = threading.Event()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name='warmup', daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            for lane in self.lanes:
+                try:
+                    self.fetch(*lane)
+                    self.warmed += 1
+                except Exception:
+                    logger.exception("warm-up of lane %s failed", lane)
+                    self.failed += 1
+        finally:
+            self.seconds = time.perf_counter() - started
+            self._done.set()
+            logger.info("warmed %d lanes in %.2fs, %d failed", self.warmed, self.seconds, self.failed)
+
+    @property
+    def ready(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "lanes": len(self.lanes), "warmed": self.warmed, "failed": self.failed,
+                "seconds": None if self.seconds is None else round(self.seconds, 3)}